@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Generates a synthetic data set for benchmarking the taxonomy stages
+# (lca.py, add_contig_taxonomy.py and cluster_taxonomy.py) without the NCBI
+# databases. Writes to the output directory:
+#   nodes.dmp, names.dmp, merged.dmp    taxonomy tree in NCBI taxdump format
+#   prot.accession2taxid[.gz]           accession to taxid table
+#   orfs.blastp                         DIAMOND tabular hits against the accessions
+#   orfs.staxids.blastp                 the same hits with a staxids column
+#   contigs.tab                         contig table (as made by make_contig_table.py)
+#   params.json                         parameters the data set was generated with
+#
+# ORFs are named <contig>_<n> and most of a contig's hits fall within one
+# genus, so the LCA and voting stages do realistic work.
+
+import os
+import gzip
+import json
+import argparse
+import numpy as np
+
+from time import strftime
+
+canonical_ranks = ['superkingdom','phylum','class','order','family','genus','species']
+
+# Share of the taxa at each canonical rank. The remainder are strains and
+# 'no rank' nodes below species or between canonical ranks
+rank_fractions = [0.00002, 0.0002, 0.0006, 0.002, 0.008, 0.06, 0.7]
+
+def write_lines(fh, fmt, columns, chunksize=500000):
+    "Writes one line per row of the columns, formatted with fmt, in chunks"
+    n_rows = len(columns[0])
+    for i in range(0, n_rows, chunksize):
+        rows = zip(*[column[i:i+chunksize] for column in columns])
+        fh.write(''.join(fmt % row for row in rows))
+
+def make_tree(num_taxa, rng):
+    """
+    Returns arrays of taxids, parent taxids and rank names for a tree with
+    num_taxa nodes including root (taxid 1). Taxids are spread over a range
+    larger than num_taxa, as in NCBI, and not ordered by depth
+    """
+    counts = [max(2, int(num_taxa * fraction)) for fraction in rank_fractions]
+    # A few 'no rank' nodes between each pair of canonical ranks
+    links = [max(1, count // 20) for count in counts]
+    num_ranked = 1 + sum(counts) + sum(links)
+    num_leaves = max(0, num_taxa - num_ranked)
+    total = num_ranked + num_leaves
+    taxids = 2 + rng.choice(int(total * 1.3), total - 1, replace=False)
+    taxids = np.r_[1, taxids]
+
+    parents = np.ones(total, dtype=np.int64)
+    ranks = np.empty(total, dtype=object)
+    ranks[0] = 'no rank'
+    upper = np.array([1])
+    start = 1
+    levels = {}
+    for rank, count, n_links in zip(canonical_ranks, counts, links):
+        link_nodes = taxids[start:start+n_links]
+        parents[start:start+n_links] = rng.choice(upper, n_links)
+        ranks[start:start+n_links] = 'no rank'
+        start += n_links
+        level = taxids[start:start+count]
+        parents[start:start+count] = rng.choice(np.r_[upper, link_nodes], count)
+        ranks[start:start+count] = rank
+        start += count
+        levels[rank] = level
+        upper = level
+    parents[start:] = rng.choice(levels['species'], num_leaves)
+    ranks[start:] = np.where(rng.random_sample(num_leaves) < 0.5, 'strain', 'no rank')
+    return(taxids, parents, ranks, levels)
+
+def genus_of(query_taxids, taxids, parents, levels):
+    "Returns the genus of each of query_taxids (0 above genus) in the tree of taxids and parents"
+    parent_of = dict(zip(taxids.tolist(), parents.tolist()))
+    genera = set(levels['genus'].tolist())
+    result = np.zeros(len(query_taxids), dtype=np.int64)
+    memo = {}
+    for i, taxid in enumerate(query_taxids.tolist()):
+        path = []
+        while taxid not in memo and taxid not in genera and taxid != 1:
+            path.append(taxid)
+            taxid = parent_of[taxid]
+        genus = memo.get(taxid, taxid if taxid in genera else 0)
+        for node in path:
+            memo[node] = genus
+        result[i] = genus
+    return(result)
+
+parser = argparse.ArgumentParser(description='Generates synthetic taxonomy, accession and DIAMOND tables for benchmarking the taxonomy stages')
+parser.add_argument('-o', '--output_dir', metavar='<dir>', help='Directory to write the data set to', required=True)
+parser.add_argument('-t', '--taxa', metavar='<int>', help='Number of taxa in nodes.dmp (1000 to 2500000)', type=int, default=10000)
+parser.add_argument('-n', '--hits', metavar='<int>', help='Number of DIAMOND hits (10000 to 10000000)', type=int, default=100000)
+parser.add_argument('-a', '--accessions', metavar='<int>', help='Number of accessions in prot.accession2taxid (default: half the number of hits)', type=int)
+parser.add_argument('--hits_per_orf', metavar='<int>', help='Mean number of hits per ORF', type=int, default=10)
+parser.add_argument('--orfs_per_contig', metavar='<int>', help='Mean number of ORFs per contig', type=int, default=15)
+parser.add_argument('--gzip', help='Write prot.accession2taxid.gz instead of prot.accession2taxid', action='store_true')
+parser.add_argument('-s', '--seed', metavar='<int>', help='Random seed', type=int, default=1)
+args = vars(parser.parse_args())
+
+output_dir = os.path.abspath(args['output_dir'])
+num_taxa = args['taxa']
+num_hits = args['hits']
+num_accessions = args['accessions'] or max(1000, num_hits // 2)
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+rng = np.random.RandomState(args['seed'])
+
+print(strftime("%Y-%m-%d %H:%M:%S") + ' Writing taxonomy of {} taxa'.format(num_taxa))
+taxids, parents, ranks, levels = make_tree(num_taxa, rng)
+order = np.argsort(taxids)
+with open(os.path.join(output_dir, 'nodes.dmp'), 'w') as fh:
+    write_lines(fh, '%d\t|\t%d\t|\t%s\t|\t\t|\t0\t|\n', [taxids[order], parents[order], ranks[order]])
+with open(os.path.join(output_dir, 'names.dmp'), 'w') as fh:
+    # A synonym for every other taxid, listed before the scientific name
+    sorted_taxids = taxids[order]
+    synonyms = sorted_taxids[::2]
+    write_lines(fh, '%d\t|\tsynonym of %d\t|\t\t|\tsynonym\t|\n', [synonyms, synonyms])
+    write_lines(fh, '%d\t|\tTaxon %d\t|\t\t|\tscientific name\t|\n', [sorted_taxids, sorted_taxids])
+# Merged taxids are beyond the current ones and point at existing taxa
+num_merged = max(10, num_taxa // 100)
+merged_old = taxids.max() + 1 + rng.choice(num_merged * 2, num_merged, replace=False)
+merged_new = rng.choice(taxids[1:], num_merged)
+with open(os.path.join(output_dir, 'merged.dmp'), 'w') as fh:
+    write_lines(fh, '%d\t|\t%d\t|\n', [np.sort(merged_old), merged_new[np.argsort(merged_old)]])
+
+print(strftime("%Y-%m-%d %H:%M:%S") + ' Writing {} accessions'.format(num_accessions))
+# Proteins come from species and strains, with a few filed under merged taxids
+leaves = np.r_[levels['species'], taxids[ranks == 'strain']]
+acc_taxids = rng.choice(leaves, num_accessions)
+is_merged = rng.random_sample(num_accessions) < 0.01
+acc_taxids[is_merged] = rng.choice(merged_old, is_merged.sum())
+accession_ids = np.arange(num_accessions)
+acc2taxid_fpath = os.path.join(output_dir, 'prot.accession2taxid')
+if args['gzip']:
+    acc2taxid_fh = gzip.open(acc2taxid_fpath + '.gz', 'wb')
+else:
+    acc2taxid_fh = open(acc2taxid_fpath, 'w')
+acc2taxid_fh.write('accession\taccession.version\ttaxid\tgi\n')
+write_lines(acc2taxid_fh, 'SYN%09d\tSYN%09d.1\t%d\t%d\n', [accession_ids, accession_ids, acc_taxids, accession_ids])
+acc2taxid_fh.close()
+
+print(strftime("%Y-%m-%d %H:%M:%S") + ' Writing {} DIAMOND hits'.format(num_hits))
+# Accessions grouped by the genus of their taxid, so hits can be drawn from one genus
+# Merged taxids are treated as children of their new taxid
+unique_taxids, acc_index = np.unique(acc_taxids, return_inverse=True)
+acc_genus = genus_of(unique_taxids, np.r_[taxids, merged_old], np.r_[parents, merged_new], levels)[acc_index]
+by_genus = np.argsort(acc_genus, kind='mergesort')
+genus_sorted = acc_genus[by_genus]
+
+num_orfs = max(1, num_hits // args['hits_per_orf'])
+num_contigs = max(1, num_orfs // args['orfs_per_contig'])
+# Hits are grouped by ORF and ORFs by contig, as DIAMOND reports them
+hit_orfs = np.sort(rng.randint(0, num_orfs, num_hits))
+orf_contigs = np.sort(rng.randint(0, num_contigs, num_orfs))
+contig_genus = rng.choice(levels['genus'], num_contigs)
+hit_genus = contig_genus[orf_contigs[hit_orfs]]
+first = np.searchsorted(genus_sorted, hit_genus, side='left')
+last = np.searchsorted(genus_sorted, hit_genus, side='right')
+hit_accessions = rng.randint(0, num_accessions, num_hits)
+in_genus = (last > first) & (rng.random_sample(num_hits) < 0.9)
+offsets = (rng.random_sample(num_hits) * (last - first)).astype(np.int64)
+hit_accessions[in_genus] = by_genus[(first + offsets)[in_genus]]
+hit_taxids = acc_taxids[hit_accessions]
+# Some hits are to accessions missing from prot.accession2taxid
+missing = rng.random_sample(num_hits) < 0.005
+hit_accessions[missing] += num_accessions
+bitscores = np.round(rng.uniform(50, 1000, num_hits), 1)
+# DIAMOND reports the hits of each query by descending bitscore, so the first is the top hit
+order = np.lexsort((-bitscores, hit_orfs))
+hit_orfs, hit_accessions, hit_taxids, bitscores = hit_orfs[order], hit_accessions[order], hit_taxids[order], bitscores[order]
+
+contig_lengths = rng.randint(3000, 200000, num_contigs)
+contig_names = np.array(['NODE_{}_length_{}_cov_{:.4f}'.format(i + 1, length, cov)
+    for i, (length, cov) in enumerate(zip(contig_lengths, rng.uniform(1, 100, num_contigs)))])
+orf_numbers = np.arange(num_orfs) - np.searchsorted(orf_contigs, orf_contigs) + 1
+orf_names = np.core.defchararray.add(np.core.defchararray.add(contig_names[orf_contigs], '_'), orf_numbers.astype(str))
+
+blast_fmt = '%s\tSYN%09d.1\t90.0\t300\t30\t0\t1\t300\t1\t300\t1e-50\t%.1f'
+with open(os.path.join(output_dir, 'orfs.blastp'), 'w') as fh:
+    write_lines(fh, blast_fmt + '\n', [orf_names[hit_orfs], hit_accessions, bitscores])
+with open(os.path.join(output_dir, 'orfs.staxids.blastp'), 'w') as fh:
+    write_lines(fh, blast_fmt + '\t%d\n', [orf_names[hit_orfs], hit_accessions, bitscores, hit_taxids])
+
+with open(os.path.join(output_dir, 'contigs.tab'), 'w') as fh:
+    fh.write('contig\tlength\tgc\tcov\n')
+    covs = [name.rsplit('_', 1)[1] for name in contig_names]
+    write_lines(fh, '%s\t%d\t%.3f\t%s\n', [contig_names, contig_lengths, rng.uniform(25, 75, num_contigs), covs])
+
+params = dict(args, accessions=num_accessions, taxa_written=len(taxids), merged=num_merged,
+    orfs=num_orfs, contigs=num_contigs)
+with open(os.path.join(output_dir, 'params.json'), 'w') as fh:
+    json.dump(params, fh, indent=2, sort_keys=True)
+print(strftime("%Y-%m-%d %H:%M:%S") + ' Written to {}'.format(output_dir))
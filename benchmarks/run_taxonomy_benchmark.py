@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Times the taxonomy stages on a data set made by generate_taxonomy_data.py
+# and writes a JSON report. Each stage runs in its own process so its peak
+# resident memory can be measured. Stages:
+#   compile             compile the taxdump into taxonomy_db arrays
+#   lca_index           build the lifting LCA index (lca_functions)
+#   accessions          extract DIAMOND hits and resolve accessions to taxids
+#   lca                 reduce the distinct taxid sets of all ORFs to their LCA
+#   lca.py              lca.py end to end on the DIAMOND table
+#   add_contig_taxonomy add_contig_taxonomy.py end to end (contig voting)
+#   cluster_taxonomy    cluster_taxonomy.py end to end (cluster voting)
+# Library stages report the time of the measured step only; the time spent
+# loading their inputs is reported separately as setup_seconds.
+#
+# The pipeline's lca_functions extension must be built
+# (python setup_lca_functions.py build_ext --inplace in pipeline/).
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+pipeline_dir = os.path.join(os.path.dirname(benchmark_dir), 'pipeline')
+
+STAGES = ['compile', 'lca_index', 'accessions', 'lca', 'lca.py', 'add_contig_taxonomy', 'cluster_taxonomy']
+LIBRARY_STAGES = ['compile', 'lca_index', 'accessions', 'lca']
+
+def data_paths(data_dir):
+    "Returns the taxdump paths of a generated data set"
+    paths = dict((fname, os.path.join(data_dir, fname)) for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp'])
+    paths['acc2taxid'] = os.path.join(data_dir, 'prot.accession2taxid')
+    if not os.path.isfile(paths['acc2taxid']):
+        paths['acc2taxid'] += '.gz'
+    return(paths)
+
+def run_library_stage(stage, data_dir, work_dir, num_processors):
+    """
+    Runs one library stage in this process and returns its timings. Called in
+    a child process started by run_stage
+    """
+    sys.path.insert(0, pipeline_dir)
+    import taxonomy_db
+    import lca_functions
+
+    paths = data_paths(data_dir)
+    timings = {}
+    t0 = time.time()
+    if stage == 'compile':
+        # Compiled into the work directory so an existing database is not reused
+        cache_dir = os.path.join(work_dir, 'taxonomy_db')
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        t0 = time.time()
+        taxonomy = taxonomy_db.load(paths['nodes.dmp'], paths['names.dmp'], paths['merged.dmp'], cache_dir=cache_dir)
+        timings['seconds'] = time.time() - t0
+        timings['max_taxid'] = int(taxonomy.max_taxid)
+        return(timings)
+
+    # Other stages share the database the scripts load from the data directory
+    taxonomy = taxonomy_db.load(paths['nodes.dmp'], paths['names.dmp'], paths['merged.dmp'])
+    if stage == 'lca_index':
+        timings['setup_seconds'] = time.time() - t0
+        t0 = time.time()
+        jump_table, depth = lca_functions.Build_lifting_table(taxonomy.parents_dict())
+        timings['seconds'] = time.time() - t0
+        return(timings)
+
+    if stage == 'accessions':
+        timings['setup_seconds'] = time.time() - t0
+        t0 = time.time()
+        blast_dict = lca_functions.Extract_blast(os.path.join(data_dir, 'orfs.blastp'))
+        timings['extract_seconds'] = time.time() - t0
+        t1 = time.time()
+        acc2taxid_dict = lca_functions.Process_accession2taxid_file(paths['acc2taxid'], blast_dict, num_processors)
+        timings['resolve_seconds'] = time.time() - t1
+        timings['seconds'] = time.time() - t0
+        timings['orfs'] = len(blast_dict)
+        timings['accessions_resolved'] = len(acc2taxid_dict)
+        return(timings)
+
+    # lca: taxid sets are read from the staxids table so accession
+    # resolution is not part of the measurement
+    blast_taxids = lca_functions.Extract_blast(os.path.join(data_dir, 'orfs.staxids.blastp'), staxids=True)
+    taxsets = list(set(tuple(sorted(taxonomy.resolve_merged(list(taxset)).tolist())) for taxset in blast_taxids.itervalues() if taxset))
+    jump_table, depth = lca_functions.Build_lifting_table(taxonomy.parents_dict())
+    timings['setup_seconds'] = time.time() - t0
+    t0 = time.time()
+    lcas = lca_functions.Lifting_reduce_taxsets(taxsets, jump_table, depth)
+    timings['seconds'] = time.time() - t0
+    timings['taxsets'] = len(taxsets)
+    timings['failed_taxsets'] = sum(1 for lca, failed in lcas if lca is None)
+    return(timings)
+
+def script_command(stage, data_dir, work_dir, num_processors):
+    "Returns the command line for a script stage"
+    python = sys.executable
+    if stage == 'lca.py':
+        return([python, os.path.join(pipeline_dir, 'lca.py'), '-backend', 'lifting', '-p', str(num_processors),
+            '-out', os.path.join(work_dir, 'orfs.lca'), 'database_directory', data_dir, os.path.join(data_dir, 'orfs.blastp')])
+    if stage == 'add_contig_taxonomy':
+        return([python, os.path.join(pipeline_dir, 'add_contig_taxonomy.py'), '-p', str(num_processors),
+            os.path.join(data_dir, 'contigs.tab'), os.path.join(work_dir, 'orfs.lca'), data_dir,
+            os.path.join(work_dir, 'taxonomy.tab')])
+    return([python, os.path.join(pipeline_dir, 'cluster_taxonomy.py'), '-t', os.path.join(work_dir, 'clusters.tab'),
+        '-x', data_dir, '-o', os.path.join(work_dir, 'cluster_taxonomy.tab')])
+
+def write_cluster_table(work_dir, num_clusters=50):
+    "Assigns the contigs of the taxonomy table to clusters in turn, as a binning run would"
+    with open(os.path.join(work_dir, 'taxonomy.tab')) as infile:
+        with open(os.path.join(work_dir, 'clusters.tab'), 'w') as outfile:
+            outfile.write(infile.readline().rstrip('\n') + '\tcluster\n')
+            for i, line in enumerate(infile):
+                outfile.write('{}\tbin_{}\n'.format(line.rstrip('\n'), i % num_clusters))
+
+def run_stage(stage, data_dir, work_dir, num_processors, log):
+    """
+    Runs a stage in a child process and returns its report entry, with the
+    wall time and peak resident memory of the child
+    """
+    if stage in LIBRARY_STAGES:
+        command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '-p', str(num_processors),
+            '-w', work_dir, data_dir]
+    else:
+        if stage == 'cluster_taxonomy':
+            write_cluster_table(work_dir)
+        command = script_command(stage, data_dir, work_dir, num_processors)
+    stdout_path = os.path.join(work_dir, stage + '.out')
+    t0 = time.time()
+    with open(stdout_path, 'w') as stdout:
+        proc = subprocess.Popen(command, stdout=stdout, stderr=log)
+        # wait4 gives the resource usage of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+    entry = {'stage': stage, 'wall_seconds': time.time() - t0, 'exit_status': os.WEXITSTATUS(status),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        'peak_rss_mb': rusage.ru_maxrss / (1048576.0 if sys.platform == 'darwin' else 1024.0)}
+    if stage in LIBRARY_STAGES and entry['exit_status'] == 0:
+        with open(stdout_path) as fh:
+            entry.update(json.loads(fh.read().strip().split('\n')[-1]))
+    else:
+        entry['seconds'] = entry['wall_seconds']
+    return(entry)
+
+def git_commit():
+    try:
+        return(subprocess.check_output(['git', '-C', benchmark_dir, 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip())
+    except (subprocess.CalledProcessError, OSError):
+        return(None)
+
+parser = argparse.ArgumentParser(description='Times the taxonomy stages on a data set made by generate_taxonomy_data.py')
+parser.add_argument('data_dir', help='Directory written by generate_taxonomy_data.py')
+parser.add_argument('-o', '--report', metavar='<report.json>', help='Path of the JSON report (default: <work_dir>/benchmark.json)')
+parser.add_argument('-w', '--work_dir', metavar='<dir>', help='Directory for stage outputs (default: <data_dir>/benchmark)')
+parser.add_argument('-p', '--processors', metavar='<int>', help='Number of processors to pass to the stages', type=int, default=1)
+parser.add_argument('-s', '--stages', metavar='<stage>', nargs='+', choices=STAGES, default=STAGES,
+    help='Stages to run, in order: {}'.format(', '.join(STAGES)))
+parser.add_argument('--stage', help=argparse.SUPPRESS, choices=LIBRARY_STAGES)
+args = vars(parser.parse_args())
+
+data_dir = os.path.abspath(args['data_dir'])
+work_dir = os.path.abspath(args['work_dir'] or os.path.join(data_dir, 'benchmark'))
+num_processors = args['processors']
+
+if args['stage']:
+    # Child process of run_stage
+    print(json.dumps(run_library_stage(args['stage'], data_dir, work_dir, num_processors)))
+    exit(0)
+
+if not os.path.isdir(work_dir):
+    os.makedirs(work_dir)
+report_path = args['report'] or os.path.join(work_dir, 'benchmark.json')
+
+params = None
+params_path = os.path.join(data_dir, 'params.json')
+if os.path.isfile(params_path):
+    with open(params_path) as fh:
+        params = json.load(fh)
+
+report = {
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'processors': num_processors,
+    'data_dir': data_dir,
+    'data_params': params,
+    'stages': [],
+}
+with open(os.path.join(work_dir, 'benchmark.log'), 'w') as log:
+    for stage in [stage for stage in STAGES if stage in args['stages']]:
+        print(time.strftime("%Y-%m-%d %H:%M:%S") + ' Running {}'.format(stage))
+        entry = run_stage(stage, data_dir, work_dir, num_processors, log)
+        report['stages'].append(entry)
+        print('{}: {:.2f} s, peak RSS {:.1f} MB{}'.format(stage, entry['seconds'], entry['peak_rss_mb'],
+            '' if entry['exit_status'] == 0 else ' (failed with exit status {}, see benchmark.log)'.format(entry['exit_status'])))
+
+with open(report_path, 'w') as fh:
+    json.dump(report, fh, indent=2, sort_keys=True)
+print('written: {}'.format(report_path))
+if any(entry['exit_status'] for entry in report['stages']):
+    exit(1)
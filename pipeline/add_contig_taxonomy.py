@@ -29,244 +29,122 @@
 
 
 import sys
-import subprocess
 import pprint
 import os
+import collections
+import contig_tables
+import taxonomy_db
+import taxonomy_service
 
+import numpy as np
+import pandas as pd
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
 from time import *
 from tqdm import tqdm
 
-def isConsistentWithOtherOrfs(taxid, rank, ctg_lcas, nodes_dict):
-    """
-    Function that determines for a given taxid, whether the majority of proteins
-    in a contig, with rank equal to or above the given rank, are common
-    ancestors of the taxid.  If the majority are, this function returns True,
-    otherwise it returns False
-    """
-    # ctg_lcas = {ctg:{canonical_rank:{taxid:num_hits,...},...},ctg2:{...},...}
-    # First we make a modified rank_priority list that only includes the current rank and above
-    rank_index = rank_priority.index(rank)
-    ranks_to_consider = rank_priority[rank_index:]
-
-    # Now we total up the consistent and inconsistent ORFs
-    consistent = 0
-    inconsistent = 0
-
-    for rankName in ranks_to_consider:
-        if rankName not in ctg_lcas:
-            continue
-        for ctg_lca in ctg_lcas[rankName]:
-            if isCommonAncestor(ctg_lca, taxid, nodes_dict):
-                consistent += ctg_lcas[rankName][ctg_lca]
-            else:
-                inconsistent += ctg_lcas[rankName][ctg_lca]
-
-    if consistent > inconsistent:
-        return True
-    else:
-        return False
-
-def isCommonAncestor(parent_taxid, child_taxid, nodes_dict):
-    ancestor_taxid = child_taxid
-    while ancestor_taxid != 1:
-        if parent_taxid == ancestor_taxid:
-            return True
-        ancestor_taxid = nodes_dict[ancestor_taxid]['parent']
-    return False
-
-def lowest_majority(ctg_lcas, nodes_dict):
-    # ctg_lcas = {canonical_rank:{taxid:num_hits, taxid2:#,...},rank2:{...},...}
-    taxid_totals = {}
-
-    for rank in rank_priority:
-        if rank not in ctg_lcas:
-            continue
-
-        rank_index = rank_priority.index(rank)
-        ranks_to_consider = rank_priority[rank_index:]
-
-        for taxid in ctg_lcas[rank]:
-            # Make a dictionary to total the number of canonical ranks hit
-            # while traversing the path so that we can add 'unclassified' to
-            # any that don't exist. Later we need to make sure that
-            # 'unclassified' doesn't ever win
-            ranks_in_path = {rank_to_consider:0 for rank_to_consider in ranks_to_consider}
-
-            # We need to add to taxid_totals for each taxid in the tax_path
-            current_taxid = taxid
-            current_rank = rank
-            while current_taxid != 1:
-                if current_rank not in set(rank_priority):
-                    current_taxid = nodes_dict[current_taxid]['parent']
-                    current_rank = nodes_dict[current_taxid]['rank']
-                    continue
-
-                ranks_in_path[current_rank] += 1
-
-                if current_rank not in taxid_totals:
-                    taxid_totals.update({current_rank:{current_taxid:1}})
-                    current_taxid = nodes_dict[current_taxid]['parent']
-                    current_rank = nodes_dict[current_taxid]['rank']
-                    continue
-
-                if current_taxid in taxid_totals[current_rank]:
-                    taxid_totals[current_rank][current_taxid] += 1
-                else:
-                    taxid_totals[current_rank][current_taxid] = 1
-
-                current_taxid = nodes_dict[current_taxid]['parent']
-                current_rank = nodes_dict[current_taxid]['rank']
-
-            # Now go through ranks_in_path. Where total = 0, add 'unclassified'
-            for rank_to_consider in ranks_to_consider:
-                if ranks_in_path[rank_to_consider] == 0:
-                    if rank_to_consider not in taxid_totals:
-                        taxid_totals[rank_to_consider] = {'unclassified':1}
-                        continue
-                    if 'unclassified' in taxid_totals[rank_to_consider]:
-                        taxid_totals[rank_to_consider]['unclassified'] += 1
-                    else:
-                        taxid_totals[rank_to_consider]['unclassified'] = 1
-
-
-    # If there are any gaps in the taxonomy paths for any of the proteins in the contig,
-    # we need to add 'unclassified' to the relevant canonical taxonomic rank.
-    # However, we must never allow 'unclassified' to win! (That just won't really tell us anything)
-
-    # Now we need to determine which is the first level to have a majority
-    for rank in rank_priority:
-        total_votes = 0
-        taxid_leader = None
-        taxid_leader_votes = 0
-        if not rank in taxid_totals:
-            continue
-        for taxid in taxid_totals[rank]:
-            taxid_votes = taxid_totals[rank][taxid]
-            total_votes += taxid_votes
-            if taxid_votes > taxid_leader_votes:
-                taxid_leader = taxid
-                taxid_leader_votes = taxid_votes
-        majority_threshold = float(total_votes)/2
-        if taxid_leader_votes > majority_threshold and taxid_leader != 'unclassified':
-            return taxid_leader
-    # Just in case
-    return 1
-
-def parse_names(names_dmp_path):
-    names = {}
-    print(strftime("%Y-%m-%d %H:%M:%S") + ' Processing taxid names')
-    wc_output = subprocess.check_output(['wc', '-l', names_dmp_path])
-    wc_list = wc_output.split()
-    number_of_lines = int(wc_list[0])
-    with open(names_dmp_path) as names_dmp:
-        for line in tqdm(names_dmp, total=number_of_lines):
-            taxid, name, _, classification = line.strip('\t|\n').split('\t|\t')[:4]
-            taxid = int(taxid)
-            # Only add scientific name entries
-            scientific = classification == 'scientific name'
-            if scientific:
-                # line_list[1] = line_list[1].replace(' ', '_')
-                names.update({taxid:name})
-    return(names)
-
-def parse_nodes(nodes_dmp_path):
-    print(strftime("%Y-%m-%d %H:%M:%S") + ' Processing taxid nodes')
-    wc_output = subprocess.check_output(['wc', '-l', nodes_dmp_path])
-    wc_list = wc_output.split()
-    number_of_lines = int(wc_list[0])
-    nodes_dmp = open(nodes_dmp_path)
-    root_line = nodes_dmp.readline()
-    nodes = {}
-    nodes.update({1:{'parent':1, 'rank':'root'}})
-    for line in tqdm(nodes_dmp, total=number_of_lines):
-        child, parent, rank = line.split('\t|\t')[:3]
-        parent, child = map(int,[parent, child])
-        nodes.update({child:{'parent':parent, 'rank':rank}})
-    nodes_dmp.close()
-    return(nodes)
-
-def parse_merged(fpath):
-    print(strftime("%Y-%m-%d %H:%M:%S") + ' Processing merged taxid nodes')
-    wc_output = subprocess.check_output(['wc', '-l', fpath])
-    wc_list = wc_output.split()
-    number_of_lines = int(wc_list[0])
-    fh = open(fpath)
-    merged = {}
-    for line in tqdm(fh, desc='parsing merged', total=number_of_lines, leave=False):
-        old_taxid, new_taxid = [int(taxid) for taxid in line.strip('\t|\n').split('\t|\t')]
-        merged.update({old_taxid:new_taxid})
-    fh.close()
-    return(merged)
-
-def parse_lca(lca_fpath):
+def parse_lca(lca_fpath, chunksize=1000000):
     print( strftime("%Y-%m-%d %H:%M:%S") + ' Parsing lca taxonomy table')
-    # Work out number of lines in file
-    wc_output = subprocess.check_output(['wc', '-l', lca_fpath])
-    wc_list = wc_output.split()
-    number_of_lines = int(wc_list[0])
-    number_of_proteins = {}
-    lca_hits = {}
+    # Each taxid votes at its lowest canonical rank (the last filled slot of
+    # its lineage) or at root if it has none. ORFs lca.py placed at root
+    # itself are kept under 'no rank', which never takes part in the vote
+    rank_names = canonical_ranks + ['root', 'no rank']
+    root_code = len(canonical_ranks)
+    unranked_code = root_code + 1
+    filled = lineage != 0
+    lowest_slot = np.where(filled.any(axis=1),
+        root_code - 1 - np.argmax(filled[:,::-1], axis=1), root_code)
+    lowest_taxid = np.ones(lineage.shape[0], dtype=np.int64)
+    has_slot = lowest_slot != root_code
+    lowest_taxid[has_slot] = lineage[has_slot, lowest_slot[has_slot]]
+
     # lca_hits[contig][rank][taxid] (running total of each thing)
-    fh = open(lca_fpath)
-    for line in tqdm(fh, total=number_of_lines):
-        orf, name, rank, taxid = line.strip().split('\t')
-        contig, orf_num = orf.rsplit('_', 1)
-        taxid = int(taxid)
-        # Convert any nodes that were recently suppressed/deprecated
-        # to their new node taxid. Otherwise keep the same taxid
-        taxid = merged.get(taxid, taxid)
-        if taxid != 1:
-            while rank not in set(rank_priority):
-                taxid = nodes[taxid]['parent']
-                rank = nodes[taxid]['rank']
-        # Count number of proteins per contig
-        if contig in number_of_proteins:
-            number_of_proteins[contig] += 1
-        else:
-            number_of_proteins[contig] = 1
-
-        # Keep running total of taxids for each contig
-        if contig not in lca_hits:
-            lca_hits.update({contig:{rank:{taxid:1}}})
-            continue
+    counts = []
+    lines_read = 0
+    try:
+        reader = pd.read_csv(lca_fpath, sep='\t', header=None, usecols=[0,3],
+            names=['orf','taxid'], dtype={'orf':str,'taxid':np.int64},
+            na_filter=False, chunksize=chunksize)
+        pbar = tqdm(unit=' lines')
+        for chunk in reader:
+            pbar.update(len(chunk))
+            taxids = chunk['taxid'].values
+            # Convert any nodes that were recently suppressed/deprecated
+            # to their new node taxid. Otherwise keep the same taxid
+            taxids = taxonomy.resolve_merged(taxids)
+            contigs = chunk['orf'].str.rsplit('_', n=1).str[0].values
+            in_tree = (taxids < lineage.shape[0]) & (taxids != 1)
+            rank_codes = np.full(len(taxids), root_code, dtype=np.int64)
+            rank_codes[in_tree] = lowest_slot[taxids[in_tree]]
+            rank_codes[taxids == 1] = unranked_code
+            rank_taxids = np.ones(len(taxids), dtype=np.int64)
+            rank_taxids[in_tree] = lowest_taxid[taxids[in_tree]]
+            # First line of each count is kept so ties can be broken in file order
+            votes = pd.DataFrame({'contig':contigs, 'rank':rank_codes, 'taxid':rank_taxids,
+                'line':np.arange(lines_read, lines_read + len(chunk))})
+            counts.append(votes.groupby(['contig','rank','taxid'])['line'].agg(['size','min']))
+            lines_read += len(chunk)
+        pbar.close()
+    except pd.errors.EmptyDataError:
+        pass
 
+    lca_hits = {}
+    if not counts:
+        return(lca_hits)
+    totals = pd.concat(counts).groupby(level=[0,1,2]).agg({'size':'sum','min':'min'})
+    totals.sort_values('min', inplace=True)
+    for (contig, rank_code, taxid), num_hits in totals['size'].iteritems():
+        rank = rank_names[rank_code]
+        if contig not in lca_hits:
+            lca_hits[contig] = {}
         if rank not in lca_hits[contig]:
-            lca_hits[contig].update({rank:{taxid:1}})
-            continue
-
-        if taxid not in lca_hits[contig][rank]:
-            lca_hits[contig][rank].update({taxid:1})
-        else:
-            lca_hits[contig][rank][taxid] += 1
-    fh.close()
+            # Ordered, so taxids with equal votes stay in order of first appearance
+            lca_hits[contig][rank] = collections.OrderedDict()
+        lca_hits[contig][rank][int(taxid)] = int(num_hits)
     return(lca_hits)
 
-def rank_taxids(ctg_lcas):
+def vote_contig(contig_lcas):
+    # In descending order of rank and votes, accept the first taxid consistent
+    # with the majority of other ORFs. If there is some kind of draw, find the
+    # lowest taxonomic level where there is a majority
+    return(taxonomy_db.vote_taxid(contig_lcas, lineage))
+
+# Set before the worker pool is created so forked workers share it (along
+# with the lineage table) copy-on-write instead of receiving it by pickle
+voting_lcas = {}
+
+def vote_contig_batch(contigs):
+    return([(contig, vote_contig(voting_lcas[contig])) for contig in contigs])
+
+def rank_taxids(ctg_lcas, num_processors=1):
+    global voting_lcas
 
     print(strftime("%Y-%m-%d %H:%M:%S") + ' Ranking taxids')
     n_contigs = len(ctg_lcas)
     top_taxids = {}
-    for contig in tqdm(ctg_lcas, total=n_contigs):
-        acceptedTaxid = None
-        for rank in rank_priority:
-            if acceptedTaxid is not None:
-                break
-            # Order in descending order of votes
-            if rank in ctg_lcas[contig]:
-                ordered_taxids = sorted(ctg_lcas[contig][rank], key=lambda tid:ctg_lcas[contig][rank][tid], reverse=True)
-                #sys.exit()
-                for taxid in ordered_taxids:
-                    if isConsistentWithOtherOrfs(taxid, rank, ctg_lcas[contig], nodes):
-                        acceptedTaxid = taxid
-                        break
-
-        # If acceptedTaxid is still None at this point, there was some kind of
-        # draw, so we need to find the lowest taxonomic level where there is a
-        # majority
-        if acceptedTaxid is None:
-            acceptedTaxid = lowest_majority(ctg_lcas[contig], nodes)
-
-        top_taxids[contig] = acceptedTaxid
+    if service is not None:
+        contigs = list(ctg_lcas)
+        top_taxids.update(zip(contigs, service.vote(ctg_lcas[contig] for contig in contigs)))
+        return(top_taxids)
+    if num_processors <= 1:
+        for contig in tqdm(ctg_lcas, total=n_contigs):
+            top_taxids[contig] = vote_contig(ctg_lcas[contig])
+        return(top_taxids)
+
+    voting_lcas = ctg_lcas
+    contigs = list(ctg_lcas)
+    # Several batches per worker keeps the load even when contigs differ in ORF count
+    batch_size = max(1, min(1000, n_contigs // (num_processors * 8)))
+    batches = [contigs[i:i+batch_size] for i in range(0, n_contigs, batch_size)]
+    pool = Pool(num_processors)
+    with tqdm(total=n_contigs) as pbar:
+        for votes in pool.imap(vote_contig_batch, batches):
+            top_taxids.update(votes)
+            pbar.update(len(votes))
+    pool.close()
+    pool.join()
+    voting_lcas = {}
     return(top_taxids)
 
 def resolve_taxon_paths(ctg2taxid):
@@ -275,85 +153,46 @@ def resolve_taxon_paths(ctg2taxid):
     # {contig:{rank1:name1,rank2,name2},contig2:{rank1:name1,rank2:name2,...},...}
     n_contigs = len(ctg2taxid)
     for contig in tqdm(ctg2taxid, total=n_contigs):
-        taxid = ctg2taxid[contig]
-        if taxid == 1:
-            contig_paths.update({contig:{'root':names[taxid]}})
-        while taxid != 1:
-            current_rank = nodes[taxid]['rank']
-            if current_rank not in set(rank_priority):
-                taxid = nodes[taxid]['parent']
-                continue
-
-            name = names[taxid]
-
-            if contig not in contig_paths:
-                contig_paths.update({contig:{current_rank:name}})
-            else:
-                contig_paths[contig][current_rank] = name
-            taxid = nodes[taxid]['parent']
-
-        for rank in rank_priority:
-            if rank not in contig_paths[contig]:
-                contig_paths[contig][rank] = 'unclassified'
-
-    for contig in contig_paths:
-        contig_paths[contig].pop('root')
+        # Contigs voted to the same taxid share one lookup
+        contig_paths[contig] = dict(zip(canonical_ranks, taxonomy.lineage_names(ctg2taxid[contig])))
         contig_paths[contig]['taxid'] = ctg2taxid[contig]
 
     return(contig_paths)
 
 def write_taxa(ranked_ctgs, contig_table_fpath, outfpath):
     print(strftime("%Y-%m-%d %H:%M:%S") + ' Writing table')
-    outfile = open(outfpath, 'w')
-    fh = open(contig_table_fpath)
-    header = fh.readline().rstrip('\n')
-    header += '\t'.join([
-        '','kingdom','phylum','class','order','family','genus','species','taxid'
-        ]) + '\n'
-    outfile.write(header)
-
-    for line in fh:
-        original_line = line.rstrip('\n')
-        line_list = original_line.split('\t')
-        ctg = line_list[0]
-        if ctg not in ranked_ctgs:
-            # In this case we fill up the record with 'unclassified'
-            # - probably this results from the contig having no blast hits
-            ranked_ctgs[ctg] = {}
-            for rank in rank_priority:
-                ranked_ctgs[ctg][rank] = 'unclassified'
-                ranked_ctgs[ctg]['taxid'] = 'unclassified'
-
-        new_line = [ranked_ctgs[ctg][rank] for rank in reversed(rank_priority)]
-        new_line.insert(0, original_line)
-        new_line.append(str(ranked_ctgs[ctg]['taxid']))
-
-        outline = '\t'.join(map(str, new_line)) + '\n'
-        outfile.write(outline)
-    outfile.close()
-
-
-
-if not len(sys.argv) == 5:
-    usage = 'Usage: add_contig_taxonomy.py <contig_table_path> <tax_table_path> <taxdump_dir_path> <output_file_path>'
-    exit(usage)
-
-contig_tab_path = sys.argv[1]
-tax_table_path = sys.argv[2]
-taxdump_dir_path = os.path.abspath(sys.argv[3])
-output_file_path = sys.argv[4]
-
-# Process NCBI taxdump files
-name_fpath = os.path.join(taxdump_dir_path, 'names.dmp')
-nodes_fpath = os.path.join(taxdump_dir_path, 'nodes.dmp')
-merged_fpath = os.path.join(taxdump_dir_path, 'merged.dmp')
+    ranks = list(reversed(rank_priority))
+    contigs = list(ranked_ctgs)
+    taxa = pd.DataFrame([[str(ranked_ctgs[ctg][rank]) for rank in ranks] + [str(ranked_ctgs[ctg]['taxid'])]
+        for ctg in contigs], index=contigs, columns=ranks + ['taxid'])
+    header = ['kingdom','phylum','class','order','family','genus','species','taxid']
+    # Contigs missing from ranked_ctgs are filled with 'unclassified'
+    # - probably this results from the contig having no blast hits
+    contig_tables.join_tables(contig_table_fpath, header, taxa, [outfpath], fill_value='unclassified')
+
+
+parser = ArgumentParser(description='Adds contig taxonomy to a table made by make_contig_table.py')
+parser.add_argument('contig_table_path', help='Contig table from make_contig_table.py')
+parser.add_argument('tax_table_path', help='ORF taxonomy table (.lca) from lca.py')
+parser.add_argument('taxdump_dir_path', help='Directory containing names.dmp, nodes.dmp and merged.dmp')
+parser.add_argument('output_file_path', help='Path of the output taxonomy table (ending in .feather or .parquet for a columnar table)')
+parser.add_argument('-p', '--processors', metavar='<int>', help='Number of processors to use for contig voting', type=int, default=1)
+args = vars(parser.parse_args())
+
+contig_tab_path = args['contig_table_path']
+tax_table_path = args['tax_table_path']
+taxdump_dir_path = os.path.abspath(args['taxdump_dir_path'])
+output_file_path = args['output_file_path']
+num_processors = args['processors']
 
 pp = pprint.PrettyPrinter(indent=4)
 
-# Build taxid tree structure with associated canoncial ranks and names
-names = parse_names(name_fpath)
-nodes = parse_nodes(nodes_fpath)
-merged = parse_merged(merged_fpath)
+# Load taxid tree structure with associated canonical ranks and names,
+# compiled from the NCBI taxdump files on first use
+print(strftime("%Y-%m-%d %H:%M:%S") + ' Loading taxonomy database')
+taxonomy = taxonomy_db.load_dir(taxdump_dir_path)
+# Contigs are voted on by the taxonomy service if one is running for the same databases
+service = taxonomy_service.connect(taxonomy_service.socket_path(taxdump_dir_path), taxonomy.key)
 
 rank_priority = [
     'species',
@@ -365,11 +204,17 @@ rank_priority = [
     'superkingdom',
     'root']
 
+# Columns of the lineage table, from the top of the tree down
+canonical_ranks = taxonomy_db.canonical_ranks
+
+# Canonical ancestors of every taxid, so ancestor checks are a single lookup
+lineage = taxonomy.lineage
+
 # retrieve lca taxids for each contig
 classifications = parse_lca(tax_table_path)
 
 # Vote for majority lca taxid from contig lca taxids
-contigs_to_taxid = rank_taxids(classifications)
+contigs_to_taxid = rank_taxids(classifications, num_processors)
 
 # Add all corresponding canonical ranks from voted taxid
 ranked_contigs = resolve_taxon_paths(contigs_to_taxid)
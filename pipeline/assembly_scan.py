@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Reads an assembly once and writes, for the contigs at or above a length
+# cutoff, any of:
+#   the filtered fasta       as written by fasta_length_trim.pl
+#   the contig table         contig, length, gc and cov, as made by make_contig_table.py
+#   the k-mer matrix         as counted by recursive_dbscan.py (5-mers, reverse
+#                            complements combined, counts starting at 1)
+# The assembly is streamed in chunks of contigs whose GC content and k-mer
+# counts are computed by worker processes, and rows are written in assembly
+# order as the chunks come back.
+
+import os
+import argparse
+import itertools
+import numpy as np
+
+from multiprocessing import Pool
+
+K_MER_SIZE = 5
+DNA_LETTERS = 'ATCG'
+CHUNK_BASES = 8388608
+
+# Codes of the bases counted in k-mers. Anything else (including lower case)
+# breaks k-mers, as in recursive_dbscan.py
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = code
+
+def revcomp(k_mer):
+    complements = {'A':'T', 'T':'A', 'C':'G', 'G':'C'}
+    return(''.join(complements[base] for base in reversed(k_mer)))
+
+def unique_k_mers(k_mer_size=K_MER_SIZE):
+    "Returns the k-mers counted, one of each reverse complement pair, in matrix column order"
+    all_k_mers = list(DNA_LETTERS)
+    for i in range(1, k_mer_size):
+        all_k_mers = [k_mer + base for k_mer in all_k_mers for base in DNA_LETTERS]
+    k_mers = []
+    seen = set()
+    for k_mer in all_k_mers:
+        if k_mer not in seen and revcomp(k_mer) not in seen:
+            k_mers.append(k_mer)
+            seen.add(k_mer)
+    return(k_mers)
+
+def k_mer_columns(k_mer_size=K_MER_SIZE):
+    "Returns the matrix column of each k-mer, indexed by its base codes read as a base 4 number"
+    columns = np.zeros(4 ** k_mer_size, dtype=np.int64)
+    for column, k_mer in enumerate(unique_k_mers(k_mer_size)):
+        for strand in [k_mer, revcomp(k_mer)]:
+            columns[sum(BASE_CODES[ord(base)] * 4 ** (k_mer_size - 1 - i) for i, base in enumerate(strand))] = column
+    return(columns)
+
+def count_k_mers(seq, columns, k_mer_size=K_MER_SIZE):
+    "Returns the k-mer counts of seq, plus one so none are zero"
+    num_columns = columns.max() + 1
+    # recursive_dbscan.py counted the k-mers starting before the last k_mer_size bases
+    num_k_mers = len(seq) - k_mer_size
+    if num_k_mers <= 0:
+        return(np.ones(num_columns, dtype=np.int64))
+    codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    values = np.zeros(num_k_mers, dtype=np.int64)
+    valid = np.ones(num_k_mers, dtype=bool)
+    for i in range(k_mer_size):
+        window = codes[i:i + num_k_mers]
+        values = values * 4 + (window & 3)
+        valid &= window < 4
+    return(np.bincount(columns[values[valid]], minlength=num_columns) + 1)
+
+def gc_content(seq):
+    # As Bio.SeqUtils.GC, which also counts S (G or C)
+    gc = sum(seq.count(base) for base in ['G', 'C', 'g', 'c', 'S', 's'])
+    try:
+        return(gc * 100.0 / len(seq))
+    except ZeroDivisionError:
+        return(0.0)
+
+def scan_chunk(args):
+    "Returns (gc, k-mer counts text or None) for each sequence of a chunk"
+    seqs, k_mer_size, count = args
+    columns = k_mer_columns(k_mer_size) if count else None
+    results = []
+    for seq in seqs:
+        k_mer_text = None
+        if count:
+            k_mer_text = '\t'.join(str(n) for n in count_k_mers(seq, columns, k_mer_size))
+        results.append((gc_content(seq), k_mer_text))
+    return(results)
+
+def read_records(fasta_fpath):
+    "Yields (header line, sequence) for each record of the fasta file"
+    header = None
+    lines = []
+    with open(fasta_fpath) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if header is not None:
+                    yield((header, ''.join(lines)))
+                header = line.rstrip('\r\n')
+                lines = []
+            else:
+                lines.append(line.strip())
+    if header is not None:
+        yield((header, ''.join(lines)))
+
+def read_chunks(fasta_fpath, length_cutoff, chunk_bases=CHUNK_BASES):
+    "Yields lists of the (header line, sequence) records at least length_cutoff long"
+    chunk = []
+    bases = 0
+    for header, seq in read_records(fasta_fpath):
+        if len(seq) < length_cutoff:
+            continue
+        chunk.append((header, seq))
+        bases += len(seq)
+        if bases >= chunk_bases:
+            yield(chunk)
+            chunk = []
+            bases = 0
+    if chunk:
+        yield(chunk)
+
+def read_coverage_table(fpath):
+    "Returns the coverage of each contig in a table made by calculate_read_coverage.py"
+    coverages = {}
+    with open(fpath) as table:
+        for i, line in enumerate(table):
+            if i > 0:
+                line_list = line.rstrip().split('\t')
+                coverages[line_list[0]] = float(line_list[1])
+    return(coverages)
+
+def spades_coverage(contig):
+    "Returns the coverage in a SPAdes contig name (NODE_<n>_length_<length>_cov_<cov>)"
+    fields = contig.split('_')
+    if len(fields) < 6 or fields[0] != 'NODE' or fields[2] != 'length' or fields[4] != 'cov':
+        raise ValueError(contig + ' not the right format to extract coverage from sequence name')
+    return(fields[5])
+
+def contig_row(contig, length, gc, coverages, no_coverage):
+    if no_coverage:
+        return('{}\t{}\t{}\n'.format(contig, length, gc))
+    if coverages is None:
+        cov = spades_coverage(contig)
+    elif contig in coverages:
+        cov = coverages[contig]
+    else:
+        raise ValueError(contig + ' not found in the coverage table')
+    return('{}\t{}\t{}\t{}\n'.format(contig, length, gc, cov))
+
+def write_rows(outfiles, records, results, filtered_fpath, table_fpath, matrix_fpath, coverages, no_coverage):
+    for (header, seq), (gc, k_mer_text) in zip(records, results):
+        contig = header[1:].split()[0] if header[1:].split() else ''
+        if filtered_fpath:
+            outfiles[filtered_fpath].write('{}\n{}\n'.format(header, seq))
+        if table_fpath:
+            outfiles[table_fpath].write(contig_row(contig, len(seq), gc, coverages, no_coverage))
+        if matrix_fpath:
+            outfiles[matrix_fpath].write('{}\t{}\n'.format(contig, k_mer_text))
+
+def scan_assembly(assembly_fpath, length_cutoff=0, filtered_fpath=None, table_fpath=None, matrix_fpath=None,
+        coverage_table=None, no_coverage=False, k_mer_size=K_MER_SIZE, num_processors=1):
+    """
+    Writes the filtered fasta, contig table and k-mer matrix (whichever paths
+    are given) for the contigs at least length_cutoff long, reading the
+    assembly once. Coverage comes from coverage_table, or the SPAdes contig
+    names unless no_coverage. Raises ValueError for contigs without coverage
+    """
+    coverages = read_coverage_table(coverage_table) if coverage_table else None
+    out_fpaths = [fpath for fpath in [filtered_fpath, table_fpath, matrix_fpath] if fpath]
+    tmp_suffix = '.{}.tmp'.format(os.getpid())
+    outfiles = dict((fpath, open(fpath + tmp_suffix, 'w')) for fpath in out_fpaths)
+    if table_fpath:
+        outfiles[table_fpath].write('contig\tlength\tgc\n' if no_coverage else 'contig\tlength\tgc\tcov\n')
+    if matrix_fpath:
+        # The corner is blank because the contig names are listed under it
+        outfiles[matrix_fpath].write('\t'.join([''] + unique_k_mers(k_mer_size)) + '\n')
+    pool = Pool(num_processors) if num_processors > 1 else None
+    try:
+        chunks = read_chunks(assembly_fpath, length_cutoff)
+        # A few chunks per process are read at a time, so memory use is bounded
+        batch = list(itertools.islice(chunks, 2 * num_processors))
+        while batch:
+            tasks = [([seq for header, seq in chunk], k_mer_size, matrix_fpath is not None) for chunk in batch]
+            results = pool.map(scan_chunk, tasks) if pool else map(scan_chunk, tasks)
+            write_rows(outfiles, [record for chunk in batch for record in chunk],
+                [result for chunk_results in results for result in chunk_results],
+                filtered_fpath, table_fpath, matrix_fpath, coverages, no_coverage)
+            batch = list(itertools.islice(chunks, 2 * num_processors))
+    except:
+        for fpath, outfile in outfiles.items():
+            outfile.close()
+            os.remove(fpath + tmp_suffix)
+        raise
+    finally:
+        if pool:
+            pool.terminate()
+    for fpath, outfile in outfiles.items():
+        outfile.close()
+        os.rename(fpath + tmp_suffix, fpath)
+    return(out_fpaths)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reads an assembly once, writing the length filtered fasta, \
+        contig table (length, GC, coverage) and k-mer matrix of the contigs above a length cutoff')
+    parser.add_argument('-a', '--assembly', metavar='<assembly.fasta>', help='Path to assembly fasta', required=True)
+    parser.add_argument('-l', '--length_cutoff', metavar='<int>', help='Contig length cutoff in bp', type=int, default=0)
+    parser.add_argument('-f', '--filtered', metavar='<filtered.fasta>', help='Path of the filtered fasta to write')
+    parser.add_argument('-t', '--table', metavar='<contigs.tab>', help='Path of the contig table to write')
+    parser.add_argument('-m', '--k_mer_matrix', metavar='<k-mer_matrix>', help='Path of the k-mer matrix to write')
+    parser.add_argument('-c', '--coverage', metavar='<coverage.tab>', help='Coverage table made by calculate_read_coverage.py \
+        (otherwise coverage is taken from SPAdes contig names)')
+    parser.add_argument('-n', '--no_coverage', help='Leave coverage out of the contig table', action='store_true')
+    parser.add_argument('-p', '--processors', metavar='<int>', help='Number of processes computing GC and k-mers', type=int, default=1)
+    args = vars(parser.parse_args())
+    if not (args['filtered'] or args['table'] or args['k_mer_matrix']):
+        parser.error('give at least one of --filtered, --table and --k_mer_matrix')
+    try:
+        scan_assembly(args['assembly'], args['length_cutoff'], args['filtered'], args['table'], args['k_mer_matrix'],
+            args['coverage'], args['no_coverage'], num_processors=args['processors'])
+    except ValueError as err:
+        exit('Error, {}'.format(err))
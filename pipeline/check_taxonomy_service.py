@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Starts taxonomy_service.py on a temporary socket for a databases directory,
+# checks that its ping, lca, lineage and vote answers are the same as those
+# of the taxonomy loaded locally, and shuts it down. Exits with 1 if any
+# answer differs.
+#
+#   check_taxonomy_service.py <databases directory> [-n <int>]
+
+import os
+import sys
+import time
+import random
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+import collections
+
+import numpy as np
+
+import taxonomy_db
+import taxonomy_service
+import lca_functions
+
+PIPELINE = os.path.dirname(os.path.realpath(__file__))
+# Seconds to wait for the service to load the databases and start listening
+START_TIMEOUT = 600
+
+def start_service(db_dir, sock_path):
+    "Returns the service process and a client connected to it"
+    proc = subprocess.Popen([sys.executable, os.path.join(PIPELINE, 'taxonomy_service.py'), db_dir, '--socket', sock_path])
+    started = time.time()
+    while time.time() - started < START_TIMEOUT:
+        if proc.poll() is not None:
+            exit('Error, taxonomy service exited with code {}'.format(proc.returncode))
+        client = taxonomy_service.connect(sock_path)
+        if client is not None:
+            return(proc, client)
+        time.sleep(1)
+    proc.terminate()
+    proc.wait()
+    exit('Error, taxonomy service did not start within {} seconds'.format(START_TIMEOUT))
+
+def sample_taxids(taxonomy, num_taxids):
+    "Returns up to num_taxids random taxids of nodes.dmp that have a canonical rank ancestor"
+    taxids = np.flatnonzero(taxonomy.lineage.any(axis=1)).tolist()
+    return(random.sample(taxids, min(num_taxids, len(taxids))))
+
+def sample_rank_counts(taxonomy, taxids, num_votes):
+    "Returns {rank:{taxid:votes}} for random votes for the lowest canonical ancestors of taxids"
+    rank_counts = {}
+    for taxid in random.sample(taxids, min(num_votes, len(taxids))):
+        lineage = taxonomy.lineage[taxid]
+        slot = max(i for i, ancestor in enumerate(lineage) if ancestor)
+        rank = taxonomy_db.canonical_ranks[slot]
+        if rank not in rank_counts:
+            rank_counts[rank] = collections.OrderedDict()
+        # Few distinct vote counts, so that ties are checked too
+        rank_counts[rank][int(lineage[slot])] = random.randint(1, 3)
+    return(rank_counts)
+
+def compare(op, local, served):
+    mismatches = [i for i, (expected, answer) in enumerate(zip(local, served)) if expected != answer]
+    if len(local) != len(served):
+        mismatches.append(min(len(local), len(served)))
+    if mismatches:
+        print('{}: {} of {} answers differ, e.g. {} locally but {} from the service'.format(op, len(mismatches),
+            len(local), local[mismatches[0]] if mismatches[0] < len(local) else None,
+            served[mismatches[0]] if mismatches[0] < len(served) else None))
+    else:
+        print('{}: {} answers match'.format(op, len(local)))
+    return(not mismatches)
+
+def encoded(name):
+    # Names come back from the service as unicode
+    return(name.encode('utf-8') if name is not None else None)
+
+def check(db_dir, client, num_queries):
+    "Returns whether every answer of the service matches the local taxonomy"
+    taxonomy = taxonomy_db.load_dir(db_dir)
+    taxids = sample_taxids(taxonomy, num_queries)
+    matches = [compare('ping', [taxonomy.key], [client.key])]
+
+    jump_table, depth = lca_functions.Build_lifting_table(taxonomy.parents_dict())
+    taxsets = [random.sample(taxids, min(random.randint(1, 5), len(taxids))) for i in range(num_queries)]
+    local = [(lca, list(failed)) for lca, failed in
+        lca_functions.Lifting_reduce_taxsets([tuple(sorted(taxset)) for taxset in taxsets], jump_table, depth)]
+    matches.append(compare('lca', local, [(lca, list(failed)) for lca, failed in client.lca(taxsets)]))
+
+    # Out of range taxids are answered with empty lineages
+    queried = taxids + [0, taxonomy.max_taxid + 1]
+    local = [[[int(ancestor), taxonomy.name(ancestor) if ancestor else None] for ancestor in taxonomy.lineage[taxid]]
+        if 0 < taxid <= taxonomy.max_taxid else [[0, None] for rank in taxonomy_db.canonical_ranks] for taxid in queried]
+    served = [[[ancestor, encoded(name)] for ancestor, name in row] for row in client.lineage(queried)]
+    matches.append(compare('lineage', local, served))
+
+    rank_counts_list = [sample_rank_counts(taxonomy, taxids, random.randint(1, 20)) for i in range(num_queries)]
+    local = [int(taxonomy_db.vote_taxid(rank_counts, taxonomy.lineage)) for rank_counts in rank_counts_list]
+    matches.append(compare('vote', local, client.vote(rank_counts_list)))
+    return(all(matches))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that taxonomy_service.py answers as the taxonomy loaded locally does')
+    parser.add_argument('db_dir', help='Directory containing nodes.dmp, names.dmp and merged.dmp')
+    parser.add_argument('-n', '--num_queries', metavar='<int>', help='Number of queries of each kind', type=int, default=1000)
+    parser.add_argument('-s', '--seed', metavar='<int>', help='Random seed', type=int, default=0)
+    args = vars(parser.parse_args())
+    random.seed(args['seed'])
+    db_dir = os.path.abspath(args['db_dir'])
+    tmp_dir = tempfile.mkdtemp(prefix='taxonomy_service_check.')
+    proc = None
+    try:
+        proc, client = start_service(db_dir, os.path.join(tmp_dir, 'service.sock'))
+        passed = check(db_dir, client, args['num_queries'])
+        client.close()
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+        shutil.rmtree(tmp_dir)
+    if not passed:
+        exit(1)
+    print('Taxonomy service answers match')
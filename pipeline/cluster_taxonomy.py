@@ -29,128 +29,17 @@
 import sys
 from time import *
 from tqdm import *
-import subprocess
 import argparse
+import collections
 import pprint
+import numpy as np
+import pandas as pd
+import taxonomy_db
+import taxonomy_service
 pp = pprint.PrettyPrinter(indent=4)
 
-rank_priority = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom', 'root']
-canonical_ranks = {
-	'superkingdom': 1,
-	'phylum': 1,
-	'class': 1,
-	'order': 1,
-	'family': 1,
-	'genus': 1,
-	'species': 1
-}
-
-def isConsistentWithOtherOrfs(taxid, rank, contigDictionary, taxidDictionary):
-	# Function that determines for a given taxid, whether the majority of proteins
-	# in a contig, with rank equal to or above the given rank, are common ancestors of
-	# the taxid.  If the majority are, this function returns True, otherwise it returns
-	# False
-
-	# First we make a modified rank_priority list that only includes the current rank and above
-	ranks_to_consider = None
-	for i, rankName in enumerate(rank_priority):
-		if rankName == rank:
-			ranks_to_consider = rank_priority[i:]
-			break
-
-	# Now we total up the consistent and inconsistent ORFs
-
-	consistentTotal = 0
-	inconsistentTotal = 0
-
-	for rankName in ranks_to_consider:
-		if rankName in contigDictionary:
-			for current_taxid in contigDictionary[rankName]:
-				if isCommonAncestor(current_taxid, taxid, taxidDictionary):
-					consistentTotal += contigDictionary[rankName][current_taxid]
-				else:
-					inconsistentTotal += contigDictionary[rankName][current_taxid]
-
-	if consistentTotal > inconsistentTotal:
-		return True
-	else:
-		return False
-
-def isCommonAncestor(potentialParentTaxid, childTaxid, taxidDictionary):
-	current_taxid = childTaxid
-	while int(current_taxid) != 1:
-		if potentialParentTaxid == current_taxid:
-			return True
-		current_taxid = taxidDictionary[current_taxid]['parent']
-	return False
-
-def lowest_majority(contigDictionary, taxidDictionary):
-	taxid_totals = {} # Dictionary of dictionary, keyed by rank then by taxid, holds totals accounting for whole taxid paths
-
-	for rank in rank_priority:
-		if rank in contigDictionary:
-			ranks_to_consider = None
-			for i, rankName in enumerate(rank_priority):
-				if rankName == rank:
-					ranks_to_consider = rank_priority[i:]
-					break
-
-			for taxid in contigDictionary[rank]:
-				# Make a dictionary to total the number of canonical ranks hit while traversing the path
-				# - so that we can add 'unclassified' to any that don't exist
-				# Later we need to make sure that 'unclassified' doesn't ever win
-				ranks_in_path = {}
-				for rank_to_consider in ranks_to_consider:
-					ranks_in_path[rank_to_consider] = 0
-
-				# We need to add to taxid_totals for each taxid in the tax_path
-				current_taxid = taxid
-				current_rank = rank
-				while int(current_taxid) != 1:
-					if current_rank in canonical_ranks:
-						ranks_in_path[current_rank] += 1
-						if current_rank in taxid_totals:
-							if current_taxid in taxid_totals[current_rank]:
-								taxid_totals[current_rank][current_taxid] += 1
-							else:
-								taxid_totals[current_rank][current_taxid] = 1
-						else:
-							taxid_totals[current_rank] = { current_taxid: 1 }
-					current_taxid = taxidDictionary[current_taxid]['parent']
-					current_rank = taxidDictionary[current_taxid]['rank']
-
-				# Now go through ranks_in_path. Where total = 0, add 'unclassified'
-				for rank_to_consider in ranks_to_consider:
-					if ranks_in_path[rank_to_consider] == 0:
-						if rank_to_consider in taxid_totals:
-							if 'unclassified' in taxid_totals[rank_to_consider]:
-								taxid_totals[rank_to_consider]['unclassified'] += 1
-							else:
-								taxid_totals[rank_to_consider]['unclassified'] = 1
-						else:
-							taxid_totals[rank_to_consider] = { 'unclassified': 1 }
-
-	# If there are any gaps in the taxonomy paths for any of the proteins in the contig,
-	# we need to add 'unclassified' to the relevant canonical taxonomic rank.
-	# However, we must never allow 'unclassified' to win! (That just won't really tell us anything)
-
-	# Now we need to determine which is the first level to have a majority
-	for rank in rank_priority:
-		total_votes = 0
-		taxid_leader = None
-		taxid_leader_votes = 0
-		if rank in taxid_totals:
-			for taxid in taxid_totals[rank]:
-				total_votes += taxid_totals[rank][taxid]
-				if taxid_totals[rank][taxid] > taxid_leader_votes:
-					taxid_leader = taxid
-					taxid_leader_votes = taxid_totals[rank][taxid]
-			majority_threshold = float(total_votes)/2
-			if taxid_leader_votes > majority_threshold and taxid_leader != 'unclassified':
-				return taxid_leader
-
-	# Just in case
-	return 1
+# Columns of the taxonomy database lineage table, from the top of the tree down
+canonical_ranks = taxonomy_db.canonical_ranks
 
 parser = argparse.ArgumentParser(description="Summarize the taxonomy of clusters in a table")
 parser.add_argument('-t','--contig_tab', help='Master contig table', required=True)
@@ -171,65 +60,19 @@ single_genome_mode = args['single_genome']
 # Process NCBI taxdump files
 names_dmp_path = taxdump_dir_path + '/names.dmp'
 nodes_dmp_path = taxdump_dir_path + '/nodes.dmp'
+merged_dmp_path = taxdump_dir_path + '/merged.dmp'
 
-taxids = {}
-print strftime("%Y-%m-%d %H:%M:%S") + ' Processing taxid names'
-wc_output = subprocess.check_output(['wc', '-l', names_dmp_path])
-wc_list = wc_output.split()
-number_of_lines = int(wc_list[0])
-
-with open(names_dmp_path) as names_dmp:
-	for line in tqdm(names_dmp, total=number_of_lines):
-		line_list = line.rstrip('\n').split('|')
-		# Remove trailing and leading spaces
-		for i,value in enumerate(line_list):
-			line_list[i] = value.strip()
-
-		# Only add scientific name entries
-		if line_list[3] == 'scientific name':
-			# line_list[1] = line_list[1].replace(' ', '_')
-			taxids[int(float(line_list[0]))] = { 'name': line_list[1] }
-
-print strftime("%Y-%m-%d %H:%M:%S") + ' Processing taxid nodes'
-wc_output = subprocess.check_output(['wc', '-l', nodes_dmp_path])
-wc_list = wc_output.split()
-number_of_lines = int(wc_list[0])
-
-with open(nodes_dmp_path) as nodes_dmp:
-	for line in tqdm(nodes_dmp, total=number_of_lines):
-		line_list = line.rstrip('\n').split('|')
-		# Remove trailing and leading spaces
-		for i,value in enumerate(line_list):
-			line_list[i] = value.strip()
-
-		taxids[ int(float(line_list[0])) ][ 'parent' ] = int(float(line_list[1]))
-		taxids[ int(float(line_list[0])) ][ 'rank' ] = line_list[2]
-
-#name_lookup = {} # Dictionary of dictionaries, keyed by rank then name
-#for taxid in taxids:
-#	rank = taxids[taxid]['rank']
-#	name = taxids[taxid]['name']
-#	if rank in name_lookup:
-#		name_lookup[rank][name] = taxid
-#	else:
-#		name_lookup[rank] = { name: taxid }
+print strftime("%Y-%m-%d %H:%M:%S") + ' Loading taxonomy database'
+taxonomy = taxonomy_db.load(nodes_dmp_path, names_dmp_path, merged_dmp_path)
+# Clusters are voted on by the taxonomy service if one is running for the same databases
+service = taxonomy_service.connect(taxonomy_service.socket_path(taxdump_dir_path), taxonomy.key)
 
 print strftime("%Y-%m-%d %H:%M:%S") + ' Parsing taxonomy table'
-#protein_classifications = {} # protein_classifications[contig][rank][taxid] (running total of each thing)
-contig_classifications = {}
-#number_of_proteins = {}
-length_of_contigs = {}
-
-# Work out number of lines in file
-wc_output = subprocess.check_output(['wc', '-l', contig_table_path])
-wc_list = wc_output.split()
-number_of_lines = int(wc_list[0])
 
 # Determine contig, length and cluster indexes
 contig_table = open(contig_table_path, 'r')
-contig_table_lines = contig_table.read().splitlines()
-contig_table.close
-contig_table_first_line_list = contig_table_lines[0].split('\t')
+contig_table_first_line_list = contig_table.readline().rstrip('\n').split('\t')
+contig_table.close()
 column_count = {}
 contig_index = None
 cluster_index = None
@@ -274,98 +117,69 @@ if column_count['length'] > 1:
 if column_count['taxid'] > 1:
 	print 'Error, there is more than one "taxid" column in ' + contig_table_path
 
-for i,line in enumerate(tqdm(contig_table_lines, total=number_of_lines)):
-	if i > 0:
-		line_list = line.rstrip('\n').split('\t')
-		contig = line_list[contig_index]
-		if single_genome_mode:
-			cluster = 'unclustered'
-		else:
-			cluster = line_list[cluster_index]
-		length = line_list[length_index]
-		try:
-			taxid = int(float(line_list[taxid_index]))
-		except ValueError:
-			taxid = 'unclassified'
-
-		taxRank = None
-		if taxid == 'unclassified':
-			taxid = 1
-			taxRank = 'root'
-		elif taxid not in taxids:
-			# This happens sometimes when the taxid database and the NR database are not in sync
-			taxid = 1
-			taxRank = 'root'
-		else:
-			taxRank = taxids[taxid]['rank']
-
-		# Now get the taxid of the next canonical rank (if applicable)
-		if taxRank == 'no rank':
-			taxid = 1
-			taxRank = 'root'
-
-		if taxid != 1:
-			while taxRank not in rank_priority:
-				taxid = taxids[taxid]['parent']
-				taxRank = taxids[taxid]['rank']
-
-		# Keep running total of taxids for each cluster
-		if cluster not in contig_classifications:
-			contig_classifications[cluster] = {}
-		if taxRank not in contig_classifications[cluster]:
-			contig_classifications[cluster][taxRank] = {}
-
-		if taxid not in contig_classifications[cluster][taxRank]:
-			contig_classifications[cluster][taxRank][taxid] = int(float(length)) # We need this because directly inting a string in the form '16079.0' doesn't work
-		else:
-			contig_classifications[cluster][taxRank][taxid] += int(float(length))
-
-		# Count length of contigs per cluster
-		if contig in length_of_contigs:
-			length_of_contigs[contig] += int(float(length))
-		else:
-			length_of_contigs[contig] = int(float(length))
+# Only the needed columns are read, as typed arrays
+usecols = [contig_index, length_index, taxid_index]
+if not single_genome_mode:
+	usecols.append(cluster_index)
+contig_table = pd.read_csv(contig_table_path, sep='\t', usecols=usecols, dtype=str, na_filter=False)
+contig_table.columns = [contig_table_first_line_list[i] for i in sorted(usecols)]
+if single_genome_mode:
+	clusters = np.full(len(contig_table), 'unclustered', dtype=object)
+else:
+	clusters = contig_table[cluster_column_name].values
+lengths = pd.to_numeric(contig_table['length']).values.astype(np.int64)
+# Unclassified contigs and taxids missing from the database (this happens
+# sometimes when the taxid database and the NR database are not in sync) go to root
+taxids = pd.to_numeric(contig_table['taxid'], errors='coerce').fillna(1).values.astype(np.int64)
+taxids[(taxids < 1) | (taxids >= len(taxonomy.parent))] = 1
+taxids[taxonomy.parent[taxids] == 0] = 1
+
+# Now get the taxid of the next canonical rank (if applicable), the lowest
+# filled slot of each lineage. Taxids without one (including 'no rank'
+# taxids) go to root
+root_code = len(canonical_ranks)
+lineages = taxonomy.lineage[taxids]
+filled = lineages != 0
+rank_codes = np.where(filled.any(axis=1), root_code - 1 - np.argmax(filled[:,::-1], axis=1), root_code)
+rank_codes[np.array([rank == 'no rank' for rank in taxonomy.rank_names] + [False])[taxonomy.rank_code[taxids]]] = root_code
+has_rank = rank_codes != root_code
+voted_taxids = np.ones(len(taxids), dtype=np.int64)
+voted_taxids[has_rank] = lineages[has_rank, rank_codes[has_rank]]
+
+# Keep running total of contig lengths for each cluster, rank and taxid.
+# Totals are kept in order of first appearance, which breaks ties in vote_taxid
+votes = pd.DataFrame({'cluster':clusters, 'rank':rank_codes, 'taxid':voted_taxids,
+	'length':lengths, 'line':np.arange(len(taxids))})
+totals = votes.groupby(['cluster','rank','taxid']).agg({'length':'sum', 'line':'min'})
+totals.sort_values('line', inplace=True)
+rank_names = canonical_ranks + ['root']
+contig_classifications = {}
+for (cluster, rank_code, taxid), length in totals['length'].iteritems():
+	taxRank = rank_names[rank_code]
+	if cluster not in contig_classifications:
+		contig_classifications[cluster] = {}
+	if taxRank not in contig_classifications[cluster]:
+		contig_classifications[cluster][taxRank] = collections.OrderedDict()
+	contig_classifications[cluster][taxRank][int(taxid)] = int(length)
 
 print strftime("%Y-%m-%d %H:%M:%S") + ' Ranking taxids'
 top_taxids = {}
 total_clusters = len(contig_classifications)
 
-for cluster in tqdm(contig_classifications, total=total_clusters):
-	acceptedTaxid = None
-	for rank in rank_priority:
-		if acceptedTaxid is not None:
-			break
-		# Order in descending order of votes
-		if rank in contig_classifications[cluster]:
-			ordered_taxids = sorted(contig_classifications[cluster][rank], key=contig_classifications[cluster][rank].__getitem__, reverse=True)
-			#sys.exit()
-			for taxid in ordered_taxids:
-				if isConsistentWithOtherOrfs(taxid, rank, contig_classifications[cluster], taxids):
-					acceptedTaxid = taxid
-					break
-
-	# If acceptedTaxid is still None at this point, there was some kind of draw, so we need to find the lowest taxonomic level where there is a
-	# majority
-	if acceptedTaxid is None:
-		acceptedTaxid = lowest_majority(contig_classifications[cluster], taxids)
-
-	top_taxids[cluster] = acceptedTaxid
+if service is not None:
+	clusters = list(contig_classifications)
+	top_taxids.update(zip(clusters, service.vote(contig_classifications[cluster] for cluster in clusters)))
+else:
+	for cluster in tqdm(contig_classifications, total=total_clusters):
+		# In descending order of rank and length, accept the first taxid consistent with the
+		# majority of other contigs, or else the lowest taxonomic level where there is a majority
+		top_taxids[cluster] = taxonomy_db.vote_taxid(contig_classifications[cluster], taxonomy.lineage)
 
 print strftime("%Y-%m-%d %H:%M:%S") + ' Resolving taxon paths'
 taxon_paths = {} # Dictionary of dictionaries, keyed by contig then rank, contains the taxon names
 for cluster in tqdm(top_taxids, total=len(top_taxids)):
-	taxon_paths[cluster] = {}
-	current_taxid = top_taxids[cluster]
-
-	while int(current_taxid) != 1:
-		current_rank = taxids[current_taxid]['rank']
-		if current_rank in canonical_ranks:
-			taxon_paths[cluster][current_rank] = taxids[current_taxid]['name']
-		current_taxid = taxids[current_taxid]['parent']
-
-	for rank in rank_priority:
-		if rank not in taxon_paths[cluster]:
-			taxon_paths[cluster][rank] = 'unclassified'
+	# Clusters voted to the same taxid share one lookup
+	taxon_paths[cluster] = dict(zip(canonical_ranks, taxonomy.lineage_names(top_taxids[cluster])))
 
 print strftime("%Y-%m-%d %H:%M:%S") + ' Writing table'
 output_table = open(output_file_path, 'w')
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Reading, joining and writing of the per-contig tables passed between
+# pipeline stages. Tables are tab separated unless their path ends in
+# .feather or .parquet, in which case they are written as typed columnar
+# files (requires pyarrow).
+
+import csv
+import numpy as np
+import pandas as pd
+
+COLUMNAR_FORMATS = {'.feather':'feather', '.parquet':'parquet'}
+
+def table_format(fpath):
+    "Returns 'feather', 'parquet' or 'tsv' based on the file extension"
+    for extension, fmt in COLUMNAR_FORMATS.iteritems():
+        if fpath.endswith(extension):
+            return(fmt)
+    return('tsv')
+
+def read_table(fpath, **kwargs):
+    "Reads a contig table written in any of the supported formats into a DataFrame"
+    fmt = table_format(fpath)
+    if fmt == 'feather':
+        return(pd.read_feather(fpath))
+    if fmt == 'parquet':
+        return(pd.read_parquet(fpath))
+    return(pd.read_csv(fpath, sep='\t', **kwargs))
+
+def read_tsv_rows(fpath, chunksize=None):
+    """
+    Returns the header fields of a TSV table and its rows as strings, exactly
+    as written (in chunks of chunksize rows if given)
+    """
+    with open(fpath) as fh:
+        header = fh.readline().rstrip().split('\t')
+    try:
+        rows = pd.read_csv(fpath, sep='\t', header=None, skiprows=1, dtype=str,
+            quoting=csv.QUOTE_NONE, na_filter=False, chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        rows = [] if chunksize else pd.DataFrame(columns=range(len(header)), dtype=str)
+    return(header, rows)
+
+class TableWriter(object):
+    """
+    Writes a table chunk by chunk. TSV rows, and parquet row groups (one per
+    chunk), are written to disk as they arrive. Feather files cannot be
+    appended to, so feather chunks are kept as typed Arrow batches until the
+    writer is closed. In columnar formats a column is numeric if all its
+    non-blank fields in the first chunk are numbers, and later chunks must
+    agree
+    """
+
+    def __init__(self, fpath, header):
+        self.fpath = fpath
+        self.header = list(header)
+        self.format = table_format(fpath)
+        if self.format == 'tsv':
+            self.fh = open(fpath, 'w')
+            self.fh.write('\t'.join(self.header) + '\n')
+        else:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('Writing {} tables requires pyarrow (pip install pyarrow)'.format(self.format))
+            self.pa = pyarrow
+            self.schema = None
+            self.parquet_writer = None
+            self.batches = []
+
+    def column_type(self, fields):
+        "Returns int64 or float64 for a column of strings holding only numbers (or blanks), otherwise string"
+        filled = fields[fields != '']
+        numbers = pd.to_numeric(filled, errors='coerce')
+        if not len(filled) or numbers.isnull().any():
+            return(self.pa.string())
+        if numbers.dtype.kind in 'iu':
+            return(self.pa.int64())
+        return(self.pa.float64())
+
+    def record_batch(self, rows):
+        arrays = []
+        for name, column, field in zip(self.header, rows, self.schema):
+            fields = rows[column]
+            if field.type != self.pa.string():
+                values = pd.to_numeric(fields.replace('', np.nan), errors='coerce')
+                mismatched = (fields != '') & values.isnull()
+                if field.type == self.pa.int64():
+                    mismatched |= values.notnull() & (values != values.round())
+                if mismatched.any():
+                    raise ValueError('Column {} of {} holds {!r}, but its first rows were all {}'.format(
+                        name, self.fpath, fields[mismatched].iloc[0], field.type))
+                fields = values
+            arrays.append(self.pa.array(fields, type=field.type, from_pandas=True))
+        return(self.pa.RecordBatch.from_arrays(arrays, self.header))
+
+    def write(self, rows):
+        "Writes a DataFrame of string fields, one column per header field"
+        if self.format == 'tsv':
+            if len(rows):
+                self.fh.write('\n'.join('\t'.join(row) for row in rows.values.tolist()) + '\n')
+            return
+        if not len(rows):
+            return
+        if self.schema is None:
+            self.schema = self.pa.schema([(name, self.column_type(rows[column])) for name, column in zip(self.header, rows)])
+        batch = self.record_batch(rows)
+        if self.format == 'parquet':
+            if self.parquet_writer is None:
+                self.parquet_writer = self.pa.parquet.ParquetWriter(self.fpath, self.schema)
+            self.parquet_writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self.batches.append(batch)
+
+    def close(self):
+        if self.format == 'tsv':
+            self.fh.close()
+            return
+        if self.schema is None:
+            # No rows, so every column is left as strings
+            self.schema = self.pa.schema([(name, self.pa.string()) for name in self.header])
+        if self.format == 'parquet':
+            if self.parquet_writer is None:
+                self.parquet_writer = self.pa.parquet.ParquetWriter(self.fpath, self.schema)
+            self.parquet_writer.close()
+        else:
+            self.pa.Table.from_batches(self.batches, self.schema).to_pandas().to_feather(self.fpath)
+            self.batches = []
+
+def join_tables(table_fpath, other_header, other_rows, out_fpaths, fill_value=None, chunksize=100000):
+    """
+    Streams the rows of the TSV table at table_fpath and appends the fields of
+    other_rows (a DataFrame of strings indexed by contig) matching its first
+    column, writing the joined table to each of out_fpaths. Rows of the table
+    with no match are filled with fill_value, or dropped if it is None. The
+    order of the table's rows is kept.
+    """
+    header, chunks = read_tsv_rows(table_fpath, chunksize)
+    # Later rows replace earlier ones for the same contig
+    other_rows = other_rows[~other_rows.index.duplicated(keep='last')]
+    writers = [TableWriter(fpath, header + list(other_header)) for fpath in out_fpaths]
+    for chunk in chunks:
+        contigs = chunk[0].values
+        if fill_value is None:
+            keep = np.asarray(pd.Index(contigs).isin(other_rows.index))
+            chunk = chunk[keep]
+            contigs = contigs[keep]
+        joined = other_rows.reindex(contigs)
+        if fill_value is not None:
+            joined = joined.fillna(fill_value)
+        joined.index = chunk.index
+        joined.columns = range(chunk.shape[1], chunk.shape[1] + joined.shape[1])
+        chunk = pd.concat([chunk, joined], axis=1)
+        for writer in writers:
+            writer.write(chunk)
+    for writer in writers:
+        writer.close()
+
+def combine_tables(table1_fpath, table2_fpath, out_fpaths, chunksize=100000):
+    """
+    Writes the rows of table 1 that have a matching first column in table 2,
+    with the rest of table 2's fields appended
+    """
+    table2_header, table2_rows = read_tsv_rows(table2_fpath)
+    table2_rows = table2_rows.set_index(0)
+    join_tables(table1_fpath, table2_header[1:], table2_rows, out_fpaths, chunksize=chunksize)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Downloads and prepares the NCBI databases used by make_taxonomy_table.py.
+# Each download is read once: its md5 is computed as it streams in and it is
+# decompressed on the fly into its final form, so no compressed copy is kept
+# on disk:
+#   prot.accession2taxid.gz  is gunzipped to prot.accession2taxid
+#   taxdump.tar.gz           has names.dmp, nodes.dmp and merged.dmp extracted,
+#                            which are then compiled into taxonomy_db arrays
+#   nr.gz                    is gunzipped into diamond makedb's standard input
+# Outputs are written under temporary names and only put in place once the
+# md5 matches NCBI's, after which the .md5 file is saved to mark them current.
+# accession2taxid and taxdump are prepared concurrently, then nr, which
+# uses them for diamond's taxonomy mapping.
+#
+# Files are read from NCBI by default, or from a mirror given as a base URL
+# (ftp://, http://, file://) or a local directory holding the same files.
+
+import os
+import zlib
+import shutil
+import hashlib
+import tarfile
+import urllib2
+import argparse
+import platform
+import subprocess
+import taxonomy_db
+
+from multiprocessing.pool import ThreadPool
+from time import strftime
+
+NCBI_URLS = {
+    'acc2taxid':'ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/prot.accession2taxid.gz',
+    'taxdump':'ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz',
+    'nr':'ftp://ftp.ncbi.nlm.nih.gov/blast/db/FASTA/nr.gz',
+}
+DATABASES = ['acc2taxid', 'taxdump', 'nr']
+TAXDUMP_FILES = ['names.dmp', 'nodes.dmp', 'merged.dmp']
+BLOCKSIZE = 16777216
+MAX_ATTEMPTS = 3
+
+class ChecksumError(IOError):
+    pass
+
+# Raised while unpacking a corrupt or truncated download
+DECOMPRESSION_ERRORS = (zlib.error, tarfile.TarError, EOFError)
+
+def database_url(db, base_url=None):
+    "Returns the URL of the database download, from NCBI or the mirror at base_url"
+    if base_url is None:
+        return(NCBI_URLS[db])
+    return(base_url.rstrip('/') + '/' + os.path.basename(NCBI_URLS[db]))
+
+def open_url(url):
+    "Opens a local path or an ftp://, http(s):// or file:// URL for reading"
+    if '://' not in url:
+        return(open(url, 'rb'))
+    return(urllib2.urlopen(url))
+
+def read_url(url):
+    handle = open_url(url)
+    try:
+        return(handle.read())
+    finally:
+        handle.close()
+
+def tmp_suffix():
+    return('.{}.{}.tmp'.format(platform.node(), os.getpid()))
+
+class HashingReader(object):
+    "Reads a URL, computing the md5 of everything read"
+
+    def __init__(self, url):
+        self.url = url
+        self.handle = open_url(url)
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=BLOCKSIZE):
+        block = self.handle.read(size)
+        self.md5.update(block)
+        self.size += len(block)
+        return(block)
+
+    def blocks(self):
+        block = self.read()
+        while block:
+            yield(block)
+            block = self.read()
+
+    def check(self, md5_text):
+        "Reads anything left and raises ChecksumError if the md5 differs from md5_text's"
+        for block in self.blocks():
+            pass
+        expected = md5_text.split()[0] if md5_text.split() else ''
+        if self.md5.hexdigest() != expected:
+            raise ChecksumError('md5 of {} is {}, expected {}'.format(self.url, self.md5.hexdigest(), expected))
+        print(strftime("%Y-%m-%d %H:%M:%S") + ' md5 checksum of {} successful ({:.1f} MB)'.format(self.url, self.size / 1048576.0))
+
+    def close(self):
+        self.handle.close()
+
+def corrupt_download(reader, md5_text, err):
+    "Returns the ChecksumError for a download that could not be unpacked, reading the rest of it"
+    try:
+        reader.check(md5_text)
+    except ChecksumError as checksum_err:
+        return(checksum_err)
+    return(ChecksumError('{} could not be unpacked although its md5 matches: {}'.format(reader.url, err)))
+
+def gunzip_blocks(blocks):
+    "Decompresses a stream of gzip data, which may hold several gzip members"
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in blocks:
+        while block:
+            data = decompressor.decompress(block)
+            if data:
+                yield(data)
+            block = decompressor.unused_data
+            if block:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield(data)
+
+def remove_files(fpaths):
+    for fpath in fpaths:
+        if os.path.isfile(fpath):
+            os.remove(fpath)
+
+def prepare_acc2taxid(outdir, url, md5_text):
+    out_fpath = os.path.join(outdir, 'prot.accession2taxid')
+    tmp_fpath = out_fpath + tmp_suffix()
+    reader = HashingReader(url)
+    try:
+        with open(tmp_fpath, 'wb') as outfile:
+            try:
+                for data in gunzip_blocks(reader.blocks()):
+                    outfile.write(data)
+            except DECOMPRESSION_ERRORS as err:
+                raise corrupt_download(reader, md5_text, err)
+        reader.check(md5_text)
+    except:
+        remove_files([tmp_fpath])
+        raise
+    finally:
+        reader.close()
+    os.rename(tmp_fpath, out_fpath)
+
+def prepare_taxdump(outdir, url, md5_text):
+    tmp_fpaths = dict((fname, os.path.join(outdir, fname + tmp_suffix())) for fname in TAXDUMP_FILES)
+    reader = HashingReader(url)
+    try:
+        extracted = set()
+        try:
+            tar = tarfile.open(fileobj=reader, mode='r|gz')
+            for member in tar:
+                if member.name in tmp_fpaths:
+                    with open(tmp_fpaths[member.name], 'wb') as outfile:
+                        shutil.copyfileobj(tar.extractfile(member), outfile, BLOCKSIZE)
+                    extracted.add(member.name)
+            tar.close()
+        except DECOMPRESSION_ERRORS as err:
+            raise corrupt_download(reader, md5_text, err)
+        reader.check(md5_text)
+        if extracted != set(TAXDUMP_FILES):
+            raise IOError('{} does not contain {}'.format(url, ', '.join(sorted(set(TAXDUMP_FILES) - extracted))))
+    except:
+        remove_files(tmp_fpaths.values())
+        raise
+    finally:
+        reader.close()
+    for fname, tmp_fpath in tmp_fpaths.items():
+        os.rename(tmp_fpath, os.path.join(outdir, fname))
+    # Compiled now rather than by the first run that needs them
+    taxonomy_db.load_dir(outdir)
+
+def prepare_nr(outdir, url, md5_text, num_processors):
+    tmp_prefix = os.path.join(outdir, 'nr' + tmp_suffix())
+    command = ['diamond', 'makedb', '--db', tmp_prefix, '-p', str(num_processors)]
+    # Taxonomy mapping lets diamond report staxids (see make_taxonomy_table.py --staxids)
+    acc2taxid_fpath = os.path.join(outdir, 'prot.accession2taxid')
+    nodes_fpath = os.path.join(outdir, 'nodes.dmp')
+    if os.path.isfile(acc2taxid_fpath) and os.path.isfile(nodes_fpath):
+        command += ['--taxonmap', acc2taxid_fpath, '--taxonnodes', nodes_fpath]
+    print('building nr.dmnd database, this may take some time: ' + ' '.join(command))
+    reader = HashingReader(url)
+    # Without --in, diamond makedb reads the sequences from its standard input
+    makedb = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        try:
+            for data in gunzip_blocks(reader.blocks()):
+                makedb.stdin.write(data)
+        except DECOMPRESSION_ERRORS as err:
+            raise corrupt_download(reader, md5_text, err)
+        except IOError:
+            # diamond exited early; its exit code is reported below
+            if makedb.poll() is None:
+                raise
+        finally:
+            makedb.stdin.close()
+        exit_code = makedb.wait()
+        if exit_code != 0:
+            raise RuntimeError('diamond makedb failed with exit code {}'.format(exit_code))
+        reader.check(md5_text)
+    except:
+        if makedb.poll() is None:
+            makedb.kill()
+            makedb.wait()
+        remove_files([tmp_prefix + '.dmnd'])
+        raise
+    finally:
+        reader.close()
+    os.rename(tmp_prefix + '.dmnd', os.path.join(outdir, 'nr.dmnd'))
+
+PREPARE = {'acc2taxid':prepare_acc2taxid, 'taxdump':prepare_taxdump, 'nr':prepare_nr}
+OUTPUTS = {'acc2taxid':['prot.accession2taxid'], 'taxdump':TAXDUMP_FILES, 'nr':['nr.dmnd']}
+
+def update_database(db, outdir, num_processors=1, base_url=None):
+    """
+    Downloads and prepares one database unless its local .md5 file matches
+    the current one, retrying downloads that fail their checksum
+    """
+    url = database_url(db, base_url)
+    md5_text = read_url(url + '.md5')
+    md5_fpath = os.path.join(outdir, os.path.basename(url) + '.md5')
+    if os.path.isfile(md5_fpath) and all(os.path.isfile(os.path.join(outdir, fname)) for fname in OUTPUTS[db]):
+        with open(md5_fpath) as fh:
+            if fh.read().split()[:1] == md5_text.split()[:1]:
+                print('{} up to date'.format(', '.join(OUTPUTS[db])))
+                return
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        print(strftime("%Y-%m-%d %H:%M:%S") + ' Updating {} from {}'.format(', '.join(OUTPUTS[db]), url))
+        try:
+            # Only diamond makedb uses several processors
+            PREPARE[db](*[outdir, url, md5_text] + ([num_processors] if db == 'nr' else []))
+            break
+        except ChecksumError as err:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            print('{}. Retrying...'.format(err))
+    # Saved last, so an interrupted update is redone
+    with open(md5_fpath + tmp_suffix(), 'w') as fh:
+        fh.write(md5_text)
+    os.rename(md5_fpath + tmp_suffix(), md5_fpath)
+    print('{} updated'.format(', '.join(OUTPUTS[db])))
+
+def update(outdir, dbs=DATABASES, num_processors=1, base_url=None):
+    "Updates the databases, preparing accession2taxid and taxdump concurrently before nr"
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    first = [db for db in ['acc2taxid', 'taxdump'] if db in dbs]
+    if len(first) > 1:
+        pool = ThreadPool(len(first))
+        pool.map(lambda db: update_database(db, outdir, num_processors, base_url), first)
+        pool.close()
+    elif first:
+        update_database(first[0], outdir, num_processors, base_url)
+    if 'nr' in dbs:
+        update_database('nr', outdir, num_processors, base_url)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Downloads and prepares prot.accession2taxid, the taxdump files and nr.dmnd, checking each against its md5 as it streams')
+    parser.add_argument('-o', '--outdir', metavar='<dir>', help='Database directory', required=True)
+    parser.add_argument('-d', '--databases', metavar='<db>', nargs='+', choices=DATABASES, default=DATABASES,
+        help='Databases to update: {} (default: all)'.format(', '.join(DATABASES)))
+    parser.add_argument('-u', '--url', metavar='<url>', help='Base URL or directory of a mirror of the NCBI files (default: NCBI)')
+    parser.add_argument('-p', '--processors', metavar='<int>', help='Number of processors for diamond makedb', type=int, default=1)
+    args = vars(parser.parse_args())
+    try:
+        update(args['outdir'], args['databases'], args['processors'], args['url'])
+    except (RuntimeError, IOError) as err:
+        exit('Error updating databases: {}'.format(err))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Reader for the per-sequence (--tblout) and per-domain (--domtblout) tables
+# written by hmmscan and hmmsearch. Fields are separated by runs of spaces,
+# the last one (the target description) may itself contain spaces, and
+# comment lines start with '#' anywhere in the file. Lines are split only as
+# far as the last requested column, and rows are filtered by score as they
+# are read, so multi-GB tables are read in one pass without holding them.
+
+import argparse
+import numpy as np
+import pandas as pd
+
+TBLOUT_COLUMNS = ['target_name', 'target_accession', 'query_name', 'query_accession',
+    'evalue', 'score', 'bias', 'domain_evalue', 'domain_score', 'domain_bias',
+    'exp', 'reg', 'clu', 'ov', 'env', 'dom', 'rep', 'inc', 'description']
+DOMTBLOUT_COLUMNS = ['target_name', 'target_accession', 'target_length', 'query_name',
+    'query_accession', 'query_length', 'evalue', 'score', 'bias', 'domain_number',
+    'domain_count', 'domain_c_evalue', 'domain_i_evalue', 'domain_score', 'domain_bias',
+    'hmm_from', 'hmm_to', 'ali_from', 'ali_to', 'env_from', 'env_to', 'acc', 'description']
+FLOAT_COLUMNS = set(['evalue', 'score', 'bias', 'domain_evalue', 'domain_score', 'domain_bias',
+    'exp', 'domain_c_evalue', 'domain_i_evalue', 'acc'])
+INT_COLUMNS = set(['reg', 'clu', 'ov', 'env', 'dom', 'rep', 'inc', 'target_length', 'query_length',
+    'domain_number', 'domain_count', 'hmm_from', 'hmm_to', 'ali_from', 'ali_to', 'env_from', 'env_to'])
+
+def read_tblout(fpath, columns=('target_name', 'query_name', 'score'), min_score=None,
+        score_column='score', domtblout=False):
+    """
+    Reads the named columns of an hmmscan/hmmsearch --tblout (or --domtblout)
+    table into a DataFrame with numeric columns typed. With min_score, only
+    rows whose score_column is at least min_score are kept
+    """
+    names = DOMTBLOUT_COLUMNS if domtblout else TBLOUT_COLUMNS
+    for column in list(columns) + [score_column]:
+        if column not in names:
+            raise ValueError('{} is not a column of {} tables'.format(column, 'domtblout' if domtblout else 'tblout'))
+    indices = [names.index(column) for column in columns]
+    score_index = names.index(score_column)
+    # The description is everything after the last fixed column
+    maxsplit = len(names) - 1 if names.index('description') in indices else max(indices + [score_index]) + 1
+    values = [[] for column in columns]
+    with open(fpath) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split(None, maxsplit)
+            if not fields:
+                continue
+            if min_score is not None and float(fields[score_index]) < min_score:
+                continue
+            for value_list, index in zip(values, indices):
+                value_list.append(fields[index].rstrip('\n') if index < len(fields) else '')
+    frame = pd.DataFrame(dict((column, typed_column(column, value_list))
+        for column, value_list in zip(columns, values)), columns=list(columns))
+    return(frame)
+
+def typed_column(column, values):
+    if column in FLOAT_COLUMNS:
+        return(np.array(values, dtype=np.float64))
+    if column in INT_COLUMNS:
+        return(np.array(values, dtype=np.int64))
+    return(np.array(values, dtype=object))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extracts columns of an hmmscan/hmmsearch tblout or domtblout table as tab separated text')
+    parser.add_argument('table', help='Table written with --tblout (or --domtblout with -d)')
+    parser.add_argument('-c', '--columns', metavar='<column>', nargs='+', default=['target_name', 'query_name', 'score'],
+        help='Columns to extract (default: target_name query_name score)')
+    parser.add_argument('-d', '--domtblout', help='The table was written with --domtblout', action='store_true')
+    parser.add_argument('-s', '--min_score', metavar='<float>', help='Only keep rows scoring at least this', type=float)
+    args = vars(parser.parse_args())
+    table = read_tblout(args['table'], args['columns'], args['min_score'], domtblout=args['domtblout'])
+    print(table.to_csv(sep='\t', index=False).rstrip('\n'))
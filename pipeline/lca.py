@@ -31,11 +31,14 @@ import time
 import re
 import argparse
 import os
+import sys
 from functools import reduce
 from itertools import chain
 from sys import argv, exit
 import subprocess
 import gzip
+import taxonomy_db
+import taxonomy_service
 
 try:
     import lca_functions
@@ -92,23 +95,35 @@ help='Updates nodes.dmp, names.dmp and accession2taxid files within the specifie
 parser_databasedirectory.set_defaults(parser_databasefiles=False, parser_databasedirectory=True)
 
 parser.add_argument("blast", metavar='BLAST output',\
-help="Path to BLAST output file.")
+help="Path to BLAST output file. Use - to read diamond output from stdin as it is produced (requires -out).")
 parser.add_argument("-f", metavar='bitscore filter', required=False, default=0.9, type=restricted_float,\
 help="Filter to parse percentage of top BLAST hits based on bitscore.")
 parser.add_argument("-fail_info", required=False, action='store_true',\
 help="Writes out files with failure taxid/orf information")
+parser.add_argument("-backend", metavar='LCA index', required=False, default='rmq', choices=['rmq', 'lifting'],\
+help="LCA index to build: rmq (euler tour + sparse table) or lifting (binary lifting jump table, lower memory). Not built when a taxonomy service (taxonomy_service.py) is running for the same databases")
+parser.add_argument("-lca_cache", metavar='cache file', required=False,\
+help="Path to a file persisting LCAs of taxid sets across runs sharing the same nodes.dmp")
+parser.add_argument("-out", metavar='lca output', required=False,\
+help="Path to write the .lca table. Defaults to the BLAST output path with a .lca extension")
+parser.add_argument("-tee", metavar='BLAST copy', required=False,\
+help="When reading BLAST output from stdin, also write the raw hits to this path")
+parser.add_argument("-p", metavar='processors', required=False, default=1, type=int,\
+help="Number of processors to use when parsing accession2taxid. Must be given before (database_files|database_directory)")
 
 args = vars(parser.parse_args())
 
 if args['parser_databasefiles']:
     nodes_path = args['nodes.dmp']
     names_path = args['names.dmp']
+    merged_path = None
     accession2taxid_file = args['accession2taxid']
 elif args['parser_databasedirectory']:
     taxdump_dir_path = os.path.abspath(args['path_to_database_directory'])
     accession2taxid_path = os.path.join(taxdump_dir_path, 'prot.accession2taxid')
     names_path = os.path.join(taxdump_dir_path,'names.dmp')
     nodes_path = os.path.join(taxdump_dir_path,'nodes.dmp')
+    merged_path = os.path.join(taxdump_dir_path,'merged.dmp')
     for f in ['prot.accession2taxid','prot.accession2taxid.gz']:
         acc2taxid_fpath = os.path.join(taxdump_dir_path, f)
         if os.path.isfile(acc2taxid_fpath):
@@ -118,6 +133,12 @@ elif args['parser_databasedirectory']:
 blast_file = args['blast']
 bitscore_filter = args['f']
 failure_tracking = args['fail_info']
+num_processors = args['p']
+lca_cache_path = args['lca_cache']
+lca_backend = args['backend']
+tee_path = args['tee']
+if blast_file == '-' and not args['out']:
+    parser.error('-out is required when reading BLAST output from stdin')
 taxdump_url = "ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz"
 accession2taxid_url = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/prot.accession2taxid.gz"
 
@@ -144,88 +165,93 @@ if args['update']:
 
 start_time = time.strftime('%H:%M:%S', time.gmtime(time.time()))
 t0 = time.time()
-output_filename = str('.'.join(blast_file.split("/")[-1].split(".")[:-1]))
-output_dir = '/'.join(os.path.abspath(blast_file).split('/')[:-1])
+if args['out']:
+    lca_output_path = os.path.abspath(args['out'])
+    output_filename = os.path.splitext(os.path.basename(lca_output_path))[0]
+else:
+    output_filename = str('.'.join(blast_file.split("/")[-1].split(".")[:-1]))
+    output_dir = '/'.join(os.path.abspath(blast_file).split('/')[:-1])
+    lca_output_path = output_dir + '/' + output_filename + ".lca"
 print('{}: Beginning LCA'.format(start_time))
-# Parse nodes file
-parents = dict()
-children = dict()
-taxids = dict()
-with open(nodes_path) as nodes:
-    for i,line in enumerate(nodes):
-        if i > 0: # We skip the first line because it says that root is its own child!
-            no_whitespace_string = line.replace(' ', '')
-            no_whitespace_string = no_whitespace_string.replace('\t', '')
-            line_list = no_whitespace_string.split('|')
-            child = int(line_list[0])
-            parent = int(line_list[1])
-
-            # Add information to datastructures
-            taxids[child] = 1
-
-            parents[child] = parent
-
-            if parent in children:
-                children[parent].add(child)
-            else:
-                children[parent] = set([child])
-
-
-#data structures for tree traversal w/ distance from root and first occurrence attributes
-tour = list()
-first_node = (0, 1, 'b')
-tour.append(first_node)
-direction = 'forward'
-dist = 0
-level = list()
-level.append(dist)
-
-#Traversing tree by eulerian tour
-while taxids:
-    if direction == 'forward':
-        # Looking for a child of tour[-1][1], will take first arbitrary one
-        parent = tour[-1][1]
-        if parent in children: # i.e. if parent has children
-            child = children[parent].pop()
-            new_node = (parent, child, 'b')
-            tour.append(new_node)
-            dist += 1
-            level.append(dist)
-            # Delete the child taxid from the taxids dictionary
-            taxids.pop(child, None)
-
-            # If the set is now empty, we need to delete the parent key in children
-            if not children[parent]:
-                children.pop(parent, None)
+# Load the taxonomy database compiled from nodes.dmp and names.dmp
+taxonomy = taxonomy_db.load(nodes_path, names_path, merged_path)
+# A running taxonomy service already holds an LCA index and resolved accessions
+service = taxonomy_service.connect(taxonomy_service.socket_path(os.path.dirname(os.path.abspath(nodes_path))), taxonomy.key)
+if service is not None:
+    lca_backend = 'service'
+# Root is left out because it is its own parent
+parents = taxonomy.parents_dict()
+taxids = dict.fromkeys(parents, 1)
+
+
+num_taxa = len(taxids) + 1
+max_taxid = max(max(parents), max(parents.values()))
+
+if lca_backend == 'lifting':
+    jump_table, depth = lca_functions.Build_lifting_table(parents)
+elif lca_backend == 'rmq':
+    children = dict()
+    for child, parent in parents.iteritems():
+        if parent in children:
+            children[parent].add(child)
         else:
-            direction = 'reverse'
-            # Do nothing else
-    elif direction == 'reverse':
-        child = tour[-1][1]
-        if child in parents: # i.e. child has parents left
-            parent = parents[child]
-            new_node = (child, parent, 'l')
-            tour.append(new_node)
-            dist -= 1
-            level.append(dist)
-            # Delete the child from the parents dictionary
-            parents.pop(child, None)
-
-            # If parent still has children, reverse direction
-            if parent in children:
+            children[parent] = set([child])
+
+    #data structures for tree traversal w/ distance from root and first occurrence attributes
+    tour = list()
+    first_node = (0, 1, 'b')
+    tour.append(first_node)
+    direction = 'forward'
+    dist = 0
+    level = list()
+    level.append(dist)
+
+    #Traversing tree by eulerian tour
+    while taxids:
+        if direction == 'forward':
+            # Looking for a child of tour[-1][1], will take first arbitrary one
+            parent = tour[-1][1]
+            if parent in children: # i.e. if parent has children
+                child = children[parent].pop()
+                new_node = (parent, child, 'b')
+                tour.append(new_node)
+                dist += 1
+                level.append(dist)
+                # Delete the child taxid from the taxids dictionary
+                taxids.pop(child, None)
+
+                # If the set is now empty, we need to delete the parent key in children
+                if not children[parent]:
+                    children.pop(parent, None)
+            else:
+                direction = 'reverse'
+                # Do nothing else
+        elif direction == 'reverse':
+            child = tour[-1][1]
+            if child in parents: # i.e. child has parents left
+                parent = parents[child]
+                new_node = (child, parent, 'l')
+                tour.append(new_node)
+                dist -= 1
+                level.append(dist)
+                # Delete the child from the parents dictionary
+                parents.pop(child, None)
+
+                # If parent still has children, reverse direction
+                if parent in children:
+                    direction = 'forward'
+            else:
                 direction = 'forward'
+
+    occurrence = dict()
+    tour_length=len(tour)
+    #Building first occurrence dictionary
+    for index, node in enumerate(tour):
+        child = node[1]
+        if child not in occurrence:
+            occurrence[child]=int(index)
         else:
-            direction = 'forward'
-
-occurrence = dict()
-tour_length=len(tour)
-#Building first occurrence dictionary
-for index, node in enumerate(tour):
-    child = node[1]
-    if child not in occurrence:
-        occurrence[child]=int(index)
-    else:
-        pass
+            pass
 
 t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
 print('{}: Finished building tree'.format(t))
@@ -235,74 +261,169 @@ Next Module: Constructs Sparse Table (Preprocessing for RMQ and LCA)
 Uses level array constructed from eulerian tour
 """
 
-sparse_table = lca_functions.Preprocess(level)
-
-"""
-Constructs dictionary of {'ORF1': [accession number/accession number.version, ...], ...}
-taking accession numbers for (default 90% of) topbitscore and above
-Operating under the assumption bitscore is descending from highest to lowest for each gene
-"""
-t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
-print('{}: Finished constructing sparse table'.format(t))
-
-blast_orfs = lca_functions.Extract_blast(blast_file, bitscore_filter)
-
-"""
-Next Module: Reads in Genbank accession2taxid_file
-Converts accession numbers from blast output to tax ids in preparation for LCA algorithm
-"""
-t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
-print('{}: Finished extracting blastp orfs. parsing prot.acc2taxid DB'.format(t))
-
-accession2taxid_dict = lca_functions.Process_accession2taxid_file(accession2taxid_file, blast_orfs)
-
-t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
-print('{}: Finished acc2taxid translation dict'.format(t))
-
-blast_taxids = lca_functions.Convert_accession2taxid(accession2taxid_dict, blast_orfs)
-
-t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
-print('{}: Finished acc2taxid conversion'.format(t))
+if lca_backend == 'rmq':
+    sparse_table = lca_functions.Preprocess(level)
+    index_memory = lca_functions.Index_memory(num_taxa, max_taxid, sparse_table=sparse_table)
+elif lca_backend == 'lifting':
+    index_memory = lca_functions.Index_memory(num_taxa, max_taxid, jump_table=jump_table)
+if lca_backend != 'service':
+    for backend in ['rmq', 'lifting']:
+        status = 'built' if backend == lca_backend else 'estimated'
+        print('{} LCA index memory: {:.1f} MB ({})'.format(backend, index_memory[backend] / 1048576.0, status))
+
+if blast_file == '-':
+    # Reading diamond output from a pipe as it is produced
+    blast_input = lca_functions.Blast_stream(sys.stdin, tee_path)
+    staxids = blast_input.has_staxids()
+else:
+    blast_input = blast_file
+    staxids = lca_functions.Blast_has_staxids(blast_file)
 
 """
 Next Module: Performs LCA algorithm on taxids from converted BLAST accession numbers
 Uses reduce and finds LCA from list of taxids from blast output
 """
 
-failed_orfs = list()
-failed_taxids = list()
-lca_dict = dict()
-
-for orf, taxset in blast_taxids.iteritems():
-    lca = False
-    while lca == False:
+def reduce_taxset(taxset):
+    """Returns (lca, failed taxids) for a set of taxids. lca is None if the reduction failed"""
+    if lca_backend == 'service':
+        return(service.lca([taxset])[0])
+    taxset = set(taxset)
+    failed = list()
+    while True:
         #Need at least 2 nodes to perform reduction to lca
         if len(taxset) >= 2:
             try:
                 #Finds the minimum in a range by providing two keys "node1=taxid1 and node2=taxid2"
-                lca = reduce(lambda taxid1, taxid2: lca_functions.RangeMinQuery(node1=taxid1, node2=taxid2, tree=tour, sparse_table=sparse_table, level_array=level, first_occurrence_index=occurrence), taxset)
-                lca_dict[orf] = {'lca':int(lca)}
+                if lca_backend == 'lifting':
+                    lca = reduce(lambda taxid1, taxid2: lca_functions.LiftingQuery(taxid1, taxid2, jump_table, depth), taxset)
+                else:
+                    lca = reduce(lambda taxid1, taxid2: lca_functions.RangeMinQuery(node1=taxid1, node2=taxid2, tree=tour, sparse_table=sparse_table, level_array=level, first_occurrence_index=occurrence), taxset)
+                return(int(lca), failed)
             except KeyError as failed_taxid:
                 #Will raise KeyError if taxid not in tree
-                failed_taxid = str(failed_taxid)
-                failed_taxid = int(failed_taxid)
-                failure_info = (orf, failed_taxid)
-                failed_taxids.append(failure_info)
-                blast_taxids[orf].remove(failed_taxid)
+                failed_taxid = int(str(failed_taxid))
+                failed.append(failed_taxid)
+                taxset.remove(failed_taxid)
             except ValueError as failed_orf:
-                failure_info = (orf, taxset)
-                failed_orfs.append(failure_info)
-                lca = True
-        elif len(taxset) == 1:
-            lca = int(taxset.pop())
-            lca_dict[orf] = {'lca' : lca}
+                return(None, failed)
+        else:
+            return(int(taxset.pop()), failed)
+
+def assign_lca(orf, taxset, batch_lcas={}):
+    """Returns the LCA taxid of an ORF's set of taxids, or None if the reduction failed. Records failures"""
+    if not taxset:
+        failure_info = (orf, taxset)
+        failed_taxids.append(failure_info)
+        #default lca to root
+        return(1)
+    # ORFs resolving to the same set of taxids share one reduction
+    cached = lca_cache.get(taxset)
+    if cached is None:
+        cached = batch_lcas.get(tuple(sorted(taxset))) or reduce_taxset(taxset)
+        lca_cache.add(taxset, cached)
+    lca, failed = cached
+    for failed_taxid in failed:
+        failed_taxids.append((orf, failed_taxid))
+    if lca is None:
+        failed_orfs.append((orf, taxset.difference(failed)))
+    return(lca)
+
+def batch_reduce(taxsets):
+    """Returns {sorted taxid tuple: (lca, failed taxids)} for the distinct uncached taxid sets,
+    reduced together by the taxonomy service or with batch lifting queries. Empty for rmq"""
+    if lca_backend not in ['lifting', 'service']:
+        return(dict())
+    pending = set(tuple(sorted(taxset)) for taxset in taxsets if taxset)
+    pending = [taxset for taxset in pending if taxset not in lca_cache.lcas]
+    if lca_backend == 'service':
+        return(dict(zip(pending, service.lca(pending))))
+    return(dict(zip(pending, lca_functions.Lifting_reduce_taxsets(pending, jump_table, depth))))
+
+def lca_line(orf, lca):
+    """Returns the .lca table line for an ORF"""
+    name = taxonomy.name(lca)
+    if name is not None:
+        rank = taxonomy.rank(lca)
+        name = name.strip().replace(' ', '_') # This helps with parsing in R later
+    else:
+        rank = 'no rank'
+        name = 'root'
+    return('%s\t%s\t%s\t%s\n' % (orf, name, rank, lca))
+
+failed_orfs = list()
+failed_taxids = list()
+lca_cache = lca_functions.LCACache(lca_cache_path, index_key=taxonomy.key or lca_functions.Taxonomy_index_key(nodes_path))
+lca_outfile = open(lca_output_path, "w")
+
+if staxids and blast_file == '-':
+    """
+    Taxids are in-line, so each group of ORFs is reduced and written
+    as soon as diamond has reported all of its hits
+    """
+    t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+    print('{}: Finished constructing {} LCA index. Streaming blastp orfs with taxids'.format(t, lca_backend))
+    for chunk in lca_functions.Read_blast_chunks(blast_input, staxids, chunksize=10000):
+        orf_taxsets = lca_functions.Filter_blast_chunk(chunk, bitscore_filter, staxids)
+        batch_lcas = batch_reduce(taxset for orf, taxset in orf_taxsets)
+        for orf, taxset in orf_taxsets:
+            lca = assign_lca(orf, taxset, batch_lcas)
+            if lca is not None:
+                lca_outfile.write(lca_line(orf, lca))
+        lca_outfile.flush()
+else:
+    """
+    Constructs dictionary of {'ORF1': [accession number/accession number.version, ...], ...}
+    taking accession numbers for (default 90% of) topbitscore and above
+    If the BLAST output has a staxids column, constructs {'ORF1': set([taxid, ...]), ...} instead
+    Operating under the assumption hits are grouped by ORF
+    """
+    t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+    print('{}: Finished constructing {} LCA index'.format(t, lca_backend))
+
+    blast_orfs = lca_functions.Extract_blast(blast_input, bitscore_filter, staxids)
+
+    """
+    Next Module: Reads in Genbank accession2taxid_file
+    Converts accession numbers from blast output to tax ids in preparation for LCA algorithm
+    Skipped when the BLAST output already carries taxids (diamond staxids column)
+    """
+    if staxids:
+        blast_taxids = blast_orfs
+        t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+        print('{}: Finished extracting blastp orfs with taxids. Skipping prot.acc2taxid DB'.format(t))
+    else:
+        t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+        print('{}: Finished extracting blastp orfs. parsing prot.acc2taxid DB'.format(t))
+
+        if lca_backend == 'service' and os.path.dirname(os.path.abspath(accession2taxid_file)) == os.path.dirname(os.path.abspath(nodes_path)):
+            # The service resolves accessions from the databases directory it was started on
+            accession2taxid_dict = service.acc2taxid(set(chain.from_iterable(blast_orfs.itervalues())))
         else:
-            failed_taxid = taxset
-            failure_info = (orf, failed_taxid)
-            failed_taxids.append(failure_info)
-            lca_dict[orf] = {'lca' : 1}
-            #default lca to root
-            lca = True
+            accession2taxid_dict = lca_functions.Process_accession2taxid_file(accession2taxid_file, blast_orfs, num_processors)
+
+        t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+        print('{}: Finished acc2taxid translation dict'.format(t))
+
+        blast_taxids = lca_functions.Convert_accession2taxid(accession2taxid_dict, blast_orfs)
+
+        t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
+        print('{}: Finished acc2taxid conversion'.format(t))
+
+    batch_lcas = batch_reduce(blast_taxids.itervalues())
+
+    for orf, taxset in blast_taxids.iteritems():
+        lca = assign_lca(orf, taxset, batch_lcas)
+        if lca is not None:
+            lca_outfile.write(lca_line(orf, lca))
+
+lca_outfile.close()
+if blast_file == '-':
+    blast_input.close()
+
+print(lca_cache.summary())
+if lca_cache_path:
+    lca_cache.save()
 
 if failure_tracking:
     if failed_taxids:
@@ -323,42 +444,3 @@ if failure_tracking:
 
 t = time.strftime('%H:%M:%S', time.gmtime(round((time.time()-t0),2)))
 print('{}: Finished LCA query'.format(t))
-
-reference_taxids = dict() # {taxid:{'name':'scientific name','parent':'parent taxid', 'rank':'given rank'}, taxid2:{...},...}
-
-with open(names_path,"r") as names_dmp:
-    for line in names_dmp:
-        line_list = line.rstrip('\n').split('|')
-        for i,value in enumerate(line_list):
-            line_list[i] = value.strip()
-            if line_list[3] == 'scientific name':
-                nospace_name = line_list[1].replace(' ', '_') # This helps with parsing in R later
-                reference_taxids[int(line_list[0])] = {'name':nospace_name}
-
-with open(nodes_path, "r") as nodes_dmp:
-    for line in nodes_dmp:
-        line_list = line.rstrip('\n').split('|')
-        # Remove trailing and leading spaces
-        for i,value in enumerate(line_list):
-            line_list[i] = value.strip()
-        reference_taxids[int(line_list[0])]['rank'] = line_list[2]
-
-for orf in lca_dict.iterkeys():
-    lca_dict[orf]['rank'] = dict()
-    lca_dict[orf]['name'] = dict()
-    if lca_dict[orf]['lca'] in reference_taxids.viewkeys():
-        rank = reference_taxids[lca_dict[orf]['lca']]['rank']
-        name = reference_taxids[lca_dict[orf]['lca']]['name']
-        lca_dict[orf]['rank'] = rank
-        lca_dict[orf]['name'] = name
-    else:
-        lca_dict[orf]['rank'] = 'no rank'
-        lca_dict[orf]['name'] = 'root'
-
-with open(output_dir + '/' + output_filename + ".lca", "w") as lca_outfile:
-    for orf in lca_dict.keys():
-        rank = lca_dict[orf]['rank']
-        name = lca_dict[orf]['name']
-        lca = lca_dict[orf]['lca']
-        lca_outfile.write('%s\t%s\t%s\t%s\n' % (orf, name, rank, lca))
-        #lca_outfile.write('%s\t%s\t%s\n' % (orf, name, rank))
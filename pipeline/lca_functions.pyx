@@ -22,10 +22,16 @@
 
 
 import re
+import os
 import numpy as np
-from subprocess import check_output
+import pandas as pd
+from subprocess import check_output, Popen, PIPE
 from itertools import chain
+from collections import deque
+from multiprocessing import Pool
+from distutils.spawn import find_executable
 import gzip
+import cPickle
 
 class countcalls(object):
    "Decorator that keeps track of the number of times a function is called."
@@ -80,24 +86,102 @@ def Preprocess(level_array):
                     #places zeros in positions not utilized in sparse table
     return(sparse_table)
 
-def Extract_blast(blast_file, bitscore_filter=0.9):
-    "Returns a dictionary of accession numbers extracted from BLAST std format outfile\ndefault bitscore filter takes orfs from >90% of top bitscore"
-    with open(blast_file,"r") as blast_file:
-        blast_dict = dict()
-        temp_orf_list = list()
-        for line in blast_file:
-            line_list = line.rstrip().split('\t')
-            bitscore = float(line_list[-1])
-            accession_num = line_list[1]
-            orf = line_list[0]
-
-            if orf in temp_orf_list:
-                if bitscore >= bitscore_filter * topbitscore:
-                    blast_dict[orf].append(accession_num)
-            else:
-                blast_dict[orf] = [accession_num]
-                topbitscore = bitscore
-                temp_orf_list = [orf]
+class Blast_stream(object):
+    "File-like wrapper of BLAST output arriving on a pipe that can peek the first line and copy everything read to tee_fpath"
+
+    def __init__(self, handle, tee_fpath=None):
+        self.handle = handle
+        self.tee = open(tee_fpath, 'w') if tee_fpath else None
+        self.buffer = handle.readline()
+        if self.tee:
+            self.tee.write(self.buffer)
+
+    def has_staxids(self):
+        "Returns True if the first line has a 13th (staxids) column after bitscore"
+        return(len(self.buffer.rstrip('\n').split('\t')) == 13)
+
+    def read(self, size=-1):
+        if self.buffer:
+            data, self.buffer = self.buffer, ''
+            return(data)
+        data = self.handle.read(size)
+        if self.tee:
+            self.tee.write(data)
+        return(data)
+
+    def readline(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, ''
+            return(data)
+        data = self.handle.readline()
+        if self.tee:
+            self.tee.write(data)
+        return(data)
+
+    def __iter__(self):
+        return(iter(self.readline, ''))
+
+    def close(self):
+        if self.tee:
+            self.tee.close()
+
+def Blast_has_staxids(blast_file):
+    "Returns True if the BLAST tabular outfile has a 13th (staxids) column after bitscore"
+    with open(blast_file) as fh:
+        line = fh.readline()
+    return(len(line.rstrip('\n').split('\t')) == 13)
+
+def Read_blast_chunks(blast_file, staxids=False, chunksize=1000000):
+    "Yields frames of the BLAST tabular outfile (path or file handle), each holding all hits of the ORFs it contains"
+    columns = {0:'qseqid', 1:'sseqid', 11:'bitscore'}
+    if staxids:
+        columns[12] = 'staxids'
+    try:
+        reader = pd.read_csv(blast_file, sep='\t', header=None, usecols=sorted(columns),
+            dtype={0:str, 1:str, 11:np.float64, 12:str}, na_filter=False, chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        return
+    carry = None
+    for chunk in reader:
+        chunk.columns = [columns[col] for col in sorted(columns)]
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        # The last ORF may continue in the next chunk
+        last_orf = chunk['qseqid'].values == chunk['qseqid'].values[-1]
+        carry = chunk[last_orf]
+        if not last_orf.all():
+            yield(chunk[~last_orf])
+    if carry is not None and len(carry):
+        yield(carry)
+
+def Filter_blast_chunk(chunk, bitscore_filter, staxids=False):
+    "Returns list of (orf, hits) in query order, keeping hits within bitscore_filter of each ORF's top bitscore\nchunk must hold whole ORF groups"
+    orfs = chunk['qseqid'].values
+    bitscores = chunk['bitscore'].values
+    # Hits for each ORF are contiguous, so each run of the same qseqid is one ORF
+    starts = np.flatnonzero(np.r_[True, orfs[1:] != orfs[:-1]])
+    topbitscores = np.repeat(np.maximum.reduceat(bitscores, starts), np.diff(np.r_[starts, len(orfs)]))
+    keep = bitscores >= bitscore_filter * topbitscores
+    orfs = orfs[keep]
+    if staxids:
+        hits = chunk['staxids'].values[keep]
+    else:
+        hits = chunk['sseqid'].values[keep]
+    starts = np.flatnonzero(np.r_[True, orfs[1:] != orfs[:-1]])
+    blast_hits = list()
+    for orf, orf_hits in zip(orfs[starts], np.split(hits, starts[1:])):
+        if staxids:
+            # staxids may list several taxids separated by ';' or be empty
+            blast_hits.append((orf, set(int(taxid) for taxids in orf_hits for taxid in taxids.split(';') if taxid)))
+        else:
+            blast_hits.append((orf, list(orf_hits)))
+    return(blast_hits)
+
+def Extract_blast(blast_file, bitscore_filter=0.9, staxids=False, chunksize=1000000):
+    "Returns a dictionary of accession numbers extracted from BLAST std format outfile\ndefault bitscore filter takes orfs from >90% of top bitscore\nWith staxids, returns a dictionary of sets of tax ids read from the 13th column"
+    blast_dict = dict()
+    for chunk in Read_blast_chunks(blast_file, staxids, chunksize):
+        blast_dict.update(Filter_blast_chunk(chunk, bitscore_filter, staxids))
     return(blast_dict)
 
 def Convert_accession2taxid(acc2taxid_dict, blast_dict):
@@ -110,28 +194,313 @@ def Convert_accession2taxid(acc2taxid_dict, blast_dict):
                 blast_taxids[orf].add(int(acc2taxid_dict.get(accession_number)))
     return(blast_taxids)
 
-def Process_accession2taxid_file(acc2taxid_fpath, blast_dict):
+#Query accessions shared with forked workers by Process_accession2taxid_file
+query_accessions = set()
+
+def Filter_accession2taxid_lines(lines):
+    "Returns dictionary of accession numbers from query_accessions with their tax ids found in lines"
+    acc2taxid_dict = dict()
+    for line in lines:
+        acc_num, acc_ver, taxid, _ = line.split('\t')
+        if acc_num in query_accessions:
+            acc2taxid_dict[acc_num] = int(taxid)
+        elif acc_ver in query_accessions:
+            acc2taxid_dict[acc_ver] = int(taxid)
+    return(acc2taxid_dict)
+
+def Scan_accession2taxid_chunk(chunk):
+    "Returns dictionary of query accession hits within the (fpath, start, end) byte range of an uncompressed accession2taxid file"
+    acc2taxid_fpath, start, end = chunk
+    acc2taxid_dict = dict()
+    remainder = ''
+    with open(acc2taxid_fpath, 'rb') as fh:
+        fh.seek(start)
+        bytes_left = end - start
+        while bytes_left > 0:
+            block = fh.read(min(bytes_left, 16777216))
+            if not block:
+                break
+            bytes_left -= len(block)
+            lines = (remainder + block).split('\n')
+            remainder = lines.pop()
+            acc2taxid_dict.update(Filter_accession2taxid_lines(lines))
+    if remainder:
+        acc2taxid_dict.update(Filter_accession2taxid_lines([remainder]))
+    return(acc2taxid_dict)
+
+def Split_accession2taxid_file(acc2taxid_fpath, num_chunks):
+    "Returns list of (fpath, start, end) byte ranges aligned on newlines, skipping the header line"
+    size = os.path.getsize(acc2taxid_fpath)
+    with open(acc2taxid_fpath, 'rb') as fh:
+        fh.readline()
+        boundaries = [fh.tell()]
+        for i in range(1, num_chunks):
+            offset = size * i // num_chunks
+            if offset <= boundaries[-1]:
+                continue
+            # Move to the first line starting at or after offset
+            fh.seek(offset - 1)
+            fh.readline()
+            if boundaries[-1] < fh.tell() < size:
+                boundaries.append(fh.tell())
+    boundaries.append(size)
+    return([(acc2taxid_fpath, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])])
+
+class PigzReader(object):
+    "Lines decompressed by a pigz process. Raises IOError once they are exhausted if pigz failed"
+
+    def __init__(self, acc2taxid_fpath, pigz):
+        self.fpath = acc2taxid_fpath
+        self.proc = Popen([pigz, '-dc', acc2taxid_fpath], stdout=PIPE, bufsize=-1)
+
+    def finish(self):
+        # A truncated or corrupt file ends the output early rather than failing a read
+        if self.proc.wait() != 0:
+            raise IOError('pigz exited with code {} decompressing {}'.format(self.proc.returncode, self.fpath))
+
+    # Only the last line can lack a newline, so pigz is checked before it is
+    # returned rather than after a partial line fails to parse
+    def readline(self):
+        line = self.proc.stdout.readline()
+        if not line.endswith('\n'):
+            self.finish()
+        return(line)
+
+    def readlines(self, sizehint=0):
+        lines = self.proc.stdout.readlines(sizehint)
+        if not lines or not lines[-1].endswith('\n'):
+            self.finish()
+        return(lines)
+
+    def __iter__(self):
+        for line in self.proc.stdout:
+            if not line.endswith('\n'):
+                self.finish()
+            yield(line)
+        self.finish()
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+
+def Open_accession2taxid_gz(acc2taxid_fpath):
+    "Returns a file handle of decompressed lines, using pigz when available to decompress in a separate process"
+    pigz = find_executable('pigz')
+    if pigz:
+        return(PigzReader(acc2taxid_fpath, pigz))
+    return(gzip.open(acc2taxid_fpath))
+
+def Process_accession2taxid_file(acc2taxid_fpath, blast_dict, num_processors=1):
     "Returns dictionary of accession numbers and accession.version with their associated tax ids"
+    global query_accessions
+    query_accessions = set(chain.from_iterable(blast_dict.values()))
     acc2taxid_dict = dict()
-    accession_set = set(chain.from_iterable(blast_dict.values()))
 
+    if num_processors < 2:
+        if acc2taxid_fpath.endswith('.gz'):
+            fh = Open_accession2taxid_gz(acc2taxid_fpath)
+        else:
+            fh = open(acc2taxid_fpath)
+        header = fh.readline()
+        acc2taxid_dict = Filter_accession2taxid_lines(fh)
+        fh.close()
+        return(acc2taxid_dict)
+
+    # Workers are forked after query_accessions is set, so they share it copy-on-write
+    pool = Pool(num_processors)
     if acc2taxid_fpath.endswith('.gz'):
-        fh = gzip.open(acc2taxid_fpath)
+        # Decompression is pipelined with filtering. Blocks of lines are handed
+        # to the workers with a bounded number in flight to cap memory usage.
+        fh = Open_accession2taxid_gz(acc2taxid_fpath)
+        header = fh.readline()
+        pending = deque()
+        while True:
+            lines = fh.readlines(16777216)
+            if not lines:
+                break
+            pending.append(pool.apply_async(Filter_accession2taxid_lines, (lines,)))
+            if len(pending) >= 2 * num_processors:
+                acc2taxid_dict.update(pending.popleft().get())
+        while pending:
+            acc2taxid_dict.update(pending.popleft().get())
+        fh.close()
     else:
-        fh = open(acc2taxid_fpath)
-    header = fh.readline()
-    for line in fh:
-        acc_num, acc_ver, taxid, _ = line.split('\t')
-        taxid = int(taxid)
-        if acc_num in accession_set:
-            acc2taxid_dict.update({acc_num:taxid})
-            # acc2taxid_dict[acc_num]=taxid
-        elif acc_ver in accession_set:
-            acc2taxid_dict.update({acc_ver:taxid})
-            # acc2taxid_dict[acc_ver]=taxid
-    fh.close()
+        chunks = Split_accession2taxid_file(acc2taxid_fpath, 4 * num_processors)
+        for hits in pool.imap_unordered(Scan_accession2taxid_chunk, chunks):
+            acc2taxid_dict.update(hits)
+    pool.close()
+    pool.join()
     return(acc2taxid_dict)
 
+def Taxonomy_index_key(nodes_fpath):
+    "Returns a key identifying the taxonomy tree built from nodes_fpath (path, size and modification time)"
+    stat = os.stat(nodes_fpath)
+    return((os.path.realpath(nodes_fpath), stat.st_size, int(stat.st_mtime)))
+
+class LCACache(object):
+    "Memoizes LCA results keyed by the sorted tuple of a taxid set, optionally persisted to cache_fpath"
+
+    def __init__(self, cache_fpath=None, index_key=None):
+        self.cache_fpath = cache_fpath
+        self.index_key = index_key
+        self.lcas = dict()
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+        if cache_fpath and os.path.isfile(cache_fpath):
+            with open(cache_fpath, 'rb') as fh:
+                stored_key, lcas = cPickle.load(fh)
+            # Only reuse LCAs computed against the same taxonomy tree
+            if stored_key == index_key:
+                self.lcas = lcas
+                self.loaded = len(lcas)
+
+    def get(self, taxset):
+        "Returns the cached result for taxset or None"
+        key = tuple(sorted(taxset))
+        self.seen.add(key)
+        result = self.lcas.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return(result)
+
+    def add(self, taxset, result):
+        self.lcas[tuple(sorted(taxset))] = result
+
+    def save(self):
+        with open(self.cache_fpath, 'wb') as fh:
+            cPickle.dump((self.index_key, self.lcas), fh, cPickle.HIGHEST_PROTOCOL)
+
+    def summary(self):
+        "Returns a printable line of cache statistics"
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return('LCA cache: {} lookups, {} unique taxid sets, {} hits ({:.1f}%), {} sets loaded from cache file'.format(
+            lookups, len(self.seen), self.hits, hit_rate, self.loaded))
+
+def Build_lifting_table(parents):
+    "Returns (jump_table, depth) int32 arrays for binary lifting LCA queries\nparents is a dictionary of {child taxid: parent taxid} excluding root"
+    max_taxid = max(max(parents), max(parents.values()))
+    parent = np.zeros(max_taxid + 1, dtype=np.int32)
+    children = np.fromiter(parents.iterkeys(), dtype=np.int32, count=len(parents))
+    parent[children] = np.fromiter((parents[child] for child in children), dtype=np.int32, count=len(children))
+    # Root is its own parent. Taxids absent from the tree keep parent 0
+    parent[1] = 1
+    in_tree = parent != 0
+    # Row k of the jump table holds the 2**k-th ancestor of each taxid
+    jumps = [parent]
+    while np.any(jumps[-1][in_tree] > 1):
+        jumps.append(jumps[-1][jumps[-1]])
+    jump_table = np.vstack(jumps)
+    # Depth is found by lifting every node to the root with the largest jumps first
+    depth = np.zeros(max_taxid + 1, dtype=np.int32)
+    taxids = np.where(in_tree)[0]
+    nodes = taxids.astype(np.int32)
+    for k in range(len(jumps) - 1, -1, -1):
+        ancestors = jump_table[k][nodes]
+        below_root = ancestors != 1
+        depth[taxids[below_root]] += 2**k
+        nodes[below_root] = ancestors[below_root]
+    # The final step from a child of root up to root
+    depth[taxids[taxids != 1]] += 1
+    return(jump_table, depth)
+
+def LiftingQuery(node1, node2, jump_table, depth):
+    "Returns LCA of 2 tax ids by binary lifting\nRequires: jump table and depth array from Build_lifting_table"
+    if node1 == node2:
+        return(node1)
+    cdef int[:, :] jumps = jump_table
+    cdef int[:] depths = depth
+    cdef int a, b, k, diff
+    for node in (node1, node2):
+        if node <= 0 or node >= jumps.shape[1] or jumps[0, node] == 0:
+            raise KeyError(node)
+    a, b = node1, node2
+    if depths[a] < depths[b]:
+        a, b = b, a
+    # Lift the deeper node to the depth of the other
+    diff = depths[a] - depths[b]
+    k = 0
+    while diff:
+        if diff & 1:
+            a = jumps[k, a]
+        diff >>= 1
+        k += 1
+    if a == b:
+        return(a)
+    for k in range(jumps.shape[0] - 1, -1, -1):
+        if jumps[k, a] != jumps[k, b]:
+            a = jumps[k, a]
+            b = jumps[k, b]
+    return(jumps[0, a])
+
+def LiftingQueryBatch(nodes1, nodes2, jump_table, depth):
+    "Returns array of LCAs for paired arrays of tax ids by binary lifting\nAll tax ids must be present in the tree"
+    a = np.array(nodes1, dtype=np.int32)
+    b = np.array(nodes2, dtype=np.int32)
+    # Order each pair so a is the deeper node
+    swap = depth[a] < depth[b]
+    a[swap], b[swap] = b[swap], a[swap].copy()
+    diff = depth[a] - depth[b]
+    for k in range(jump_table.shape[0]):
+        lift = (diff >> k) & 1 == 1
+        a[lift] = jump_table[k][a[lift]]
+    unresolved = a != b
+    for k in range(jump_table.shape[0] - 1, -1, -1):
+        differ = unresolved & (jump_table[k][a] != jump_table[k][b])
+        a[differ] = jump_table[k][a[differ]]
+        b[differ] = jump_table[k][b[differ]]
+    a[unresolved] = jump_table[0][a[unresolved]]
+    return(a)
+
+def Lifting_reduce_taxsets(taxsets, jump_table, depth):
+    "Returns list of (lca, failed taxids) for each set of tax ids, reducing all sets together in batches"
+    results = list()
+    present_sets = list()
+    for taxset in taxsets:
+        present = [taxid for taxid in taxset if 0 < taxid < depth.shape[0] and jump_table[0][taxid] != 0]
+        failed = [taxid for taxid in taxset if taxid not in present]
+        if not present:
+            # As with RangeMinQuery, a single remaining taxid is returned even if not in the tree
+            results.append((int(failed[-1]), failed[:-1]))
+        else:
+            results.append([None, failed])
+        present_sets.append(present)
+    pending = [i for i, present in enumerate(present_sets) if present]
+    if pending:
+        width = max(len(present_sets[i]) for i in pending)
+        lcas = np.array([present_sets[i][0] for i in pending], dtype=np.int32)
+        for col in range(1, width):
+            active = np.array([len(present_sets[i]) > col for i in pending])
+            others = np.array([present_sets[i][col] for i, is_active in zip(pending, active) if is_active], dtype=np.int32)
+            lcas[active] = LiftingQueryBatch(lcas[active], others, jump_table, depth)
+        for i, lca in zip(pending, lcas):
+            results[i][0] = int(lca)
+    return([tuple(result) for result in results])
+
+def Index_memory(num_taxa, max_taxid, sparse_table=None, jump_table=None):
+    "Returns dictionary of bytes used by the rmq (euler tour + sparse table) and lifting LCA indexes\nUses the nbytes of built tables and estimates from tree size otherwise"
+    tour_length = 2 * num_taxa - 1
+    if sparse_table is not None:
+        sparse_table_bytes = sparse_table.nbytes
+    else:
+        sparse_table_bytes = tour_length * int(np.floor(np.log2(tour_length)) + 1) * 8
+    if jump_table is not None:
+        num_levels = jump_table.shape[0]
+    else:
+        # NCBI taxonomy depth is under 64
+        num_levels = 6
+    memory = {
+        # float64 sparse table, level list of ints, tour list of 3-tuples and the occurrence dict
+        'rmq': sparse_table_bytes + tour_length * (8 + 24) + tour_length * (8 + 80) + num_taxa * 60,
+        # int32 jump table rows and depth array indexed by taxid
+        'lifting': (num_levels + 1) * (max_taxid + 1) * 4,
+    }
+    return(memory)
+
 #Empty data structures used for RangeMinQuery
 tour=list()
 sparse_table=list()
@@ -19,17 +19,21 @@
 
 import pandas as pd
 import argparse
-import subprocess
 import os
+import orf_calling
+import marker_search
 
 #argument parser
 parser = argparse.ArgumentParser(description='Script tabulate single copy markers \
 	from a metagenome assembly. Dependencies: prodigal v2.6.2 (from "GoogleImport" branch), hhmscan (hmmer 3.1b2)')
 parser.add_argument('-a','--assembly', help='Input assembly file', required=True)
-parser.add_argument('-p','--processors', help='Number of processors to use for hmmscan', default=1)
+parser.add_argument('-p','--processors', help='Number of processors to use for prodigal and the HMM search', default=1)
 parser.add_argument('-c','--cutoffs', help='Bacterial single copy hmm cutoffs as defined by Rinke et al. Default path is home directory.', default="~/Bacteria_single_copy_cutoffs.txt")
 parser.add_argument('-m','--hmm', help='Bacteria_single_copy_cutoffs.hmm. Default path is home directory.', default="~/Bacteria_single_copy.hmm")
 parser.add_argument('-o','--out', help='outfile.tab, three column table with contig, single copy PFAMS, and # of markers', required=False)
+parser.add_argument('-e','--engine', help='HMMER program to search the markers with. hmmsearch does not need the HMMs pressed \
+	with hmmpress and is much faster for a small set of markers', choices=marker_search.PROGRAMS, default='hmmsearch')
+parser.add_argument('--orfs', help='ORFs already called from the assembly by orf_calling.py (otherwise they are called here)', required=False)
 args = vars(parser.parse_args())
 
 assembly = os.path.abspath(args['assembly'])
@@ -47,42 +51,50 @@ def get_contig_list(path_to_assembly):
 
 def run_prodigal(path_to_assembly):
 	assembly_filename = path_to_assembly.split('/')[-1]
-	#When "shell = True", need to give one string, not a list
-	subprocess.call(" ".join(['prodigal ','-i ' + path_to_assembly, '-a ' + output_dir + '/' + assembly_filename +\
-	 '.orfs.faa','-p meta', '-m', '-o ' + output_dir + '/' + assembly_filename + '.txt']), shell = True)
-	return output_dir + '/' + assembly_filename + '.orfs.faa'
+	# Shares cached ORFs with make_taxonomy_table.py when it has called them for the same assembly
+	return orf_calling.call_orfs(path_to_assembly, output_dir + '/' + assembly_filename + '.orfs.faa',
+		output_dir + '/' + assembly_filename + '.txt', num_processors=int(args['processors']))
 
-def run_hhmscan(path_to_prodigal_output,hmmdb):
-	subprocess.call("hmmscan --cpu {} --tblout {} {} {}".format(args['processors'],path_to_prodigal_output + ".hmm.tbl", hmmdb, path_to_prodigal_output),shell = True)
-	return path_to_prodigal_output + '.hmm.tbl'
+def run_hmm_search(path_to_prodigal_output, hmmdb, min_score):
+	# ORFs are searched in shards by concurrent single-threaded processes
+	try:
+		return marker_search.search_markers(path_to_prodigal_output, os.path.expanduser(hmmdb), path_to_prodigal_output + '.hmm.tbl',
+			args['engine'], int(args['processors']), min_score)
+	except RuntimeError as err:
+		print('make_marker_table.py: Error, {}'.format(err))
+		exit(1)
 
 output_dir = '/'.join(os.path.abspath(args['out']).split('/')[:-1])
 
-prodigal_output = run_prodigal(assembly)
-hmm_table_path = run_hhmscan(prodigal_output,args['hmm'])
+if args['orfs']:
+	prodigal_output = os.path.abspath(args['orfs'])
+else:
+	prodigal_output = run_prodigal(assembly)
 
-hmm_table = pd.read_csv(hmm_table_path, sep='\s+', usecols = [1, 2, 5], skiprows = 3, header = None, index_col = False, engine = 'python')
 cutoffs_table = pd.read_csv(args['cutoffs'], sep = '\s', engine = 'python', header = None)
+cutoffs = pd.Series(cutoffs_table[1].astype(float).values, index=cutoffs_table[0].astype(str).values)
+cutoffs = cutoffs[~cutoffs.index.duplicated()]
+
+#Find the ORFs with single copy PFAM domains that pass their cutoff. Hits scoring below
+#every cutoff are not reported. Cutoff IDs are PFAMXXXXX while HMMER reports PFAMXXXXX.1,
+#so hits are joined on the ID without its version
+hmm_table_path = run_hmm_search(prodigal_output, args['hmm'], cutoffs.min())
+hits = marker_search.read_marker_hits(hmm_table_path, args['engine'], min_score=cutoffs.min())
+hits['cutoff'] = hits['PFAM'].str.split('.', n=1).str[0].map(cutoffs)
+# PFAMs without a cutoff have a NaN cutoff and never pass
+hits = hits[hits['score'] > hits['cutoff']]
 
-#Search for contigs/ORFs that contain single copy PFAM domains that pass cutoff
-#for loop to search for PFAM domains in hmm table column 1:
-contig_ORFs_that_pass_cutoffs = {}
-for index,PFAM_cutoffs_id in enumerate(cutoffs_table[0]):
-	for count,PFAM_hmm_scan_id in enumerate(hmm_table[1]):
-		#If the PFAMs domain match (cutoffs ID names format are PFAMXXXXX, not PFAMXXXXX.1)
-		if str(PFAM_cutoffs_id) in str(PFAM_hmm_scan_id):
-			#and hmm score value > cutoff value,
-			if float(hmm_table[5][count]) > float(cutoffs_table[1][index]):
-				#make dictionary of lists for PFAMs, where PFAM is key and contigs populate the list
-				if PFAM_hmm_scan_id not in contig_ORFs_that_pass_cutoffs:
-					contig_ORFs_that_pass_cutoffs[PFAM_hmm_scan_id] = []
-					contig_ORFs_that_pass_cutoffs[PFAM_hmm_scan_id].append(hmm_table[2][count])
-				else:
-					contig_ORFs_that_pass_cutoffs[PFAM_hmm_scan_id].append(hmm_table[2][count])
+#Prodigal names ORFs <contig>_<n>, so each ORF's contig is its name without the last field
+hits['contig'] = hits['orf'].str.rsplit('_', n=1).str[0]
+#hmmsearch and hmmscan list hits in different orders, so each contig's PFAMs are listed
+#by ORF and then by descending score. ORFs given with --orfs may not end in a number,
+#and are listed after the numbered ones in order of name
+hits['orf_number'] = pd.to_numeric(hits['orf'].str.rsplit('_', n=1).str[-1], errors='coerce')
+hits = hits.sort_values(['contig', 'orf_number', 'orf', 'score', 'PFAM'], ascending=[True, True, True, False, True],
+	na_position='last')
+contig_PFAMs = hits.groupby('contig', sort=False)['PFAM'].apply(list).to_dict()
 
-#Make a dictionary of dictionaries with contigs that have single copy genes (list PFAMS, for final table count length of list),
-#contig length, contig GC, contig len, passecd PFAM domains
-#write out tab-delimited table
+#write out tab-delimited table with the contigs, their single copy PFAMs and the number of them
 
 if args['out'] != None:
 	outfile_handle = args['out']
@@ -90,22 +102,11 @@ else:
 	outfile_handle = assembly + ".marker.tab"
 with open(outfile_handle, 'w') as outfile:
 	outfile.write("contig" + '\t'+ "single_copy_PFAMs" + '\t' + "num_single_copies" + '\n')
-	contig_dictionary = {}
-	for count,contig in enumerate(get_contig_list(assembly)):
-		contig_dictionary[contig] = {}
-		contig_dictionary[contig]['single_copy_PFAMs'] = []
-		contig_dictionary[contig]['num_single_copies'] = 0
-		for PFAM_key,contigs in contig_ORFs_that_pass_cutoffs.items():
-			for item in contigs:
-				if str(contig) in item:
-					contig_dictionary[contig]['single_copy_PFAMs'].append(PFAM_key)
-		contig_dictionary[contig]['num_single_copies'] = len(contig_dictionary[contig]['single_copy_PFAMs'])
-
-		if len(contig_dictionary[contig]['single_copy_PFAMs']) > 0:
-			outfile.write(str(contig) + '\t' + str(",".join(contig_dictionary[contig]['single_copy_PFAMs'])) + '\t' + \
-		 	  str(contig_dictionary[contig]['num_single_copies']) + '\n')
+	for contig in get_contig_list(assembly):
+		single_copy_PFAMs = contig_PFAMs.get(contig, [])
+		if len(single_copy_PFAMs) > 0:
+			outfile.write(str(contig) + '\t' + ",".join(single_copy_PFAMs) + '\t' + str(len(single_copy_PFAMs)) + '\n')
 		else:
-			outfile.write(str(contig) + '\t' + "NA" + '\t' + \
-		 	  str(contig_dictionary[contig]['num_single_copies']) + '\n')
+			outfile.write(str(contig) + '\t' + "NA" + '\t' + "0" + '\n')
 
 print("\nDone!")
@@ -17,19 +17,32 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Autometa. If not, see <http://www.gnu.org/licenses/>.
 import sys
-import urllib2
+import json
 import subprocess
 import os
 import platform
 import shutil
+import time
 
 import pandas as pd
 from argparse import ArgumentParser
-from Bio import SeqIO
+
+import orf_calling
+import assembly_scan
+import database_update
+import taxonomy_db
+import stage_cache
 
 
 PIPELINE = os.path.dirname(os.path.realpath(__file__))
 AUTOMETA_DATABASES = os.path.join(os.path.dirname(PIPELINE), "databases")
+# Standard tabular columns followed by subject taxids, read directly by lca.py
+DIAMOND_STAXIDS_OUTFMT = "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore staxids"
+DIAMOND_BLASTP_OPTIONS = ["--evalue 1e-5", "--max-target-seqs 200"]
+# Scripts and modules that compute the LCAs and contig taxonomy
+LCA_SCRIPTS = stage_cache.scripts("lca.py", "lca_functions.pyx", "taxonomy_db.py")
+TAXONOMY_SCRIPTS = stage_cache.scripts("add_contig_taxonomy.py", "mask_bgcs.py2.7", "contig_tables.py",
+	"taxonomy_db.py", "taxonomy_service.py")
 
 
 def run_command(command_string, stdout_path=None):
@@ -73,9 +86,10 @@ def cythonize_lca_functions():
 def lca_compilation_check():
 	lca_funcs_so = os.path.join(PIPELINE, "lca_functions.so")
 	lca_fp = os.path.join(PIPELINE, "lca.py")
+	lca_funcs_pyx = os.path.join(PIPELINE, "lca_functions.pyx")
 	if not os.path.isfile(lca_funcs_so):
 		cythonize_lca_functions()
-	elif os.path.getmtime(lca_funcs_so) < os.path.getmtime(lca_fp):
+	elif os.path.getmtime(lca_funcs_so) < max(os.path.getmtime(lca_fp), os.path.getmtime(lca_funcs_pyx)):
 		print('lca.py updated. Recompiling lca functions.')
 		build_dir = os.path.join(PIPELINE, 'build')
 		lca_funcs_c = lca_funcs_so.replace('.so','.c')
@@ -86,110 +100,16 @@ def lca_compilation_check():
 	else:
 		print('lca_functions up-to-date')
 
-def download_file(destination_dir, file_url, md5_url):
-	filename = os.path.basename(file_url)
-	md5name = os.path.basename(md5_url)
-
-	while True:
-		outfpath = os.path.join(destination_dir, filename)
-		md5_fpath = os.path.join(destination_dir, md5name)
-		run_command('wget {} -O {}'.format(file_url, outfpath))
-		run_command('wget {} -O {}'.format(md5_url, md5_fpath))
-
-		downloaded_md5 = subprocess.check_output(['md5sum', outfpath]).split(' ')[0]
-
-		with open(md5_fpath, 'r') as check_md5_file:
-			check_md5 = check_md5_file.readline().split(' ')[0]
-
-		if downloaded_md5 == check_md5:
-			print('md5 checksum successful. Continuing...')
-			break
-		else:
-			print('md5 checksum unsuccessful. Retrying...')
-
-def md5IsCurrent(local_md5_path, remote_md5_url):
-	remote_md5_handle = urllib2.urlopen(remote_md5_url)
-	remote_md5 = remote_md5_handle.readline().split(' ')[0]
-
-	with open(local_md5_path, 'r') as local_md5_file:
-		local_md5 = local_md5_file.readline().split(' ')[0]
-
-	if local_md5 == remote_md5:
-		return True
-	else:
-		return False
-
 def update_dbs(outdir, db='all'):
 	"""Updates databases for AutoMeta usage"""
-
-	#Downloading files for db population
-	if db == 'all' or db == 'nr':
-		nr_db_url = "ftp://ftp.ncbi.nlm.nih.gov/blast/db/FASTA/nr.gz"
-		nr_db_md5_url = nr_db_url+".md5"
-		# First download nr if we don't yet have it OR it is not up to date
-		nr_md5_fpath = os.path.join(outdir,'nr.gz.md5')
-		if os.path.isfile(nr_md5_fpath):
-			if not md5IsCurrent(nr_md5_fpath, nr_db_md5_url):
-				print("md5 is not current. Updating nr.dmnd")
-				download_file(outdir, nr_db_url, nr_db_md5_url)
-		else:
-			print("updating nr.dmnd")
-			download_file(outdir, nr_db_url, nr_db_md5_url)
-
-		nr_fpath = os.path.join(outdir,'nr.gz')
-		# Now we make the diamond database
-		print("building nr.dmnd database, this may take some time")
-		cmd = " ".join([
-			"diamond makedb",
-			"--in {}".format(nr_fpath),
-			"--db {}".format(nr_fpath.rstrip(".gz")),
-			"-p {}".format(num_processors),
-		])
-		returnCode = subprocess.call(cmd, shell = True)
-		if returnCode == 0: # i.e. job was successful
-		#Make an md5 file to signal that we have built the database successfully
-			os.remove(nr_fpath)
-			print("nr.dmnd updated")
-		else:
-			print("nr.dmnd update FAILED!")
-	if db == 'all' or db == 'acc2taxid':
-		accession2taxid_url = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/prot.accession2taxid.gz"
-		accession2taxid_md5_url = accession2taxid_url+".md5"
-		# Download prot.accession2taxid.gz only if the version we have is not current
-		acc2taxid_md5_fpath = os.path.join(outdir,'prot.accession2taxid.gz.md5')
-		if os.path.isfile(acc2taxid_md5_fpath):
-			if not md5IsCurrent(acc2taxid_md5_fpath, accession2taxid_md5_url):
-				print("md5 is not current. Updating prot.accession2taxid")
-				download_file(outdir, accession2taxid_url, accession2taxid_md5_url)
-		else:
-			print("updating prot.accession2taxid")
-			download_file(outdir, accession2taxid_url, accession2taxid_md5_url)
-
-		acc2taxid_fpath = os.path.join(outdir,'prot.accession2taxid.gz')
-		if os.path.isfile(acc2taxid_fpath):
-			print("Gunzipping prot.accession2taxid gzipped file\nThis may take some time...")
-			cmd = "gunzip -9vNf {}".format(acc2taxid_fpath)
-			run_command(cmd, stdout_path=acc2taxid_fpath.rstrip('.gz'))
-			print("prot.accession2taxid updated")
-	if db == 'all' or db == 'taxdump':
-		taxdump_url = "ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz"
-		taxdump_md5_url = taxdump_url+".md5"
-		# Download taxdump only if the version we have is not current
-		taxdump_md5_fpath = os.path.join(outdir,'taxdump.tar.gz.md5')
-
-		if os.path.isfile(taxdump_md5_fpath):
-			if not md5IsCurrent(taxdump_md5_fpath, taxdump_md5_url):
-				print("updating nodes.dmp, names.dmp, merged.dmp")
-				download_file(outdir, taxdump_url, taxdump_md5_url)
-		else:
-			print("updating nodes.dmp, names.dmp, merged.dmp")
-			download_file(outdir, taxdump_url, taxdump_md5_url)
-
-		taxdump_fpath = os.path.join(outdir,'taxdump.tar.gz')
-		if os.path.isfile(taxdump_fpath):
-			run_command('tar -xzf {} -C {} names.dmp nodes.dmp merged.dmp'.format(taxdump_fpath, outdir))
-			os.remove(taxdump_fpath)
-			print("nodes.dmp, names.dmp, merged.dmp updated")
+	# Each download is checked against its md5 and unpacked as it streams in.
+	# nr is formatted last so diamond can use the taxonomy mapping files
+	dbs = database_update.DATABASES if db == 'all' else [db]
+	try:
+		database_update.update(outdir, dbs, num_processors, db_url)
+	except (RuntimeError, IOError) as err:
+		print('make_taxonomy_table.py: Error, could not update {}: {}'.format(', '.join(dbs), err))
+		exit(1)
 
 def check_dbs(db_path):
 	'''
@@ -216,15 +136,15 @@ def check_dbs(db_path):
 				This may take some time...'.format(db))
 				update_dbs(db_path, db)
 
-def length_trim(fasta_path, length_cutoff):
-	input_fname, ext = os.path.splitext(os.path.basename(fasta_path))
-	#Trim the length of fasta file
-	outfname = input_fname+".filtered"+ext
-	outfile_path = os.path.join(output_dir, outfname)
-	script = os.path.join(PIPELINE, "fasta_length_trim.pl")
-	cmd = " ".join(map(str, [script, fasta_path, length_cutoff, outfile_path]))
-	run_command(cmd)
-	return outfile_path
+def scan_assembly(fasta_path, length_cutoff, filtered_fpath, contig_table_fpath, k_mer_matrix_fpath, no_coverage):
+	# Writes the filtered assembly, contig table and k-mer matrix in one pass over the assembly
+	print('make_taxonomy_table.py, filtering {} to contigs of at least {} bp'.format(fasta_path, length_cutoff))
+	try:
+		assembly_scan.scan_assembly(fasta_path, length_cutoff, filtered_fpath, contig_table_fpath, k_mer_matrix_fpath,
+			cov_table, no_coverage, num_processors=num_processors)
+	except ValueError as err:
+		print('make_taxonomy_table.py: Error, {}'.format(err))
+		exit(1)
 
 def run_prodigal(path_to_assembly):
 	assembly_fname, _ = os.path.splitext(os.path.basename(path_to_assembly))
@@ -233,39 +153,184 @@ def run_prodigal(path_to_assembly):
 		print "{} file already exists!".format(output_path)
 		print "Continuing to next step..."
 	else:
-		run_command('prodigal -i {} -a {}/{}.orfs.faa -p meta -m -o {}/{}.txt'\
-		.format(path_to_assembly, output_dir, assembly_fname, output_dir, assembly_fname))
-
-def run_diamond(orfs_fpath, diamond_db_path, num_processors, outfpath):
-	view_output = orfs_fpath + ".blastp"
+		# Shares cached ORFs with make_marker_table.py when it has called them for the same assembly
+		print('make_taxonomy_table.py, calling ORFs in {}'.format(path_to_assembly))
+		try:
+			orf_calling.call_orfs(path_to_assembly, output_path, os.path.join(output_dir, assembly_fname+'.txt'),
+				num_processors=num_processors)
+		except RuntimeError as err:
+			print('make_taxonomy_table.py: Error, {}'.format(err))
+			exit(1)
+
+def diamond_blastp_command(orfs_fpath, diamond_db_path, num_processors, outfpath=None, staxids=False):
+	# Without outfpath diamond writes its tabular output to stdout
 	tmp_dir_path = os.path.join(os.path.dirname(orfs_fpath),'tmp')
 	if not os.path.isdir(tmp_dir_path):
 		os.makedirs(tmp_dir_path) # This will give an error if the path exists but is a file instead of a dir
-	cmds = [
-		"diamond blastp",
-		"--evalue 1e-5",
-		"--max-target-seqs 200",
-		"--outfmt 6",
+	cmds = ["diamond blastp"] + DIAMOND_BLASTP_OPTIONS + [
+		"--outfmt {}".format(DIAMOND_STAXIDS_OUTFMT if staxids else 6),
 		"--query {}.faa".format(orfs_fpath),
 		"--db {}".format(diamond_db_path),
 		"-p {}".format(num_processors),
-		"--out {}".format(outfpath),
 		"-t {}".format(tmp_dir_path)
 		]
-	cmd = " ".join(cmds)
+	if outfpath:
+		cmds.append("--out {}".format(outfpath))
+	return " ".join(cmds)
+
+def tmp_suffix():
+	# Unique across nodes sharing the output directory
+	return '.{}.{}.tmp'.format(platform.node(), os.getpid())
+
+def split_orfs(orfs_faa, num_shards, shard_dir):
+	"""
+	Splits the ORFs into up to num_shards runs of consecutive records with
+	about the same number of residues each. Returns the shard descriptions
+	"""
+	lengths = orf_calling.read_fasta_lengths(orfs_faa)
+	indices = orf_calling.contiguous_shards(lengths, num_shards)
+	shards = [{'name':'shard_{:04d}'.format(i), 'orfs':len(shard), 'residues':sum(lengths[j] for j in shard)}
+		for i, shard in enumerate(indices)]
+	shard_fpaths = [os.path.join(shard_dir, shard['name'] + '.faa') for shard in shards]
+	if len(shards) == 1:
+		orf_calling.link_output(orfs_faa, shard_fpaths[0])
+	else:
+		orf_calling.write_shards(orfs_faa, indices, shard_fpaths)
+	return shards
+
+def diamond_shard_plan(orfs_faa, diamond_db_path, num_shards, staxids, shard_dir, replan=True):
+	"""
+	Returns the shards of the ORFs to align, reusing those in shard_dir if they
+	were made from the same ORFs and settings. A new plan replaces the old one,
+	unless replan is False, when None is returned instead
+	"""
+	db_realpath = os.path.realpath(diamond_db_path)
+	db_stat = os.stat(db_realpath)
+	plan = {'orfs_md5':taxonomy_db.file_md5(orfs_faa), 'db':db_realpath, 'db_size':db_stat.st_size,
+		'db_mtime':int(db_stat.st_mtime), 'staxids':staxids, 'num_shards':num_shards}
+	manifest_fpath = os.path.join(shard_dir, 'manifest.json')
+	if os.path.isfile(manifest_fpath):
+		with open(manifest_fpath) as fh:
+			manifest = json.load(fh)
+		if manifest['plan'] == plan:
+			return manifest['shards']
+		if not replan:
+			return None
+		print('ORFs, database or shard settings changed since {} was planned, discarding its shards'.format(shard_dir))
+		shutil.rmtree(shard_dir)
+	if not replan:
+		return None
+	# Planned in a temporary directory and renamed, so runs starting together
+	# agree on one plan
+	tmp_dir = shard_dir + tmp_suffix()
+	os.makedirs(tmp_dir)
+	shards = split_orfs(orfs_faa, num_shards, tmp_dir)
+	with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+		json.dump({'plan':plan, 'shards':shards}, fh, indent=1, sort_keys=True)
+	try:
+		os.rename(tmp_dir, shard_dir)
+	except OSError:
+		shutil.rmtree(tmp_dir)
+		with open(manifest_fpath) as fh:
+			return json.load(fh)['shards']
+	print('Split {} into {} shards in {}'.format(orfs_faa, len(shards), shard_dir))
+	return shards
+
+def shard_done(shard_prefix):
+	# A shard is done once its checkpoint records the size of its finished output
+	done_fpath = shard_prefix + '.done'
+	if not os.path.isfile(done_fpath) or not os.path.isfile(shard_prefix + '.blastp'):
+		return False
+	with open(done_fpath) as fh:
+		return json.load(fh)['size'] == os.path.getsize(shard_prefix + '.blastp')
+
+def run_diamond_shard(shard_prefix, diamond_db_path, num_processors, staxids=False):
+	if shard_done(shard_prefix):
+		print('{}.blastp already aligned, skipping'.format(shard_prefix))
+		return
+	tmp_fpath = shard_prefix + '.blastp' + tmp_suffix()
+	cmd = diamond_blastp_command(shard_prefix, diamond_db_path, num_processors, tmp_fpath, staxids)
+	start = time.time()
 	error = run_command_return(cmd)
-	# If there is an error, attempt to rebuild NR
-	if error == 134 or error == str(134):
-		print('Fatal: Not enough disk space for diamond alignment archive!')
-		exit(1)
 	if error:
-		print('Error when performing diamond blastp:\n{}\nAttempting to correct by rebuilding nr...'.format(error))
-		update_dbs(db_dir_path, 'nr')
-		# Retry with rebuilt nr.dmnd
-		run_command(cmd)
-
+		if os.path.isfile(tmp_fpath):
+			os.remove(tmp_fpath)
+		if error == 134:
+			print('Fatal: Not enough disk space for diamond alignment archive!')
+		else:
+			print('Error when performing diamond blastp on {}.faa (exit code {}). Finished shards are kept '\
+				'and rerunning resumes from this one. If {} is damaged, rebuild it with --update'\
+				.format(shard_prefix, error, diamond_db_path))
+		exit(1)
+	os.rename(tmp_fpath, shard_prefix + '.blastp')
+	done = {'size':os.path.getsize(shard_prefix + '.blastp'), 'seconds':round(time.time() - start, 1)}
+	with open(shard_prefix + '.done' + tmp_suffix(), 'w') as fh:
+		json.dump(done, fh)
+	os.rename(shard_prefix + '.done' + tmp_suffix(), shard_prefix + '.done')
+
+def run_diamond(orfs_fpath, diamond_db_path, num_processors, outfpath, staxids=False, num_shards=1, shard_index=None):
+	"""
+	Aligns the ORFs in shards, checkpointing each as it finishes so a rerun
+	only aligns the unfinished ones. With shard_index only that shard is
+	aligned (to spread shards over nodes) and None is returned. Otherwise the
+	shard outputs are concatenated in ORF order into outfpath
+	"""
+	shard_dir = outfpath + '.shards'
+	# Tasks aligning one shard each only use the shards planned by --plan_shards,
+	# so they never replan them while other tasks are aligning
+	shards = diamond_shard_plan(orfs_fpath + '.faa', diamond_db_path, num_shards, staxids, shard_dir,
+		replan=shard_index is None)
+	if shards is None:
+		print('No shards of the current ORFs are planned in {}. Run once with --plan_shards (without --shard_index) first'\
+			.format(shard_dir))
+		exit(1)
+	shard_prefixes = [os.path.join(shard_dir, shard['name']) for shard in shards]
+	if shard_index is not None:
+		if shard_index < len(shards):
+			run_diamond_shard(shard_prefixes[shard_index], diamond_db_path, num_processors, staxids)
+		else:
+			print('Only {} shards were planned, nothing to align for shard {}'.format(len(shards), shard_index))
+		return None
+	for shard_prefix in shard_prefixes:
+		run_diamond_shard(shard_prefix, diamond_db_path, num_processors, staxids)
+
+	tmp_fpath = outfpath + tmp_suffix()
+	if len(shard_prefixes) == 1:
+		os.rename(shard_prefixes[0] + '.blastp', tmp_fpath)
+	else:
+		with open(tmp_fpath, 'wb') as outfile:
+			for shard_prefix in shard_prefixes:
+				with open(shard_prefix + '.blastp', 'rb') as infile:
+					shutil.copyfileobj(infile, outfile)
+	os.rename(tmp_fpath, outfpath)
+	shutil.rmtree(shard_dir)
 	return outfpath
 
+def run_diamond_lca(orfs_fpath, diamond_db_path, num_processors, lca_fpath, staxids=False, tee_fpath=None):
+	"""Pipes diamond blastp output into lca.py, so LCAs are computed while the alignment runs"""
+	diamond_cmd = diamond_blastp_command(orfs_fpath, diamond_db_path, num_processors, staxids=staxids)
+	lca_script = os.path.join(PIPELINE, "lca.py")
+	lca_cmd = "{} -p {} -out {}".format(lca_script, num_processors, lca_fpath)
+	if tee_fpath:
+		lca_cmd += " -tee {}".format(tee_fpath)
+	lca_cmd += " database_directory {} -".format(db_dir_path)
+	print('make_taxonomy_table.py, run_command: {} | {}'.format(diamond_cmd, lca_cmd))
+	diamond = subprocess.Popen(diamond_cmd, stdout=subprocess.PIPE, shell=True)
+	lca = subprocess.Popen(lca_cmd, stdin=diamond.stdout, shell=True)
+	# Let diamond receive SIGPIPE if lca.py exits early
+	diamond.stdout.close()
+	lca_exit_code = lca.wait()
+	diamond_exit_code = diamond.wait()
+	if diamond_exit_code != 0 or lca_exit_code != 0:
+		print('make_taxonomy_table.py: Error, diamond blastp | lca.py failed with exit codes {} | {}'\
+			.format(diamond_exit_code, lca_exit_code))
+		# Remove partial outputs so they are not mistaken for finished ones
+		for fpath in [lca_fpath, tee_fpath]:
+			if fpath and os.path.isfile(fpath):
+				os.remove(fpath)
+		exit(1)
+	return lca_fpath
+
 #blast2lca using accession numbers#
 def run_blast2lca(input_file, taxdump_path):
 	fname = os.path.splitext(os.path.basename(input_file))[0] + ".lca"
@@ -274,23 +339,12 @@ def run_blast2lca(input_file, taxdump_path):
 		print "{} file already exists! Continuing to next step...".format(output)
 	else:
 		lca_script = os.path.join(PIPELINE, "lca.py")
-		cmd = "{} database_directory {} {}".format(lca_script, db_dir_path, input_file)
+		cmd = "{} -p {} database_directory {} {}".format(lca_script, num_processors, db_dir_path, input_file)
 		run_command(cmd)
 	return output
 
-def run_taxonomy(assembly_path, lca_fpath, db_dir_path,
-		coverage_table, bgcs_path=None, orfs_path=None): #Have to update this
-	assembly_fname, _ = os.path.splitext(os.path.basename(assembly_path))
-	contig_tab_fpath = os.path.join(output_dir, assembly_fname+'.tab')
-	contig_table_script = os.path.join(PIPELINE, "make_contig_table.py")
-	# Only make the contig table if it doesn't already exist
-	if not os.path.isfile(contig_tab_fpath):
-		cmd = "{} -a {} -o {}".format(contig_table_script, assembly_path, contig_tab_fpath)
-		if coverage_table:
-			cmd += " -c {}".format(coverage_table)
-		elif single_genome_mode:
-			cmd += " -n"
-		run_command(cmd)
+def run_taxonomy(contig_tab_fpath, lca_fpath, db_dir_path,
+		bgcs_path=None, orfs_path=None): #Have to update this
 	if bgcs_path:
 		mask_bgcs_script = os.path.join(PIPELINE, "mask_bgcs.py2.7")
 		cmd = "{} --bgc {} --orfs {} --lca {}"
@@ -306,10 +360,40 @@ def run_taxonomy(assembly_path, lca_fpath, db_dir_path,
 		contig_tab_fpath,
 		lca_fpath,
 		db_dir_path,
-		taxonomy_fp])
+		taxonomy_fp,
+		"-p {}".format(num_processors)])
 	run_command(cmd)
 	return taxonomy_fp
 
+def split_kingdoms(assembly_fpath, taxonomy_fpath, outdir):
+	"""
+	Writes each contig of the assembly to <kingdom>.fasta in outdir, streaming
+	the assembly once so only the contig to kingdom map is held in memory
+	"""
+	taxonomy_pd = pd.read_csv(taxonomy_fpath, sep='\t', usecols=['contig','kingdom'], dtype=str)
+	contig_kingdoms = dict(zip(taxonomy_pd['contig'], taxonomy_pd['kingdom']))
+	outfiles = {}
+	outfile = None
+	with open(assembly_fpath) as assembly:
+		for line in assembly:
+			if line.startswith('>'):
+				contig = line[1:].split(None, 1)[0]
+				kingdom = contig_kingdoms.pop(contig, None)
+				if kingdom is None:
+					outfile = None
+				else:
+					if kingdom not in outfiles:
+						outfiles[kingdom] = open(os.path.join(outdir, '{}.fasta'.format(kingdom)), 'w', 1 << 20)
+					outfile = outfiles[kingdom]
+			if outfile:
+				outfile.write(line)
+	for outfile in outfiles.values():
+		outfile.close()
+	#Using filtered assembly, taxonomy.tab contains contigs not filtered
+	for contig in taxonomy_pd['contig']:
+		if contig in contig_kingdoms:
+			print('{0} below length filter, skipping.'.format(contig))
+
 #argument parser
 parser = ArgumentParser(description="Script to generate the contig taxonomy table.",
 	epilog="Output will be directed to recursive_dbscan_output.tab")
@@ -335,22 +419,70 @@ parser.add_argument('-bgc', '--bgcs_dir', metavar='<dir>',
 	help='Path to directory of biosynthetic gene clusters. Masks BGCs')
 parser.add_argument('-s', '--single_genome', help='Specifies single genome mode',
 	action='store_true')
+parser.add_argument('-t', '--staxids', action='store_true',
+	help='Report subject taxids in the diamond output so lca.py can skip accession2taxid. \
+	Requires nr.dmnd built with taxonomy mapping (rebuild with --update if needed).')
+parser.add_argument('--stream_lca', action='store_true',
+	help='Pipe diamond output directly into lca.py instead of writing the full blastp table first. \
+	LCAs are written as diamond reports each query when combined with --staxids.')
+parser.add_argument('--keep_blastp', action='store_true',
+	help='With --stream_lca, also write the raw diamond hits to disk as they stream')
+parser.add_argument('--num_shards', metavar='<int>', type=int, default=1,
+	help='Split the ORFs into this many shards for diamond blastp. Finished shards are kept, \
+	so a rerun after a failure only aligns the rest (ignored with --stream_lca)')
+parser.add_argument('--plan_shards', action='store_true',
+	help='Filter the assembly, call ORFs and split them into --num_shards shards, then exit. \
+	Run once before starting the --shard_index tasks')
+parser.add_argument('--shard_index', metavar='<int>', type=int,
+	help='Only align this shard (0 to num_shards - 1), e.g. as one task of a cluster job array, after a \
+	--plan_shards run. Rerun without --shard_index once all shards are aligned to combine them and continue')
+parser.add_argument('--orfs', metavar='<orfs.faa>',
+	help='ORFs already called from the filtered assembly by orf_calling.py (otherwise they are called here)')
+parser.add_argument('--db_url', metavar='<url>',
+	help='Base URL (ftp://, http:// or file://) or directory of a mirror holding prot.accession2taxid.gz, \
+	taxdump.tar.gz and nr.gz with their .md5 files, used instead of NCBI when downloading databases')
+parser.add_argument('--stage_cache', metavar='<dir>',
+	help='Directory shared between runs for stage outputs. Stages whose inputs, parameters, tool versions \
+	and databases match a finished run link its outputs instead of running again')
+parser.add_argument('--adopt_existing', action='store_true',
+	help='Keep outputs made before stages were recorded (by an older version) instead of making them again. \
+	Their inputs, parameters, tool versions and databases are not checked')
 parser.add_argument('-u', '--update', required=False, action='store_true',
 	help='Checks/Adds/Updates: nodes.dmp, names.dmp, merged.dmp, accession2taxid, nr.dmnd files within specified directory.')
 
 args = vars(parser.parse_args())
+if args['num_shards'] < 1:
+	parser.error('--num_shards must be at least 1')
+if args['shard_index'] is not None:
+	if not 0 <= args['shard_index'] < args['num_shards']:
+		parser.error('--shard_index must be between 0 and --num_shards - 1')
+	if args['stream_lca']:
+		parser.error('--shard_index cannot be used with --stream_lca')
+	if args['plan_shards']:
+		parser.error('--shard_index cannot be used with --plan_shards')
+if args['plan_shards'] and args['stream_lca']:
+	parser.error('--plan_shards cannot be used with --stream_lca')
 
 db_dir_path = os.path.abspath(args['db_dir'])
 usr_prot_path = args['user_prot_db']
 num_processors = args['processors']
+db_url = args['db_url']
 length_cutoff = args['length_cutoff']
 fasta_path = args['assembly']
 cov_table = args['cov_table']
 output_dir = args['output_dir']
 single_genome_mode = args['single_genome']
+staxids = args['staxids']
+stream_lca = args['stream_lca']
+keep_blastp = args['keep_blastp']
+num_shards = args['num_shards']
+shard_index = args['shard_index']
+plan_shards = args['plan_shards']
+stage_cache_dir = args['stage_cache']
+stage_cache.adopt_existing = args['adopt_existing']
 
 bgcs_dir = args['bgcs_dir']
-fasta_fname, _ = os.path.splitext(os.path.basename(fasta_path))
+fasta_fname, fasta_ext = os.path.splitext(os.path.basename(fasta_path))
 prodigal_output = os.path.join(output_dir, "{}.filtered.orfs".format(fasta_fname))
 diamond_outfpath = prodigal_output + ".blastp"
 
@@ -404,82 +536,111 @@ if args['update']:
 	print("Checking database directory for updates")
 	update_dbs(db_dir_path, 'all')
 
-filtered_assembly = os.path.join(output_dir, "{}.filtered.fasta".format(fasta_fname))
-if not os.path.isfile(filtered_assembly):
-	filtered_assembly = length_trim(fasta_path, length_cutoff)
-
-if not os.path.isfile(prodigal_output + ".faa"):
-	print "Prodigal output not found. Running prodigal..."
-	#Check for file and if it doesn't exist run make_marker_table
-	run_prodigal(filtered_assembly)
-
-if not os.path.isfile(diamond_outfpath):
-	print "Could not find {}. Running diamond blast... ".format(diamond_outfpath)
-	diamond_output = run_diamond(prodigal_output, diamond_db_path, num_processors, diamond_outfpath)
-elif os.stat(diamond_outfpath).st_size == 0:
-	print "{} file is empty. Re-running diamond blast...".format(diamond_outfpath)
-	diamond_output = run_diamond(prodigal_output, diamond_db_path, num_processors, diamond_outfpath)
-elif not os.path.isfile(diamond_outfpath):
-	print "{} not found. \nExiting...".format(diamond_outfpath)
-	exit(1)
+# Each stage is skipped while its outputs are current for its inputs,
+# parameters, tool versions and databases (see stage_cache.py)
+filtered_assembly = os.path.join(output_dir, fasta_fname + ".filtered" + fasta_ext)
+contig_table = os.path.join(output_dir, fasta_fname + ".filtered.tab")
+k_mer_matrix = os.path.join(output_dir, "k-mer_matrix")
+# The same stage as in run_autometa.py, which makes the k-mer matrix for recursive_dbscan.py
+no_coverage = bool(single_genome_mode and not cov_table)
+scan_stage = stage_cache.assembly_scan_stage(fasta_path, length_cutoff, cov_table, no_coverage, filtered_assembly,
+	contig_table, k_mer_matrix, stage_cache_dir)
+def prodigal_stage():
+	# Made once the filtered assembly is written, as it is the stage's input
+	return stage_cache.Stage([prodigal_output + ".faa"], [filtered_assembly] + stage_cache.scripts("orf_calling.py"),
+		{'prodigal_args':orf_calling.PRODIGAL_ARGS}, tools=[['prodigal', '-v']], cache_dir=stage_cache_dir)
+
+if shard_index is not None:
+	# Tasks of a job array share the output directory, so rather than each
+	# redoing (and replacing) the outputs other tasks read, they only check
+	# that the --plan_shards run made them
+	if not scan_stage.is_current() or \
+		not (os.path.isfile(prodigal_output + ".faa") if args['orfs'] else prodigal_stage().is_current()):
+		print "The filtered assembly or ORFs in {} are not up to date. Run once with --plan_shards (without --shard_index) first"\
+			.format(output_dir)
+		exit(1)
 else:
-	diamond_output = diamond_outfpath
-
-if not os.path.isfile(prodigal_output + ".lca"):
-	print "Could not find {}. Running lca...".format(prodigal_output + ".lca")
-	blast2lca_output = run_blast2lca(diamond_output,db_dir_path)
-elif os.stat(prodigal_output + ".lca").st_size == 0:
-	print "{} file is empty. Re-running lca...".format(prodigal_output + ".lca")
-	blast2lca_output = run_blast2lca(diamond_output,db_dir_path)
+	if not scan_stage.restore():
+		scan_assembly(fasta_path, length_cutoff, filtered_assembly, contig_table, k_mer_matrix, no_coverage)
+		scan_stage.save()
+	if args['orfs']:
+		orf_calling.link_output(os.path.abspath(args['orfs']), prodigal_output + ".faa")
+	else:
+		orfs_stage = prodigal_stage()
+		if not orfs_stage.restore():
+			print "Running prodigal..."
+			run_prodigal(filtered_assembly)
+			orfs_stage.save()
+
+taxonomy_databases = [names_dmp_path, nodes_dmp_path, os.path.join(db_dir_path, 'merged.dmp')]
+lca_outfpath = prodigal_output + ".lca"
+if stream_lca:
+	tee_fpath = diamond_outfpath if keep_blastp else None
+	stream_lca_stage = stage_cache.Stage([lca_outfpath] + ([tee_fpath] if tee_fpath else []),
+		[prodigal_output + ".faa"] + LCA_SCRIPTS, {'diamond_options':DIAMOND_BLASTP_OPTIONS, 'staxids':staxids},
+		tools=[['diamond', 'version']], databases=[diamond_db_path, accession2taxid_path] + taxonomy_databases,
+		cache_dir=stage_cache_dir)
+	if not stream_lca_stage.restore():
+		print "Running diamond blast piped into lca..."
+		run_diamond_lca(prodigal_output, diamond_db_path, num_processors, lca_outfpath, staxids, tee_fpath)
+		stream_lca_stage.save()
+	blast2lca_output = lca_outfpath
 else:
-	blast2lca_output = prodigal_output + ".lca"
+	diamond_stage = stage_cache.Stage([diamond_outfpath], [prodigal_output + ".faa"],
+		{'diamond_options':DIAMOND_BLASTP_OPTIONS, 'staxids':staxids}, tools=[['diamond', 'version']],
+		databases=[diamond_db_path], cache_dir=stage_cache_dir)
+	if shard_index is not None:
+		# The stage manifest is left to the run combining the shards
+		run_diamond(prodigal_output, diamond_db_path, num_processors, diamond_outfpath, staxids, num_shards, shard_index)
+		print "Shard {} of {} is aligned. Rerun without --shard_index once all shards are aligned.".format(shard_index, num_shards)
+		exit(0)
+	if diamond_stage.restore():
+		diamond_output = diamond_outfpath
+	elif plan_shards:
+		shards = diamond_shard_plan(prodigal_output + ".faa", diamond_db_path, num_shards, staxids, diamond_outfpath + '.shards')
+		print "{} shards are planned. Run the --shard_index tasks, then rerun without --shard_index.".format(len(shards))
+		exit(0)
+	else:
+		print "Running diamond blast..."
+		diamond_output = run_diamond(prodigal_output, diamond_db_path, num_processors, diamond_outfpath, staxids, num_shards)
+		diamond_stage.save()
+	if plan_shards:
+		print "{} is already up to date, there are no shards to align.".format(diamond_output)
+		exit(0)
+
+	lca_stage = stage_cache.Stage([lca_outfpath], [diamond_output] + LCA_SCRIPTS,
+		databases=[accession2taxid_path] + taxonomy_databases, cache_dir=stage_cache_dir)
+	if lca_stage.restore():
+		blast2lca_output = lca_outfpath
+	else:
+		print "Running lca..."
+		blast2lca_output = run_blast2lca(diamond_output,db_dir_path)
+		lca_stage.save()
 
 taxonomy_table = os.path.join(output_dir, 'taxonomy.tab')
-if not os.path.isfile(taxonomy_table) or os.stat(taxonomy_table).st_size == 0:
+# BGC masking also reads the ORFs
+bgc_fpaths = [os.path.join(bgcs_dir, fname) for fname in sorted(os.listdir(bgcs_dir))] + [prodigal_output + ".faa"] if bgcs_dir else []
+taxonomy_stage = stage_cache.Stage([taxonomy_table],
+	[contig_table, blast2lca_output] + bgc_fpaths + TAXONOMY_SCRIPTS,
+	{'single_genome':single_genome_mode, 'bgcs':bool(bgcs_dir)}, databases=taxonomy_databases, cache_dir=stage_cache_dir)
+if not taxonomy_stage.restore():
 	print "Running add_contig_taxonomy.py... "
 	if bgcs_dir:
 		taxonomy_table = run_taxonomy(
-			assembly_path=filtered_assembly,
+			contig_tab_fpath=contig_table,
 			lca_fpath=blast2lca_output,
 			db_dir_path=db_dir_path,
-			coverage_table=cov_table,
 			bgcs_path=bgcs_dir,
 			orfs_path=prodigal_output + '.faa')
 	else:
 		taxonomy_table = run_taxonomy(
-			assembly_path=filtered_assembly,
+			contig_tab_fpath=contig_table,
 			lca_fpath=blast2lca_output,
-			db_dir_path=db_dir_path,
-			coverage_table=cov_table)
-else:
-	print('taxonomy.tab exists... Splitting original contigs into kingdoms')
-
-# Split the original contigs into sets for each kingdom
-taxonomy_pd = pd.read_table(taxonomy_table)
-categorized_seq_objects = {}
-all_seq_records = {}
-
-# Load fasta file
-for seq_record in SeqIO.parse(filtered_assembly, 'fasta'):
-	all_seq_records[seq_record.id] = seq_record
-
-for i, row in taxonomy_pd.iterrows():
-	kingdom = row['kingdom']
-	contig = row['contig']
-	if contig not in all_seq_records:
-		#Using filtered assembly, taxonomy.tab contains contigs not filtered
-		print('{0} below length filter, skipping.'.format(contig))
-		continue
-	if kingdom in categorized_seq_objects:
-		categorized_seq_objects[kingdom].append(all_seq_records[contig])
-	else:
-		categorized_seq_objects[kingdom] = [ all_seq_records[contig] ]
+			db_dir_path=db_dir_path)
+	taxonomy_stage.save()
 
-# Now we write the component fasta files
+# Split the original contigs into a fasta file for each kingdom
 if not single_genome_mode:
-	for kingdom in categorized_seq_objects:
-		seq_list = categorized_seq_objects[kingdom]
-		output_path = os.path.join(output_dir, '{}.fasta'.format(kingdom))
-		SeqIO.write(seq_list, output_path, 'fasta')
+	split_kingdoms(filtered_assembly, taxonomy_table, output_dir)
 
 print "Done!"
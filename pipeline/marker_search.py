@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Searches ORFs against the single copy marker HMMs for make_marker_table.py.
+# HMMER's threading stops scaling after a few cores, so the ORFs are split
+# into shards searched by concurrent single-threaded hmmsearch (or hmmscan)
+# processes. With only ~140 marker models, hmmsearch of the ORFs against the
+# models is much faster than hmmscan of each ORF against a pressed database,
+# and both report the same bit scores. Finished shards are kept until all are
+# done, so a rerun of an interrupted search only searches the rest.
+
+import os
+import json
+import shutil
+import argparse
+import subprocess
+import orf_calling
+import taxonomy_db
+import hmmer_tables
+
+from multiprocessing.pool import ThreadPool
+
+PROGRAMS = ['hmmsearch', 'hmmscan']
+
+# tblout columns holding the marker accession and the ORF name for each program
+HIT_COLUMNS = {
+    'hmmsearch': ['query_accession', 'target_name', 'score'],
+    'hmmscan': ['target_accession', 'query_name', 'score'],
+}
+
+def search_command(program, hmm_fpath, orfs_fpath, tblout_fpath, min_score=None):
+    command = [program, '--cpu', '1', '-o', os.devnull, '--tblout', tblout_fpath]
+    if min_score is not None:
+        # Reporting by bit score keeps hmmsearch and hmmscan from dropping
+        # hits by E-value, which depends on the number of ORFs or models
+        command += ['-T', str(min_score)]
+    return(command + [hmm_fpath, orfs_fpath])
+
+def shard_plan(orfs_fpath, hmm_fpath, program, num_shards, min_score, shard_dir):
+    """
+    Returns the names of the ORF shards in shard_dir, splitting the ORFs
+    again if the shards there were made for other ORFs or settings
+    """
+    plan = {'orfs_md5':taxonomy_db.file_md5(orfs_fpath), 'hmm':os.path.realpath(hmm_fpath),
+        'hmm_md5':taxonomy_db.file_md5(hmm_fpath), 'program':program, 'num_shards':num_shards,
+        'min_score':min_score}
+    manifest_fpath = os.path.join(shard_dir, 'manifest.json')
+    if os.path.isfile(manifest_fpath):
+        with open(manifest_fpath) as fh:
+            manifest = json.load(fh)
+        if manifest['plan'] == plan:
+            return(manifest['shards'])
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    indices = orf_calling.contiguous_shards(orf_calling.read_fasta_lengths(orfs_fpath), num_shards)
+    shards = ['shard_{:04d}'.format(i) for i in range(len(indices))]
+    orf_calling.write_shards(orfs_fpath, indices, [os.path.join(shard_dir, shard + '.faa') for shard in shards])
+    # Written last, so shards are only reused once all were written
+    with open(manifest_fpath, 'w') as fh:
+        json.dump({'plan':plan, 'shards':shards}, fh, indent=1, sort_keys=True)
+    return(shards)
+
+def search_shard(args):
+    "Searches one shard, returning None on success or its error message"
+    program, hmm_fpath, shard_prefix, min_score = args
+    if os.path.isfile(shard_prefix + '.tbl'):
+        return(None)
+    tmp_fpath = shard_prefix + '.tbl.tmp'
+    with open(shard_prefix + '.log', 'w') as log:
+        exit_code = subprocess.call(search_command(program, hmm_fpath, shard_prefix + '.faa', tmp_fpath, min_score),
+            stdout=log, stderr=subprocess.STDOUT)
+    if exit_code != 0:
+        with open(shard_prefix + '.log') as log:
+            return('{} failed on {}.faa with exit code {}:\n{}'.format(program, shard_prefix, exit_code, log.read()))
+    os.rename(tmp_fpath, shard_prefix + '.tbl')
+    return(None)
+
+def search_markers(orfs_fpath, hmm_fpath, tblout_fpath, program='hmmsearch', num_processors=1, min_score=None):
+    """
+    Searches the ORFs against the marker HMMs with up to num_processors
+    concurrent processes, writing one tblout table of all hits to tblout_fpath
+    """
+    if program not in PROGRAMS:
+        raise ValueError('program must be one of {}'.format(', '.join(PROGRAMS)))
+    if num_processors <= 1:
+        exit_code = subprocess.call(search_command(program, hmm_fpath, orfs_fpath, tblout_fpath + '.tmp', min_score))
+        if exit_code != 0:
+            raise RuntimeError('{} failed with exit code {}'.format(program, exit_code))
+        os.rename(tblout_fpath + '.tmp', tblout_fpath)
+        return(tblout_fpath)
+
+    shard_dir = tblout_fpath + '.shards'
+    shards = shard_plan(orfs_fpath, hmm_fpath, program, num_processors, min_score, shard_dir)
+    shard_prefixes = [os.path.join(shard_dir, shard) for shard in shards]
+    print('Searching {} shards of {} with {}'.format(len(shards), orfs_fpath, program))
+    pool = ThreadPool(num_processors)
+    errors = [error for error in pool.map(search_shard,
+        [(program, hmm_fpath, prefix, min_score) for prefix in shard_prefixes]) if error]
+    pool.close()
+    if errors:
+        raise RuntimeError('{} of {} shards failed, rerun to search them again. {}'.format(len(errors), len(shards), errors[0]))
+    # Comment lines of each shard's table are kept; the table reader skips them
+    with open(tblout_fpath + '.tmp', 'w') as outfile:
+        for prefix in shard_prefixes:
+            with open(prefix + '.tbl') as infile:
+                shutil.copyfileobj(infile, outfile)
+    os.rename(tblout_fpath + '.tmp', tblout_fpath)
+    shutil.rmtree(shard_dir)
+    return(tblout_fpath)
+
+def read_marker_hits(tblout_fpath, program='hmmsearch', min_score=None):
+    "Returns the marker accession, ORF and score of each hit as columns PFAM, orf and score"
+    hits = hmmer_tables.read_tblout(tblout_fpath, HIT_COLUMNS[program], min_score=min_score)
+    hits.columns = ['PFAM', 'orf', 'score']
+    return(hits)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Searches ORFs against marker HMMs in concurrent shards, writing a tblout table')
+    parser.add_argument('-i', '--orfs', metavar='<orfs.faa>', help='ORF protein fasta', required=True)
+    parser.add_argument('-m', '--hmm', metavar='<markers.hmm>', help='Marker HMMs (pressed with hmmpress for hmmscan)', required=True)
+    parser.add_argument('-o', '--tblout', metavar='<hits.tbl>', help='Path of the tblout table to write', required=True)
+    parser.add_argument('-e', '--engine', help='HMMER program to search with', choices=PROGRAMS, default='hmmsearch')
+    parser.add_argument('-p', '--processors', metavar='<int>', help='Number of concurrent searches', type=int, default=1)
+    parser.add_argument('-T', '--min_score', metavar='<float>', help='Only report hits with at least this bit score', type=float)
+    args = vars(parser.parse_args())
+    try:
+        print(search_markers(args['orfs'], args['hmm'], args['tblout'], args['engine'], args['processors'], args['min_score']))
+    except RuntimeError as err:
+        exit(str(err))
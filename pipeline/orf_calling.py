@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# ORF calling with prodigal shared by make_marker_table.py (hmmscan) and
+# make_taxonomy_table.py (DIAMOND). Results are cached under a key made from
+# the md5 of the assembly and the prodigal parameters, so the same assembly
+# is only called once however many stages ask for its ORFs. Each stage gets
+# its usual output file names as links to the cached files.
+#
+# In metagenomic mode prodigal calls genes on each contig independently, so
+# with several processors the assembly is split into length-balanced shards
+# that are called concurrently. The shard outputs are merged back into
+# assembly order with sequence numbers (seqnum=, ID=<seqnum>_<n>) renumbered,
+# giving the same files as a single prodigal run.
+
+import os
+import re
+import heapq
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import taxonomy_db
+
+PRODIGAL_ARGS = ['-p', 'meta', '-m']
+
+# Sequence numbers in the .faa headers and gene coordinate (GenBank) output
+FAA_ID = re.compile(r'( # ID=)(\d+)_')
+GBK_SEQNUM = re.compile(r'^(DEFINITION  seqnum=)(\d+);')
+GBK_ID = re.compile(r'(/note="ID=)(\d+)_')
+
+def orfs_key(assembly_fpath, cache_dir, prodigal_args=PRODIGAL_ARGS):
+    "Returns the cache key for ORFs called from the assembly with prodigal_args"
+    # Assembly checksums are remembered in the cache manifest by size and mtime
+    assembly_md5 = taxonomy_db.dump_key([assembly_fpath], cache_dir)
+    return(hashlib.md5(assembly_md5 + ' ' + ' '.join(prodigal_args)).hexdigest())
+
+def link_output(src, dst):
+    "Makes dst a hard link to src, or a copy if they are on different file systems"
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def read_fasta_lengths(fasta_fpath):
+    "Returns the length of each sequence of the fasta file, in order"
+    lengths = []
+    with open(fasta_fpath) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.strip())
+    return(lengths)
+
+def balanced_shards(lengths, num_shards):
+    """
+    Returns lists of sequence indices (each in assembly order) splitting the
+    sequences into num_shards shards of similar total length, assigning the
+    longest sequences first to the shard with the least sequence so far
+    """
+    shards = [[] for i in range(num_shards)]
+    heap = [(0, shard) for shard in range(num_shards)]
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (total + lengths[index], shard))
+    return([sorted(shard) for shard in shards if shard])
+
+def contiguous_shards(lengths, num_shards):
+    """
+    Returns lists of sequence indices splitting the sequences into up to
+    num_shards runs of consecutive sequences of similar total length, so
+    outputs of the shards concatenated in order follow the input order
+    """
+    total = sum(lengths)
+    # Index of the first sequence of each shard
+    starts = [0]
+    residues = 0
+    for index, length in enumerate(lengths):
+        if len(starts) < num_shards and index > starts[-1] and residues >= total * len(starts) / float(num_shards):
+            starts.append(index)
+        residues += length
+    ends = starts[1:] + [len(lengths)]
+    return([range(start, end) for start, end in zip(starts, ends)])
+
+def write_shards(fasta_fpath, shards, shard_fpaths):
+    "Writes the sequences of each shard to its fasta file"
+    shard_of = {}
+    for shard, indices in enumerate(shards):
+        for index in indices:
+            shard_of[index] = shard
+    outfiles = [open(fpath, 'w') for fpath in shard_fpaths]
+    index = -1
+    with open(fasta_fpath) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                index += 1
+            if index >= 0:
+                outfiles[shard_of[index]].write(line)
+    for outfile in outfiles:
+        outfile.close()
+
+def renumbered_records(fpath, indices, record_start, patterns):
+    """
+    Yields (assembly seqnum, record number, text) for each record of a shard
+    output. Records begin at lines matching record_start and their shard
+    seqnums are replaced by assembly seqnums (1-based, from indices)
+    """
+    def renumber(match):
+        return('{}{}{}'.format(match.group(1), indices[int(match.group(2)) - 1] + 1, match.group(0)[len(match.group(1)) + len(match.group(2)):]))
+    record = []
+    seqnum = None
+    count = 0
+    with open(fpath) as fh:
+        for line in fh:
+            if record_start.search(line):
+                if record:
+                    yield((seqnum, count, ''.join(record)))
+                    count += 1
+                seqnum = indices[int(record_start.search(line).group(2)) - 1] + 1
+                record = []
+            for pattern in patterns:
+                line = pattern.sub(renumber, line)
+            record.append(line)
+    if record:
+        yield((seqnum, count, ''.join(record)))
+
+def merge_outputs(shard_fpaths, shards, out_fpath, record_start, patterns):
+    "Merges shard outputs into assembly order, renumbering sequences"
+    records = [renumbered_records(fpath, indices, record_start, patterns)
+        for fpath, indices in zip(shard_fpaths, shards)]
+    with open(out_fpath, 'w') as outfile:
+        for seqnum, count, text in heapq.merge(*records):
+            outfile.write(text)
+
+def run_prodigal(assembly_fpath, faa_fpath, txt_fpath, prodigal_args=PRODIGAL_ARGS, num_processors=1):
+    """
+    Runs prodigal on the assembly. In metagenomic mode with several processors,
+    runs it on up to num_processors length-balanced shards at once
+    """
+    num_shards = 1
+    if num_processors > 1 and 'meta' in prodigal_args:
+        lengths = read_fasta_lengths(assembly_fpath)
+        num_shards = min(num_processors, len(lengths))
+    if num_shards <= 1:
+        command = ['prodigal', '-i', assembly_fpath, '-a', faa_fpath] + list(prodigal_args) + ['-o', txt_fpath]
+        print('Calling ORFs: ' + ' '.join(command))
+        exit_code = subprocess.call(command)
+        if exit_code != 0:
+            raise RuntimeError('prodigal failed with exit code {}'.format(exit_code))
+        return
+
+    shard_dir = tempfile.mkdtemp(prefix='prodigal_shards.', dir=os.path.dirname(faa_fpath))
+    try:
+        shards = balanced_shards(lengths, num_shards)
+        shard_prefixes = [os.path.join(shard_dir, 'shard{}'.format(i)) for i in range(len(shards))]
+        write_shards(assembly_fpath, shards, [prefix + '.fasta' for prefix in shard_prefixes])
+        print('Calling ORFs in {} shards of {}'.format(len(shards), assembly_fpath))
+        procs = []
+        for prefix in shard_prefixes:
+            command = ['prodigal', '-i', prefix + '.fasta', '-a', prefix + '.faa'] + list(prodigal_args) + ['-o', prefix + '.txt']
+            with open(prefix + '.log', 'w') as log:
+                procs.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT))
+        failed = [prefix for prefix, proc in zip(shard_prefixes, procs) if proc.wait() != 0]
+        if failed:
+            with open(failed[0] + '.log') as log:
+                print(log.read())
+            raise RuntimeError('prodigal failed on {} of {} shards'.format(len(failed), len(shards)))
+        merge_outputs([prefix + '.faa' for prefix in shard_prefixes], shards, faa_fpath, FAA_ID, [FAA_ID])
+        merge_outputs([prefix + '.txt' for prefix in shard_prefixes], shards, txt_fpath, GBK_SEQNUM, [GBK_SEQNUM, GBK_ID])
+    finally:
+        shutil.rmtree(shard_dir)
+
+def cached_orfs(assembly_fpath, cache_dir, prodigal_args=PRODIGAL_ARGS, num_processors=1):
+    "Returns the cached (.faa, gene coordinates) paths for the assembly, running prodigal if they are missing"
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key = orfs_key(assembly_fpath, cache_dir, prodigal_args)
+    faa_fpath = os.path.join(cache_dir, key + '.orfs.faa')
+    txt_fpath = os.path.join(cache_dir, key + '.txt')
+    if os.path.isfile(faa_fpath) and os.path.isfile(txt_fpath):
+        print('Using cached ORFs {}'.format(faa_fpath))
+        return(faa_fpath, txt_fpath)
+    # Written under temporary names so an interrupted run is never cached
+    tmp_faa = faa_fpath + '.{}.tmp'.format(os.getpid())
+    tmp_txt = txt_fpath + '.{}.tmp'.format(os.getpid())
+    try:
+        run_prodigal(assembly_fpath, tmp_faa, tmp_txt, prodigal_args, num_processors)
+    except:
+        for fpath in [tmp_faa, tmp_txt]:
+            if os.path.isfile(fpath):
+                os.remove(fpath)
+        raise
+    os.rename(tmp_txt, txt_fpath)
+    os.rename(tmp_faa, faa_fpath)
+    return(faa_fpath, txt_fpath)
+
+def call_orfs(assembly_fpath, faa_fpath, txt_fpath=None, cache_dir=None, prodigal_args=PRODIGAL_ARGS, num_processors=1):
+    """
+    Writes the ORFs of the assembly to faa_fpath (and prodigal's gene
+    coordinates to txt_fpath), from the cache in cache_dir if they have been
+    called before. The default cache is orfs_cache next to faa_fpath
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(faa_fpath)), 'orfs_cache')
+    cached_faa, cached_txt = cached_orfs(os.path.abspath(assembly_fpath), cache_dir, prodigal_args, num_processors)
+    link_output(cached_faa, faa_fpath)
+    if txt_fpath:
+        link_output(cached_txt, txt_fpath)
+    return(faa_fpath)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calls ORFs in an assembly with prodigal, reusing earlier results for the same assembly')
+    parser.add_argument('-a', '--assembly', metavar='<assembly.fasta>', help='Assembly to call ORFs in', required=True)
+    parser.add_argument('-o', '--orfs', metavar='<orfs.faa>', help='Path of the ORF protein fasta', required=True)
+    parser.add_argument('-g', '--genes', metavar='<genes.txt>', help='Path of the prodigal gene coordinates output')
+    parser.add_argument('-c', '--cache_dir', metavar='<dir>', help='ORF cache directory (default: orfs_cache next to the ORF fasta)')
+    parser.add_argument('-p', '--processors', metavar='<int>', help='Number of prodigal processes to run on shards of the assembly', type=int, default=1)
+    args = vars(parser.parse_args())
+    try:
+        print(call_orfs(args['assembly'], args['orfs'], args['genes'], args['cache_dir'], num_processors=args['processors']))
+    except RuntimeError as err:
+        exit(str(err))
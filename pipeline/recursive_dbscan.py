@@ -34,6 +34,9 @@ from sklearn import decomposition
 import os
 #import statistics
 import argparse
+import contig_tables
+import stage_cache
+import assembly_scan
 import logging
 
 def run_BH_tSNE(table, do_pca=True):
@@ -340,11 +343,14 @@ def normalizeKmers(count_matrix): # list of lists, not a np matrix
 	return k_mer_frequency_matrix
 
 parser = argparse.ArgumentParser(description="Perform initial clustering via BH-tSNE and DBSCAN.")
-parser.add_argument('-t','--input_table', help='Master contig table. Optionally can contain taxonomy data', required=True)
+parser.add_argument('-t','--input_table', help='Master contig table (tab separated, .feather or .parquet). Optionally can contain taxonomy data', required=True)
 parser.add_argument('-a','--assembly_fasta', help='Assembly fasta', required=True)
 #parser.add_argument('-o','--output_table', help='Path to output table', required=True)
 parser.add_argument('-d','--output_dir', help='Path to output directory', default='.')
 parser.add_argument('-k','--kingdom', help='Kingdom to consider (archaea|bacteria)', choices=['bacteria','archaea'], default = 'bacteria')
+parser.add_argument('-m','--k_mer_matrix', help='K-mer matrix from assembly_scan.py covering (at least) the assembly contigs. Counted from the assembly if not given')
+parser.add_argument('--stage_cache', help='Directory shared between runs for the k-mer matrix and BH-tSNE output')
+parser.add_argument('--adopt_existing', help='Keep a k-mer matrix or BH-tSNE output made by an older version instead of making it again', action='store_true')
 
 args = vars(parser.parse_args())
 
@@ -353,6 +359,8 @@ input_fasta_path = args['assembly_fasta']
 output_dir_path = args['output_dir']
 output_table_path = output_dir_path + '/recursive_dbscan_output.tab'
 domain = args['kingdom']
+stage_cache_dir = args['stage_cache']
+stage_cache.adopt_existing = args['adopt_existing']
 
 #logger
 logger = logging.getLogger('recursive_dbscan.py')
@@ -365,7 +373,7 @@ console.setFormatter(formatter)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(console)
 
-input_master_table = pd.read_csv(input_table_path, sep='\t')
+input_master_table = contig_tables.read_table(input_table_path)
 input_master_table['bh_tsne_x'] = 0
 input_master_table['bh_tsne_y'] = 0
 
@@ -398,62 +406,30 @@ for k_mer in all_k_mers:
 		unique_k_mers[k_mer] = count
 		count += 1
 
-if os.path.isfile(matrix_file):
-	logger.info("K-mer matrix already exists!")
-	logger.info("Continuing to next step...")
-
-	# Now we load the k-mer matrix
-	with open(matrix_file) as matrix:
-		for i,line in enumerate(matrix):
-			if i > 0:
-				line_list = line.rstrip().split('\t')
-				contig = line_list.pop(0)
-				line_list = [ int(x) for x in line_list ]
-				k_mer_dict[contig] = line_list
+if args['k_mer_matrix']:
+	matrix_file = args['k_mer_matrix']
+	logger.info("Using k-mer matrix {}".format(matrix_file))
 else:
-	# Count k-mers
-	# First we make a dictionary of all the possible k-mers (discounting revcomps)
-	# Under each key is an index to be used in the subsequent lists
-	# The order of the indices depends on the order k-mers were encountered while making the dictionary
-	logger.info('Counting k-mers')
-
-	for contig_name in assembly_seqs:
-		contig_seq = str(assembly_seqs[contig_name].seq)
-		# Initialize the list for the contig to be all 1s - as we can't have zero values in there for CLR later
-		list_size = len(unique_k_mers.keys())
-		current_contig_k_mer_counts = [1 for k in range(0, list_size)]
-
-		for j in range(0, (len(contig_seq) - k_mer_size)):
-			k_mer = contig_seq[j:j + k_mer_size]
-			k_mer_reverse = revcomp(k_mer)
-
-			# Find appropriate index
-			# Note - this part naturally ignores any k_mers with weird characters
-			if k_mer in unique_k_mers:
-				index = unique_k_mers[k_mer]
-				current_contig_k_mer_counts[index] += 1
-			elif k_mer_reverse in unique_k_mers:
-				index = unique_k_mers[k_mer_reverse]
-				current_contig_k_mer_counts[index] += 1
-
-		k_mer_dict[contig_name] = current_contig_k_mer_counts
-
-	# Write the file in case we have to do this again
-	matrix = open(matrix_file, 'w')
-
-	# The first line consists of the k-mer headings (left corner is blank because the contig names are listed under it)
-	header_line_list = [''] + sorted(unique_k_mers, key=unique_k_mers.__getitem__)
-	header_line = '\t'.join(header_line_list)
-	matrix.write(header_line + '\n')
-
-	for contig in k_mer_dict:
-		line_list = k_mer_dict[contig]
-		output_list = [contig] + line_list
-		for i, item in enumerate(output_list):
-			output_list[i] = str(item)
-		output_line = '\t'.join(output_list)
-		matrix.write(output_line + '\n')
-	matrix.close()
+	# Reused while the assembly and the k-mer counting are unchanged
+	k_mer_stage = stage_cache.Stage([matrix_file], [input_fasta_path] + stage_cache.scripts('assembly_scan.py'),
+		{'k_mer_size':k_mer_size}, cache_dir=stage_cache_dir)
+	if k_mer_stage.restore():
+		logger.info("K-mer matrix is up to date!")
+		logger.info("Continuing to next step...")
+	else:
+		# Counted in the same order of k-mers as unique_k_mers
+		logger.info('Counting k-mers')
+		assembly_scan.scan_assembly(input_fasta_path, matrix_fpath=matrix_file, k_mer_size=k_mer_size)
+		k_mer_stage.save()
+
+# Now we load the k-mer matrix, which may also hold contigs outside the assembly
+with open(matrix_file) as matrix:
+	for i,line in enumerate(matrix):
+		if i > 0:
+			line_list = line.rstrip().split('\t')
+			contig = line_list.pop(0)
+			if contig in assembly_seqs:
+				k_mer_dict[contig] = [ int(x) for x in line_list ]
 
 ### Collate training data for ML steps later
 # We now set up global data structures to be used in supervised machine learning
@@ -481,8 +457,10 @@ taxonomy_matrix = list()
 
 BH_tSNE_output_file = output_dir_path + '/BH_tSNE_output.tab'
 
-if os.path.isfile(BH_tSNE_output_file):
-	logger.info("BH_tSNE output already exists!")
+BH_tSNE_stage = stage_cache.Stage([BH_tSNE_output_file], [input_table_path, input_fasta_path, matrix_file] +\
+	stage_cache.scripts('recursive_dbscan.py', 'contig_tables.py'), cache_dir=stage_cache_dir)
+if BH_tSNE_stage.restore():
+	logger.info("BH_tSNE output is up to date!")
 	logger.info("Continuing to next step...")
 
 	# Now we load the file
@@ -493,6 +471,7 @@ else:
 
 	# Write file to disk
 	master_table.to_csv(path_or_buf=BH_tSNE_output_file, sep='\t', index=False, quoting=csv.QUOTE_NONE)
+	BH_tSNE_stage.save()
 
 	master_table['cluster'] = 'unclustered'
 
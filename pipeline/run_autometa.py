@@ -24,6 +24,9 @@ import logging
 import os
 import platform
 import shutil
+import contig_tables
+import stage_cache
+import assembly_scan
 
 from multiprocessing import cpu_count
 from argparse import ArgumentParser
@@ -103,9 +106,10 @@ def cythonize_lca_functions():
 def lca_compilation_check():
 	lca_funcs_so = os.path.join(pipeline_path, 'lca_functions.so')
 	lca_fp = os.path.join(pipeline_path, 'lca.py')
+	lca_funcs_pyx = os.path.join(pipeline_path, 'lca_functions.pyx')
 	if not os.path.isfile(lca_funcs_so):
 		cythonize_lca_functions()
-	elif os.path.getmtime(lca_funcs_so) < os.path.getmtime(lca_fp):
+	elif os.path.getmtime(lca_funcs_so) < max(os.path.getmtime(lca_fp), os.path.getmtime(lca_funcs_pyx)):
 		print('lca.py updated. Recompiling lca functions.')
 		build_dir = os.path.join(pipeline_path, 'build')
 		lca_funcs_c = lca_funcs_so.replace('.so','.c')
@@ -116,36 +120,51 @@ def lca_compilation_check():
 	else:
 		print('lca_functions up-to-date')
 
+def call_orfs(fasta):
+	"""Calls ORFs in the filtered assembly once for both the marker and taxonomy tables"""
+	global orfs_path
+	if orfs_path is None:
+		orfs_path = output_dir + '/' + os.path.basename(fasta) + '.orfs.faa'
+		logger.info('Calling ORFs in {}'.format(fasta))
+		run_command("{}/orf_calling.py -a {} -o {} -g {} -p {}".format(pipeline_path, fasta, orfs_path,
+			output_dir + '/' + os.path.basename(fasta) + '.txt', processors))
+	return orfs_path
+
 def run_make_taxonomy_tab(fasta, length_cutoff):
 	"""Runs make_taxonomy_table.py and directs output to taxonomy.tab for run_autometa.py"""
-	# Note we don't have to supply the cov_table here because earlier in this script we already run make_contig_table.py
+	# The cov_table is passed so make_taxonomy_table.py finds the contig table made by scan_assembly current
 	output_path = output_dir + '/taxonomy.tab'
+	# make_taxonomy_table.py filters the assembly with the same length cutoff, so it can use the same ORFs
+	orfs = call_orfs(filtered_assembly)
+	cmd = "{}/make_taxonomy_table.py -a {} -db {} -p {} -l {} -o {} --orfs {}".\
+		format(pipeline_path, fasta, db_dir_path, processors, length_cutoff, output_dir, orfs)
 	if cov_table:
-		run_command("{}/make_taxonomy_table.py -a {} -db {} -p {} -l {} -o {} -v {}".\
-			format(pipeline_path, fasta, db_dir_path, processors, length_cutoff, output_dir, cov_table))
-	else:
-		run_command("{}/make_taxonomy_table.py -a {} -db {} -p {} -l {} -o {}".\
-			format(pipeline_path, fasta, db_dir_path, processors, length_cutoff, output_dir))
+		cmd += " -v {}".format(cov_table)
+	if stage_cache_dir:
+		cmd += " --stage_cache {}".format(stage_cache_dir)
+	if stage_cache.adopt_existing:
+		cmd += " --adopt_existing"
+	run_command(cmd)
 	return output_path
 
-def length_trim(fasta,length_cutoff):
-	#will need to update path of this perl script
+def scan_assembly(fasta, length_cutoff, coverage_table=None):
+	# Writes the filtered assembly, its contig table and k-mer matrix in one pass over the assembly
 	outfile_name, ext = os.path.splitext(os.path.basename(fasta))
-	outfile_name += ".filtered" + ext
-	output_path = output_dir + '/' + outfile_name
-	run_command("{}/fasta_length_trim.pl {} {} {}".format(pipeline_path, fasta, length_cutoff,output_path))
-	return output_path
-
-def make_contig_table(fasta, coverage_table=None):
-	# Fasta is an absolute path
-	output_filename, _ = os.path.splitext(os.path.basename(fasta))
-	output_filename += '.tab'
-	output_path = output_dir + '/' + output_filename
-	if coverage_table:
-		run_command("{}/make_contig_table.py -a {} -c {} -o {}".format(pipeline_path,fasta,coverage_table,output_path))
-	else:
-		run_command("{}/make_contig_table.py -a {} -o {}".format(pipeline_path,fasta,output_path))
-	return output_path
+	filtered_path = output_dir + '/' + outfile_name + '.filtered' + ext
+	contig_table_path = output_dir + '/' + outfile_name + '.filtered.tab'
+	k_mer_matrix_path = output_dir + '/k-mer_matrix'
+	stage = stage_cache.assembly_scan_stage(fasta, length_cutoff, coverage_table, False, filtered_path,
+		contig_table_path, k_mer_matrix_path, stage_cache_dir)
+	if not stage.restore():
+		logger.info('Filtering {} to contigs of at least {} bp'.format(fasta, length_cutoff))
+		try:
+			assembly_scan.scan_assembly(fasta, length_cutoff, filtered_path, contig_table_path, k_mer_matrix_path,
+				coverage_table, num_processors=processors)
+		except ValueError as err:
+			print('run_autometa.py: Error, {}'.format(err))
+			exit(1)
+		stage.save()
+	return filtered_path, contig_table_path, k_mer_matrix_path
 
 def make_marker_table(fasta):
 	if kingdom == 'bacteria':
@@ -159,59 +178,41 @@ def make_marker_table(fasta):
 	output_fname, _ = os.path.splitext(os.path.basename(fasta))
 	output_fname += '.marker.tab'
 	output_path = output_dir + '/' + output_fname
-	if os.path.isfile(output_path):
-		print "{} file already exists!".format(output_path)
-		print "Continuing to next step..."
-		logger.info('{} file already exists!'.format(output_path))
-		logger.info('Continuing to next step...')
+	stage = stage_cache.Stage([output_path], [fasta, hmm_marker_path, hmm_cutoffs_path] +\
+		stage_cache.scripts('make_marker_table.py', 'marker_search.py', 'hmmer_tables.py', 'orf_calling.py'),
+		tools=[['prodigal', '-v'], ['hmmsearch', '-h']], cache_dir=stage_cache_dir)
+	if stage.restore():
+		logger.info('{} is up to date, continuing to next step...'.format(output_path))
 	else:
-		print "Making the marker table with prodigal and hmmscan. This could take a while..."
-		logger.info('Making the marker table with prodigal and hmmscan. This could take a while...')
-		run_command_quiet("hmmpress -f {}".format(hmm_marker_path))
-		run_command_quiet("{}/make_marker_table.py -a {} -m {} -c {} -o {} -p {}"\
-		.format(pipeline_path, fasta, hmm_marker_path, hmm_cutoffs_path, output_path, processors))
+		print "Making the marker table with prodigal and hmmsearch. This could take a while..."
+		logger.info('Making the marker table with prodigal and hmmsearch. This could take a while...')
+		run_command_quiet("{}/make_marker_table.py -a {} -m {} -c {} -o {} -p {} --orfs {}"\
+		.format(pipeline_path, fasta, hmm_marker_path, hmm_cutoffs_path, output_path, processors, call_orfs(fasta)))
+		stage.save()
 	return output_path
 
-def recursive_dbscan(input_table, filtered_assembly, domain):
+def recursive_dbscan(input_table, filtered_assembly, domain, k_mer_file):
 	recursive_dbscan_output_path = output_dir + '/recursive_dbscan_output.tab'
-	k_mer_file = output_dir + '/k-mer_matrix'
-	run_command("{}/recursive_dbscan.py -t {} -a {} -d {} -k {}".format(pipeline_path, input_table, filtered_assembly, output_dir, domain))
+	cmd = "{}/recursive_dbscan.py -t {} -a {} -d {} -k {} -m {}".format(pipeline_path, input_table, filtered_assembly, output_dir, domain, k_mer_file)
+	if stage_cache_dir:
+		cmd += " --stage_cache {}".format(stage_cache_dir)
+	if stage_cache.adopt_existing:
+		cmd += " --adopt_existing"
+	run_command(cmd)
 
 	return recursive_dbscan_output_path, k_mer_file
 
 def combine_tables(table1_path, table2_path):
 	comb_table_path = output_dir + '/combined_contig_info.tab'
 	# Note: in this sub we assume that the tables have column 1 in common
-	# Store lines of table 2, keyed by the value of the first column
-
-	# First make data structure from table 2
-	table2_lines = dict()
-	with open(table2_path) as table2:
-		for i, line in enumerate(table2):
-			line_list = line.rstrip().split('\t')
-			contig = line_list.pop(0)
-			if i == 0:
-				table_2_header = '\t'.join(line_list)
-			else:
-				table2_lines[contig] = '\t'.join(line_list)
-
-	comb_table = open(comb_table_path, 'w')
-	with open(table1_path) as table1:
-		for i, line in enumerate(table1):
-			line_list = line.rstrip().split('\t')
-			contig = line_list.pop(0)
-			if i == 0:
-				new_header = line.rstrip() + '\t' + table_2_header + '\n'
-				comb_table.write(new_header)
-			else:
-				# We have to check whether the line exists in table 2
-				if contig in table2_lines:
-					new_line = line.rstrip() + '\t' + table2_lines[contig] + '\n'
-					comb_table.write(new_line)
-
-	comb_table.close()
-
-	return comb_table_path
+	# Rows of table 1 found in table 2 are streamed to the combined table, which is
+	# also written in the columnar format given by --table_format for recursive_dbscan.py
+	comb_table_paths = [comb_table_path]
+	if table_format != 'tsv':
+		comb_table_paths.append(output_dir + '/combined_contig_info.' + table_format)
+	contig_tables.combine_tables(table1_path, table2_path, comb_table_paths)
+
+	return comb_table_paths[-1]
 
 def ML_recruitment(input_table, matrix):
 	ML_recruitment_output_path = output_dir + '/ML_recruitment_output.tab'
@@ -238,7 +239,11 @@ parser.add_argument('-r', '--ML_recruitment', help='Use ML to further recruit un
 parser.add_argument('-m', '--maketaxtable', action='store_true',\
 help='runs make_taxonomy_table.py before performing autometa binning. Must specify databases directory (-db)')
 parser.add_argument('-db', '--db_dir', metavar='<dir>', help="Path to directory with taxdump files. If this doesn't exist, the files will be automatically downloaded", required=False, default=autometa_path + '/databases')
+parser.add_argument('-f', '--table_format', metavar='<tsv|feather|parquet>', help='Format of the combined contig table passed to recursive_dbscan.py. Columnar formats require pyarrow',\
+choices=['tsv','feather','parquet'], default='tsv')
 parser.add_argument('-v', '--cov_table', metavar='<coverage.tab>', help="Path to coverage table made by calculate_read_coverage.py. If this is not specified then coverage information will be extracted from contig names (SPAdes format)", required=False)
+parser.add_argument('--stage_cache', metavar='<dir>', help='Directory shared between runs for stage outputs. Stages whose inputs, parameters and tool versions match a finished run link its outputs instead of running again')
+parser.add_argument('--adopt_existing', help='Keep outputs in the output directory made by an older version instead of making them again. Their inputs, parameters and tool versions are not checked', action='store_true')
 
 args = vars(parser.parse_args())
 
@@ -253,6 +258,13 @@ do_ML_recruitment = args['ML_recruitment']
 make_tax_table = args['maketaxtable']
 db_dir_path = os.path.abspath(args['db_dir'])
 cov_table = args['cov_table']
+table_format = args['table_format']
+stage_cache_dir = args['stage_cache']
+if stage_cache_dir:
+	stage_cache_dir = os.path.abspath(stage_cache_dir)
+stage_cache.adopt_existing = args['adopt_existing']
+# ORFs of the filtered assembly, called when first needed (see call_orfs)
+orfs_path = None
 
 # Make output directory if it doesn't exist
 if not os.path.isdir(output_dir):
@@ -281,12 +293,8 @@ logger.info('Input command: ' + ' '.join(sys.argv))
 start_time = time.time()
 FNULL = open(os.devnull, 'w')
 
-#run length trim and store output name
-filtered_assembly = length_trim(fasta_assembly, length_cutoff)
-if cov_table:
-	contig_table = make_contig_table(filtered_assembly, cov_table)
-else:
-	contig_table = make_contig_table(filtered_assembly)
+#run length trim and store output names
+filtered_assembly, contig_table, k_mer_matrix = scan_assembly(fasta_assembly, length_cutoff, cov_table)
 marker_tab_path = make_marker_table(filtered_assembly)
 
 # Ensure lca functions are compiled and up-to-date
@@ -295,21 +303,15 @@ lca_compilation_check()
 # Make combined table
 if taxonomy_table_path and not make_tax_table:
 	combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
-elif taxonomy_table_path and make_tax_table:
-	if not os.path.isfile(taxonomy_table_path):
-		print "Could not find {}, running make_taxonomy_table.py".format(taxonomy_table_path)
-		logger.debug('Could not find {}, running make_taxonomy_table.py'.format(taxonomy_table_path))
-		taxonomy_table_path = run_make_taxonomy_tab(fasta_assembly, length_cutoff)
-		combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
-	elif os.path.isfile(taxonomy_table_path) and os.stat(taxonomy_table_path).st_size == 0:
-		print "{} file is empty, running make_taxonomy_table.py".format(taxonomy_table_path)
-		logger.debug('{} file is empty, running make_taxonomy_table.py'.format(taxonomy_table_path))
-		taxonomy_table_path = run_make_taxonomy_tab(fasta_assembly, length_cutoff)
-		combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
-	else:
-		print "{} already exists, not performing make_taxonomy_table.py".format(taxonomy_table_path)
-		combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
-elif not taxonomy_table_path and make_tax_table:
+elif args['taxonomy_table'] and os.path.isfile(taxonomy_table_path) and os.stat(taxonomy_table_path).st_size > 0:
+	# A taxonomy table given with -t is used as it is
+	print "{} already exists, not performing make_taxonomy_table.py".format(taxonomy_table_path)
+	combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
+elif make_tax_table:
+	if args['taxonomy_table']:
+		print "Could not find {} or it is empty, running make_taxonomy_table.py".format(taxonomy_table_path)
+		logger.debug('Could not find {} or it is empty, running make_taxonomy_table.py'.format(taxonomy_table_path))
+	# make_taxonomy_table.py skips the stages whose outputs are still current
 	taxonomy_table_path = run_make_taxonomy_tab(fasta_assembly, length_cutoff)
 	combined_table_path = combine_tables(taxonomy_table_path, marker_tab_path)
 else:
@@ -328,7 +330,7 @@ if make_tax_table:
 	# Now change the input fasta to the output of make_taxonomy_table.py
 	filtered_assembly = expected_kingdom_bin_path
 
-recursive_dbscan_output, matrix_file = recursive_dbscan(combined_table_path, filtered_assembly, kingdom)
+recursive_dbscan_output, matrix_file = recursive_dbscan(combined_table_path, filtered_assembly, kingdom, k_mer_matrix)
 
 if do_ML_recruitment:
 	ML_recruitment(recursive_dbscan_output, matrix_file)
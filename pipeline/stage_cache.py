@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Decides whether pipeline stages can be skipped. Each stage's outputs are
+# recorded in a manifest (.stages/stages.json in the output directory) under
+# a key made from the md5s of its input files (including the scripts that
+# run it), its parameters, the versions of the tools it calls and the
+# identity of the databases it reads. A stage is skipped only while its
+# outputs exist unchanged under the same key, so changing e.g. the length
+# cutoff or a database reruns it and everything downstream of it.
+#
+# Outputs already in the output directory that the manifest has never seen
+# (made before stages were recorded) cannot be checked against the current
+# inputs, parameters and tool versions, so they are made again. With
+# --adopt_existing (adopt_existing below) they are instead adopted under the
+# current key, as long as none of them is empty.
+#
+# With a shared cache directory, finished outputs are also kept under
+# <cache_dir>/<key>/ and linked into the output directory of any later run
+# that has the same key.
+
+import os
+import json
+import hashlib
+import platform
+import subprocess
+import orf_calling
+import taxonomy_db
+
+PIPELINE = os.path.dirname(os.path.realpath(__file__))
+STATE_DIRNAME = '.stages'
+
+# Set from the --adopt_existing option of the scripts running stages
+adopt_existing = False
+
+def scripts(*fnames):
+    "Returns the paths of pipeline scripts, to make them inputs of the stages they run"
+    return([os.path.join(PIPELINE, fname) for fname in fnames])
+
+# Tool version strings, looked up once per process
+tool_versions = {}
+
+def tool_version(command):
+    "Returns what a tool prints for its version (or help) command, e.g. ['diamond', 'version']"
+    command = tuple(command)
+    if command not in tool_versions:
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except OSError:
+            output = 'not found'
+        except subprocess.CalledProcessError as err:
+            output = err.output
+        tool_versions[command] = output.strip()
+    return(tool_versions[command])
+
+def database_identity(fpath):
+    # Databases (nr.dmnd, prot.accession2taxid) are too large to hash on
+    # every update, so they are identified by path, size and mtime
+    if fpath is None or not os.path.exists(fpath):
+        return(None)
+    realpath = os.path.realpath(fpath)
+    stat = os.stat(realpath)
+    return([realpath, stat.st_size, int(stat.st_mtime)])
+
+def read_json(fpath):
+    if not os.path.isfile(fpath):
+        return({})
+    with open(fpath) as fh:
+        return(json.load(fh))
+
+def write_json(fpath, data):
+    tmp_fpath = fpath + '.{}.{}.tmp'.format(platform.node(), os.getpid())
+    with open(tmp_fpath, 'w') as fh:
+        json.dump(data, fh, indent=1, sort_keys=True)
+    os.rename(tmp_fpath, fpath)
+
+class Stage(object):
+    """
+    A pipeline stage writing outputs from inputs. Call restore() before
+    running it and save() once it has written its outputs:
+
+        stage = Stage(outputs, inputs, params, tools)
+        if not stage.restore():
+            run the stage
+            stage.save()
+    """
+
+    def __init__(self, outputs, inputs=(), params=None, tools=(), databases=(), cache_dir=None):
+        self.outputs = [os.path.abspath(fpath) for fpath in outputs]
+        self.state_dir = os.path.join(os.path.dirname(self.outputs[0]), STATE_DIRNAME)
+        self.manifest_fpath = os.path.join(self.state_dir, 'stages.json')
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        # Input md5s are remembered by size and mtime in the state directory
+        input_fpaths = [fpath for fpath in inputs if fpath]
+        description = {
+            'outputs':[os.path.basename(fpath) for fpath in self.outputs],
+            'inputs':taxonomy_db.dump_key(input_fpaths, self.state_dir),
+            'params':params or {},
+            'tools':[tool_version(command) for command in tools],
+            'databases':[database_identity(fpath) for fpath in databases]}
+        self.key = hashlib.md5(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def is_current(self):
+        "Returns whether every output exists as recorded under this stage's key"
+        manifest = read_json(self.manifest_fpath)
+        for fpath in self.outputs:
+            entry = manifest.get(fpath)
+            if not entry or entry['key'] != self.key or not os.path.isfile(fpath) or os.path.getsize(fpath) != entry['size']:
+                return(False)
+        return(True)
+
+    def cached_fpath(self, fpath):
+        return(os.path.join(self.cache_dir, self.key, os.path.basename(fpath)))
+
+    def is_legacy(self):
+        "Returns whether every output exists, is not empty and has never been recorded in the manifest"
+        manifest = read_json(self.manifest_fpath)
+        return(all(fpath not in manifest and os.path.isfile(fpath) and os.path.getsize(fpath) > 0
+            for fpath in self.outputs))
+
+    def restore(self):
+        """
+        Returns True if the outputs are current or adopted from an earlier
+        run, linking them from the shared cache if they are there. Otherwise
+        removes any stale outputs, so the stage writes new files rather than
+        into ones linked to the cache, and marks them as pending until save()
+        """
+        if self.is_current():
+            print('{} up to date, skipping'.format(', '.join(self.outputs)))
+            return(True)
+        if self.is_legacy():
+            if adopt_existing:
+                self.record()
+                print('{} made before stages were recorded, adopting as up to date without checking their inputs, '
+                    'parameters or tool versions'.format(', '.join(self.outputs)))
+                return(True)
+            print('Warning: {} made before stages were recorded. Their inputs, parameters (e.g. the length cutoff), '
+                'tool versions and databases cannot be checked, so they are made again. Use --adopt_existing to keep '
+                'them instead'.format(', '.join(self.outputs)))
+        cached = self.cache_dir and os.path.isfile(os.path.join(self.cache_dir, self.key, 'done'))
+        for fpath in self.outputs:
+            if os.path.isfile(fpath):
+                os.remove(fpath)
+        if not cached:
+            # Outputs left by a run that fails before save() are then never adopted
+            self.record(pending=True)
+            return(False)
+        for fpath in self.outputs:
+            orf_calling.link_output(self.cached_fpath(fpath), fpath)
+        self.record()
+        print('{} restored from {}'.format(', '.join(self.outputs), os.path.join(self.cache_dir, self.key)))
+        return(True)
+
+    def record(self, pending=False):
+        manifest = read_json(self.manifest_fpath)
+        for fpath in self.outputs:
+            manifest[fpath] = {'key':self.key, 'size':None if pending else os.path.getsize(fpath)}
+        write_json(self.manifest_fpath, manifest)
+
+    def save(self):
+        "Records the outputs as current, and keeps them in the shared cache if there is one"
+        self.record()
+        if not self.cache_dir:
+            return
+        key_dir = os.path.join(self.cache_dir, self.key)
+        if not os.path.isdir(key_dir):
+            os.makedirs(key_dir)
+        for fpath in self.outputs:
+            orf_calling.link_output(fpath, self.cached_fpath(fpath))
+        # Marks the cached outputs complete
+        write_json(os.path.join(key_dir, 'done'), {'outputs':[os.path.basename(fpath) for fpath in self.outputs]})
+
+# Stage run by both run_autometa.py and make_taxonomy_table.py into the same
+# output directory, defined once so both give its outputs the same key
+
+def assembly_scan_stage(fasta_fpath, length_cutoff, coverage_table, no_coverage, filtered_fpath, table_fpath,
+        matrix_fpath, cache_dir=None):
+    return(Stage([filtered_fpath, table_fpath, matrix_fpath], [fasta_fpath, coverage_table] + scripts('assembly_scan.py'),
+        {'length_cutoff':length_cutoff, 'coverage_table':bool(coverage_table), 'no_coverage':no_coverage},
+        cache_dir=cache_dir))
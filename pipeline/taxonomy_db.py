@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Compiles the NCBI taxdump (nodes.dmp, names.dmp, merged.dmp) into arrays
+# indexed by taxid, shared by lca.py, add_contig_taxonomy.py and
+# cluster_taxonomy.py. The arrays are saved as .npy files under a directory
+# named by the md5 of the dump files and memory-mapped on later loads.
+# File checksums are remembered against their size and modification time
+# in a manifest, so the dump is only re-read when it changes.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from time import strftime
+
+canonical_ranks = ['superkingdom','phylum','class','order','family','genus','species']
+
+# Order in which ranks are voted on, lowest first
+rank_priority = ['species','genus','family','order','class','phylum','superkingdom','root']
+
+ARRAYS = ['parent', 'rank_code', 'depth', 'name_offsets', 'name_pool', 'merged', 'lineage']
+
+# Number of taxids whose lineage names are kept by Taxonomy.lineage_names
+LINEAGE_CACHE_SIZE = 100000
+
+class LRUCache(object):
+    "Mapping that holds at most maxsize items, evicting the least recently used"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return(key in self.items)
+
+    def __len__(self):
+        return(len(self.items))
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return(value)
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.maxsize:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+class Taxonomy(object):
+    """
+    Taxonomy arrays, all indexed by taxid:
+    parent        parent taxid (root is its own parent, 0 if not in nodes.dmp)
+    rank_code     index into rank_names (-1 if not in nodes.dmp)
+    depth         number of edges from root
+    name_offsets  scientific name of taxid t is name_pool[name_offsets[t]:name_offsets[t+1]]
+    name_pool     uint8 array of concatenated scientific names
+    merged        new taxid of a merged taxid (0 if not merged)
+    lineage       ancestor at each of canonical_ranks, including the taxid itself
+                  (0 where absent). Root is never an ancestor
+    """
+
+    def __init__(self, arrays, rank_names, key):
+        for array in ARRAYS:
+            setattr(self, array, arrays[array])
+        self.rank_names = rank_names
+        self.key = key
+        self.max_taxid = len(self.parent) - 1
+        self.lineage_cache = LRUCache(LINEAGE_CACHE_SIZE)
+
+    def has_taxid(self, taxid):
+        return(0 < taxid <= self.max_taxid and self.parent[taxid] != 0)
+
+    def rank(self, taxid):
+        "Returns the rank of taxid, or None if it is not in nodes.dmp"
+        if not self.has_taxid(taxid):
+            return(None)
+        return(self.rank_names[self.rank_code[taxid]])
+
+    def name(self, taxid):
+        "Returns the scientific name of taxid, or None if it has none"
+        if not 0 < taxid <= self.max_taxid:
+            return(None)
+        start, end = self.name_offsets[taxid], self.name_offsets[taxid + 1]
+        if start == end:
+            return(None)
+        return(self.name_pool[start:end].tostring())
+
+    def lineage_names(self, taxid):
+        """
+        Returns a tuple of the names of taxid's ancestors at each of
+        canonical_ranks, with 'unclassified' where it has none. Each taxid is
+        resolved once and then served from an LRU cache
+        """
+        taxid = int(taxid)
+        if taxid in self.lineage_cache:
+            return(self.lineage_cache[taxid])
+        names = tuple(self.name(ancestor) if ancestor else 'unclassified'
+            for ancestor in self.lineage[taxid])
+        self.lineage_cache[taxid] = names
+        return(names)
+
+    def resolve_merged(self, taxids):
+        "Returns an array of taxids with merged taxids replaced by their new taxid"
+        taxids = np.asarray(taxids, dtype=np.int64)
+        in_range = (taxids >= 0) & (taxids < len(self.merged))
+        new_taxids = np.zeros(len(taxids), dtype=np.int64)
+        new_taxids[in_range] = self.merged[taxids[in_range]]
+        return(np.where(new_taxids != 0, new_taxids, taxids))
+
+    def parents_dict(self):
+        "Returns {child taxid: parent taxid} for every taxid in nodes.dmp except root"
+        children = np.flatnonzero(self.parent)
+        children = children[children != 1]
+        return(dict(zip(children.tolist(), self.parent[children].tolist())))
+
+def is_consistent(taxid, rank, rank_counts, lineage):
+    """
+    Determines for a given taxid, whether the majority of votes in rank_counts
+    ({rank:{taxid:votes}}), with rank equal to or above the given rank, are
+    for common ancestors of the taxid
+    """
+    ranks_to_consider = rank_priority[rank_priority.index(rank):]
+    taxid_lineage = lineage[taxid]
+    consistent = 0
+    inconsistent = 0
+    for rank_name in ranks_to_consider:
+        if rank_name not in rank_counts:
+            continue
+        for ancestor in rank_counts[rank_name]:
+            # Root is not a canonical rank and so never counts as an ancestor
+            if rank_name in canonical_ranks and taxid_lineage[canonical_ranks.index(rank_name)] == ancestor:
+                consistent += rank_counts[rank_name][ancestor]
+            else:
+                inconsistent += rank_counts[rank_name][ancestor]
+    return(consistent > inconsistent)
+
+def lowest_majority(rank_counts, lineage):
+    "Returns the taxid with a majority of votes over the lineages of rank_counts at the lowest possible rank"
+    taxid_totals = {}
+    for rank in rank_priority:
+        if rank not in rank_counts:
+            continue
+        ranks_to_consider = rank_priority[rank_priority.index(rank):]
+        for taxid in rank_counts[rank]:
+            # Where the path has no taxid at a canonical rank we add 'unclassified',
+            # which must never win
+            taxid_lineage = lineage[taxid]
+            for rank_to_consider in ranks_to_consider:
+                path_taxid = 0
+                if rank_to_consider in canonical_ranks:
+                    path_taxid = int(taxid_lineage[canonical_ranks.index(rank_to_consider)])
+                if not path_taxid:
+                    path_taxid = 'unclassified'
+                if rank_to_consider not in taxid_totals:
+                    taxid_totals[rank_to_consider] = {path_taxid:1}
+                elif path_taxid in taxid_totals[rank_to_consider]:
+                    taxid_totals[rank_to_consider][path_taxid] += 1
+                else:
+                    taxid_totals[rank_to_consider][path_taxid] = 1
+
+    for rank in rank_priority:
+        if rank not in taxid_totals:
+            continue
+        total_votes = 0
+        taxid_leader = None
+        taxid_leader_votes = 0
+        for taxid in taxid_totals[rank]:
+            taxid_votes = taxid_totals[rank][taxid]
+            total_votes += taxid_votes
+            if taxid_votes > taxid_leader_votes:
+                taxid_leader = taxid
+                taxid_leader_votes = taxid_votes
+        if taxid_leader_votes > float(total_votes)/2 and taxid_leader != 'unclassified':
+            return(taxid_leader)
+    # Just in case
+    return(1)
+
+def vote_taxid(rank_counts, lineage):
+    """
+    Returns the taxid voted for by rank_counts ({rank:{taxid:votes}}, ranks
+    from rank_priority). In descending order of rank_priority and of votes,
+    the first taxid consistent with the majority of votes at its rank and
+    above is accepted. If there is none, the lowest majority taxid is used.
+    Taxids with equal votes are tried in the order of rank_counts[rank], so
+    pass OrderedDicts for ties to be broken deterministically
+    """
+    for rank in rank_priority:
+        if rank not in rank_counts:
+            continue
+        ordered_taxids = sorted(rank_counts[rank], key=rank_counts[rank].__getitem__, reverse=True)
+        for taxid in ordered_taxids:
+            if is_consistent(taxid, rank, rank_counts, lineage):
+                return(taxid)
+    return(lowest_majority(rank_counts, lineage))
+
+def file_md5(fpath, blocksize=16777216):
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as fh:
+        block = fh.read(blocksize)
+        while block:
+            md5.update(block)
+            block = fh.read(blocksize)
+    return(md5.hexdigest())
+
+def dump_key(fpaths, cache_dir):
+    """
+    Returns the md5 identifying the dump files. Each file's md5 is recorded in
+    the cache manifest with its size and mtime and only recomputed when they change
+    """
+    manifest_fpath = os.path.join(cache_dir, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_fpath):
+        with open(manifest_fpath) as fh:
+            manifest = json.load(fh)
+    changed = False
+    md5s = []
+    for fpath in fpaths:
+        if fpath is None or not os.path.isfile(fpath):
+            md5s.append('')
+            continue
+        realpath = os.path.realpath(fpath)
+        stat = os.stat(realpath)
+        entry = manifest.get(realpath)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != int(stat.st_mtime):
+            entry = {'size':stat.st_size, 'mtime':int(stat.st_mtime), 'md5':file_md5(realpath)}
+            manifest[realpath] = entry
+            changed = True
+        md5s.append(entry['md5'])
+    if changed:
+        tmp_fpath = manifest_fpath + '.{}.tmp'.format(os.getpid())
+        with open(tmp_fpath, 'w') as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+        os.rename(tmp_fpath, manifest_fpath)
+    return(hashlib.md5(' '.join(md5s)).hexdigest())
+
+def read_dmp(fpath, columns):
+    # Fields are separated by '\t|\t', so splitting on tabs puts field i in column 2*i
+    fields = sorted(columns)
+    return(pd.read_csv(fpath, sep='\t', header=None, usecols=[2*i for i in fields],
+        quoting=3, na_filter=False, dtype={2*i:columns[i] for i in fields}
+        ).rename(columns={2*i:i for i in fields}))
+
+def build_lineage(parent, rank_code, rank_names):
+    "Returns the canonical lineage table (see Taxonomy) by walking every taxid to root at once"
+    slot_of_code = np.array([canonical_ranks.index(rank) if rank in canonical_ranks else -1
+        for rank in rank_names] + [-1], dtype=np.int8)
+    # rank_code -1 (not in nodes.dmp) picks the trailing -1
+    rank_slots = slot_of_code[rank_code]
+    lineage = np.zeros((len(parent), len(canonical_ranks)), dtype=np.int32)
+    taxids = np.arange(len(parent), dtype=np.int32)
+    ancestors = taxids.copy()
+    active = ancestors > 1
+    while active.any():
+        rows = taxids[active]
+        current = ancestors[active]
+        slots = rank_slots[current]
+        canonical = slots >= 0
+        rows, current, slots = rows[canonical], current[canonical], slots[canonical]
+        # Keep the lowest ancestor if a rank repeats along the path
+        unset = lineage[rows, slots] == 0
+        lineage[rows[unset], slots[unset]] = current[unset]
+        ancestors[active] = parent[ancestors[active]]
+        active = ancestors > 1
+    return(lineage)
+
+def build_depth(parent):
+    depth = np.zeros(len(parent), dtype=np.int32)
+    ancestors = parent.copy()
+    active = ancestors > 1
+    while active.any():
+        depth[active] += 1
+        ancestors[active] = parent[ancestors[active]]
+        active = ancestors > 1
+    # The final step from a child of root up to root
+    in_tree = parent != 0
+    in_tree[1] = False
+    depth[in_tree] += 1
+    return(depth)
+
+def compile_taxdump(nodes_fpath, names_fpath, merged_fpath=None):
+    "Parses the dump files and returns (arrays, rank_names)"
+    print(strftime("%Y-%m-%d %H:%M:%S") + ' Compiling taxonomy database from ' + os.path.dirname(os.path.abspath(nodes_fpath)))
+    nodes = read_dmp(nodes_fpath, {0:np.int64, 1:np.int64, 2:str})
+    names = read_dmp(names_fpath, {0:np.int64, 1:str, 3:str})
+    names = names[names[3] == 'scientific name']
+    names = names.drop_duplicates(subset=0, keep='last').sort_values(0)
+    if merged_fpath and os.path.isfile(merged_fpath) and os.path.getsize(merged_fpath):
+        merged = read_dmp(merged_fpath, {0:np.int64, 1:np.int64})
+    else:
+        merged = pd.DataFrame({0:np.array([], dtype=np.int64), 1:np.array([], dtype=np.int64)})
+
+    max_taxid = max(nodes[0].max(), nodes[1].max(), names[0].max() if len(names) else 1)
+    parent = np.zeros(max_taxid + 1, dtype=np.int32)
+    parent[nodes[0].values] = nodes[1].values
+    # Root is its own parent
+    parent[1] = 1
+    rank_names = sorted(nodes[2].str.strip().unique())
+    rank_code = np.full(max_taxid + 1, -1, dtype=np.int16)
+    rank_code[nodes[0].values] = np.searchsorted(rank_names, nodes[2].str.strip().values)
+
+    name_lengths = np.zeros(max_taxid + 1, dtype=np.int64)
+    name_lengths[names[0].values] = names[1].str.len().values
+    name_offsets = np.zeros(max_taxid + 2, dtype=np.int64)
+    np.cumsum(name_lengths, out=name_offsets[1:])
+    name_pool = np.frombuffer(''.join(names[1].values), dtype=np.uint8)
+
+    merged_map = np.zeros(merged[0].max() + 1 if len(merged) else 0, dtype=np.int32)
+    merged_map[merged[0].values] = merged[1].values
+
+    arrays = {
+        'parent':parent,
+        'rank_code':rank_code,
+        'depth':build_depth(parent),
+        'name_offsets':name_offsets,
+        'name_pool':name_pool,
+        'merged':merged_map,
+        'lineage':build_lineage(parent, rank_code, rank_names)}
+    return(arrays, rank_names)
+
+def load(nodes_fpath, names_fpath, merged_fpath=None, cache_dir=None):
+    """
+    Returns a Taxonomy for the dump files, compiling them on first use.
+    The compiled arrays are kept in cache_dir (default: taxonomy_db next to
+    nodes.dmp). If cache_dir is not writable the arrays are built in memory
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(nodes_fpath)), 'taxonomy_db')
+    fpaths = [nodes_fpath, names_fpath, merged_fpath]
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        key = dump_key(fpaths, cache_dir)
+    except (IOError, OSError) as err:
+        print('Could not use taxonomy database cache {} ({}). Building in memory'.format(cache_dir, err))
+        arrays, rank_names = compile_taxdump(*fpaths)
+        return(Taxonomy(arrays, rank_names, None))
+
+    db_dir = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(db_dir, 'ranks.json')):
+        arrays, rank_names = compile_taxdump(*fpaths)
+        # Written to a temporary directory first so concurrent runs never see a partial database
+        tmp_dir = None
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+            for array in ARRAYS:
+                np.save(os.path.join(tmp_dir, array + '.npy'), arrays[array])
+            with open(os.path.join(tmp_dir, 'ranks.json'), 'w') as fh:
+                json.dump(rank_names, fh)
+        except (IOError, OSError) as err:
+            print('Could not save taxonomy database to {} ({}). Using it from memory'.format(cache_dir, err))
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            return(Taxonomy(arrays, rank_names, None))
+        try:
+            os.rename(tmp_dir, db_dir)
+        except OSError:
+            # Another run finished compiling first
+            shutil.rmtree(tmp_dir)
+    arrays = {array:np.load(os.path.join(db_dir, array + '.npy'), mmap_mode='r') for array in ARRAYS}
+    with open(os.path.join(db_dir, 'ranks.json')) as fh:
+        rank_names = [str(rank) for rank in json.load(fh)]
+    return(Taxonomy(arrays, rank_names, key))
+
+def load_dir(taxdump_dir, cache_dir=None):
+    "Returns a Taxonomy for the nodes.dmp, names.dmp and merged.dmp in taxdump_dir"
+    return(load(
+        os.path.join(taxdump_dir, 'nodes.dmp'),
+        os.path.join(taxdump_dir, 'names.dmp'),
+        os.path.join(taxdump_dir, 'merged.dmp'),
+        cache_dir))
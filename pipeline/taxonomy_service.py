@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Long-lived taxonomy service for processing many samples against the same
+# databases. It loads the taxonomy database, the LCA index and resolved
+# accessions once and answers batch requests over a local Unix socket.
+# lca.py, add_contig_taxonomy.py and cluster_taxonomy.py use it when it is
+# running for the same taxdump, and load everything themselves otherwise.
+#
+# Start it with:
+#   taxonomy_service.py <databases directory> [--socket <path>]
+#
+# Requests and responses are single lines of JSON: {"op": ..., ...} is
+# answered with {"result": ...} or {"error": "message"}. Operations:
+#   ping       -> taxonomy database key
+#   lca        "taxsets": [[taxid, ...], ...] -> [[lca, [failed taxids]], ...]
+#   acc2taxid  "accessions": [accession, ...] -> {accession: taxid} for those found
+#   lineage    "taxids": [taxid, ...] -> [[[taxid, name], ...canonical ranks], ...]
+#   vote       "counts": [[[rank, taxid, votes], ...], ...] -> [voted taxid, ...]
+
+import os
+import sys
+import json
+import collections
+import socket
+import signal
+import argparse
+import threading
+import SocketServer
+
+from time import strftime
+
+import taxonomy_db
+
+SOCKET_ENV = 'AUTOMETA_TAXONOMY_SOCKET'
+# Seconds to wait for a service to accept a connection and answer ping
+CONNECT_TIMEOUT = 10
+
+def socket_path(taxdump_dir):
+    "Returns the service socket for a databases directory ($AUTOMETA_TAXONOMY_SOCKET if set)"
+    return(os.environ.get(SOCKET_ENV) or os.path.join(taxdump_dir, 'taxonomy_db', 'service.sock'))
+
+class TaxonomyClient(object):
+    "Connection to a running taxonomy service"
+
+    # Largest number of items sent in one request
+    batch_size = 100000
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.key = self.request('ping')
+
+    def request(self, op, **params):
+        params['op'] = op
+        self.sock.sendall(json.dumps(params) + '\n')
+        line = self.rfile.readline()
+        if not line:
+            raise IOError('Taxonomy service closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError('Taxonomy service error: {}'.format(response['error']))
+        return(response['result'])
+
+    def batched(self, op, name, items):
+        items = list(items)
+        results = []
+        for i in range(0, len(items), self.batch_size):
+            results.extend(self.request(op, **{name:items[i:i+self.batch_size]}))
+        return(results)
+
+    def lca(self, taxsets):
+        "Returns [(lca, failed taxids), ...] for each set of taxids"
+        return([(lca, failed) for lca, failed in self.batched('lca', 'taxsets', [list(taxset) for taxset in taxsets])])
+
+    def acc2taxid(self, accessions):
+        "Returns {accession: taxid} for accessions found in prot.accession2taxid"
+        accessions = list(accessions)
+        acc2taxid_dict = dict()
+        for i in range(0, len(accessions), self.batch_size):
+            hits = self.request('acc2taxid', accessions=accessions[i:i+self.batch_size])
+            acc2taxid_dict.update((str(accession), taxid) for accession, taxid in hits.iteritems())
+        return(acc2taxid_dict)
+
+    def lineage(self, taxids):
+        "Returns the [taxid, name] at each canonical rank for each taxid"
+        return(self.batched('lineage', 'taxids', taxids))
+
+    def vote(self, rank_counts_list):
+        "Returns the voted taxid for each {rank:{taxid:votes}} (see taxonomy_db.vote_taxid)"
+        counts = [[[rank, taxid, votes] for rank in rank_counts for taxid, votes in rank_counts[rank].iteritems()]
+            for rank_counts in rank_counts_list]
+        return(self.batched('vote', 'counts', counts))
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def connect(sock_path, key=None):
+    """
+    Returns a TaxonomyClient for the service listening on sock_path, or None
+    if it is not running or serves a taxonomy database other than key
+    """
+    if not os.path.exists(sock_path):
+        return(None)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # A service that does not answer promptly is treated as not running
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(sock_path)
+        client = TaxonomyClient(sock)
+    except (socket.timeout, socket.error, IOError, ValueError, RuntimeError):
+        sock.close()
+        return(None)
+    # Requests can take as long as a scan of prot.accession2taxid
+    sock.settimeout(None)
+    if key is not None and client.key != key:
+        print('Taxonomy service at {} serves a different taxonomy database. Loading locally'.format(sock_path))
+        client.close()
+        return(None)
+    print('Using taxonomy service at {}'.format(sock_path))
+    return(client)
+
+class TaxonomyService(object):
+    "Taxonomy database, LCA index and accession lookups held in memory between requests"
+
+    def __init__(self, taxdump_dir):
+        import lca_functions
+        self.lca_functions = lca_functions
+        self.taxonomy = taxonomy_db.load_dir(taxdump_dir)
+        print(strftime("%Y-%m-%d %H:%M:%S") + ' Building LCA index')
+        self.jump_table, self.depth = lca_functions.Build_lifting_table(self.taxonomy.parents_dict())
+        # LCAs of the distinct taxid sets reduced so far
+        self.lcas = dict()
+        self.acc2taxid_fpath = None
+        for fname in ['prot.accession2taxid', 'prot.accession2taxid.gz']:
+            fpath = os.path.join(taxdump_dir, fname)
+            if os.path.isfile(fpath):
+                self.acc2taxid_fpath = fpath
+                break
+        # Accessions found so far, and those known to be missing
+        self.acc2taxid_dict = dict()
+        self.missing_accessions = set()
+        # Accession scans share module state in lca_functions, so run one at a time
+        self.acc_lock = threading.Lock()
+
+    def ping(self):
+        return(self.taxonomy.key)
+
+    def lca(self, taxsets):
+        taxsets = [tuple(sorted(taxset)) for taxset in taxsets]
+        pending = list(set(taxset for taxset in taxsets if taxset and taxset not in self.lcas))
+        self.lcas.update(zip(pending, self.lca_functions.Lifting_reduce_taxsets(pending, self.jump_table, self.depth)))
+        return([self.lcas[taxset] if taxset else (1, []) for taxset in taxsets])
+
+    def acc2taxid(self, accessions):
+        accessions = [str(accession) for accession in accessions]
+        with self.acc_lock:
+            unresolved = [accession for accession in set(accessions)
+                if accession not in self.acc2taxid_dict and accession not in self.missing_accessions]
+            if unresolved:
+                if self.acc2taxid_fpath is None:
+                    raise IOError('prot.accession2taxid not found')
+                # Scanned in this process, as forking worker processes from a
+                # request thread could copy locks held by other threads
+                hits = self.lca_functions.Process_accession2taxid_file(self.acc2taxid_fpath, {'query':unresolved})
+                self.acc2taxid_dict.update(hits)
+                self.missing_accessions.update(accession for accession in unresolved if accession not in hits)
+        return({accession:self.acc2taxid_dict[accession] for accession in accessions if accession in self.acc2taxid_dict})
+
+    def lineage(self, taxids):
+        rows = []
+        for taxid in taxids:
+            if not 0 < taxid <= self.taxonomy.max_taxid:
+                rows.append([[0, None] for rank in taxonomy_db.canonical_ranks])
+                continue
+            rows.append([[int(ancestor), self.taxonomy.name(ancestor) if ancestor else None]
+                for ancestor in self.taxonomy.lineage[taxid]])
+        return(rows)
+
+    def vote(self, counts):
+        taxids = []
+        for rank_counts_list in counts:
+            # Votes are kept in the order sent so ties resolve as they would locally
+            rank_counts = {}
+            for rank, taxid, votes in rank_counts_list:
+                rank = str(rank)
+                if rank not in rank_counts:
+                    rank_counts[rank] = collections.OrderedDict()
+                rank_counts[rank][taxid] = votes
+            taxids.append(int(taxonomy_db.vote_taxid(rank_counts, self.taxonomy.lineage)))
+        return(taxids)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.pop('op')
+                if op not in ['ping', 'lca', 'acc2taxid', 'lineage', 'vote']:
+                    raise ValueError('Unknown operation {}'.format(op))
+                response = {'result':getattr(service, op)(**request)}
+            except Exception as err:
+                response = {'error':'{}: {}'.format(type(err).__name__, err)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+class TaxonomyServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve(taxdump_dir, sock_path):
+    if os.path.exists(sock_path):
+        client = connect(sock_path)
+        if client is not None:
+            client.close()
+            exit('A taxonomy service is already listening at {}'.format(sock_path))
+        # Left behind by a service that did not shut down cleanly
+        os.remove(sock_path)
+    service = TaxonomyService(taxdump_dir)
+    server = TaxonomyServer(sock_path, RequestHandler)
+    server.service = service
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(strftime("%Y-%m-%d %H:%M:%S") + ' Taxonomy service listening at {}'.format(sock_path))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.remove(sock_path)
+        print(strftime("%Y-%m-%d %H:%M:%S") + ' Taxonomy service stopped')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves taxonomy lookups to the Autometa taxonomy scripts over a local Unix socket')
+    parser.add_argument('db_dir', help='Directory containing nodes.dmp, names.dmp, merged.dmp and prot.accession2taxid')
+    parser.add_argument('--socket', help='Socket path (default: $AUTOMETA_TAXONOMY_SOCKET or <db_dir>/taxonomy_db/service.sock)')
+    args = vars(parser.parse_args())
+    db_dir = os.path.abspath(args['db_dir'])
+    serve(db_dir, args['socket'] or socket_path(db_dir))
+    # Request threads still open at shutdown would fail noisily while the interpreter exits
+    sys.stdout.flush()
+    os._exit(0)